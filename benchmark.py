@@ -0,0 +1,160 @@
+# end-to-end benchmark of the pipeline against the local stand-in servers of
+# fake_servers.py, for measuring throughput changes reproducibly and without
+# API keys. each configuration is a pipeline setting (how queries are
+# parallelised) run against a server profile (latency, errors, rate limit).
+# for each one, gpt_queries.py is run on a few index terms with fresh memo,
+# completion cache and quota files, then rerun_google.update_df is run over its
+# output with the same memo. the completion server answers with the terms generated
+# for each index term in data/big_run, and the search server can replay the
+# result pages of an existing memo (--replay_memo).
+#
+# reports, for each stage: API queries per second, p50/p99 latency of the API
+# calls (as timed by the retry policy, including waiting on the client's rate
+# limiter) and memo / completion cache hit rates
+#
+# e.g. python benchmark.py --seeds alprazolam,heroin --replay_memo memo.db --out bench.csv
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+import fake_servers
+import gpt_queries
+import rerun_google
+from memo_store import open_memo
+
+
+# pipeline settings: extra gpt_queries.py arguments
+PIPELINES = {
+    "sequential": ["--concurrency", "1", "--search_workers", "1"],
+    "concurrent": ["--concurrency", "8", "--search_workers", "8"],
+    "batched": ["--concurrency", "4", "--batch_prompts", "4", "--search_workers", "8"],
+}
+
+# server profiles: fake_servers.make_server arguments used for both servers
+PROFILES = {
+    "fast": dict(latency=0.02, jitter=0.02),
+    "slow": dict(latency=0.2, jitter=0.2),
+    "flaky": dict(latency=0.05, jitter=0.05, error_rate=0.05, throttle_rate=0.05),
+    "limited": dict(latency=0.05, jitter=0.05, rate_limit=20),
+}
+
+
+# returns one row of the report for a stage of a configuration
+#
+# params:
+# stage (str) - name of the stage
+# seconds (float) - wall clock time of the stage
+# engine (SearchEngine) - search engine used by the stage
+# completion_policy (RetryPolicy) - retry policy of the completion API (None
+#                                   if the stage doesn't query it)
+# cache (CompletionCache) - completion cache of the stage (None if not used)
+def stage_row(stage, seconds, engine, completion_policy=None, cache=None):
+    row = {"stage": stage, "seconds": round(seconds, 2)}
+    for api, policy in [("completion", completion_policy), ("search", engine.policy)]:
+        if policy is None:
+            continue
+        row[api + " calls"] = policy.n_calls
+        row[api + " qps"] = round(policy.n_calls / max(seconds, 1e-9), 1)
+        for p in [50, 99]:
+            latency = policy.latency_percentile(p)
+            row["%s p%d ms" % (api, p)] = None if latency is None else round(latency * 1000, 1)
+        row[api + " retries"] = policy.n_retries
+    n_lookups = engine.n_memo_hits + engine.n_memo_misses
+    row["memo hit rate"] = round(engine.n_memo_hits / n_lookups, 3) if n_lookups > 0 else None
+    if cache is not None:
+        n_lookups = cache.n_hits + cache.n_misses
+        row["cache hit rate"] = round(cache.n_hits / n_lookups, 3) if n_lookups > 0 else None
+    return row
+
+
+# runs both stages of one configuration and returns their report rows
+#
+# params:
+# pipeline (str) - key of PIPELINES
+# profile (str) - key of PROFILES
+# args (argparse.Namespace) - command line args
+# terms (dict) - terms for the completion server (from
+#                fake_servers.load_replay_terms)
+def run_config(pipeline, profile, args, terms):
+    tmp = tempfile.mkdtemp(prefix="benchmark_")
+    completion_server = fake_servers.make_completion_server(terms=terms, **PROFILES[profile])
+    memo = open_memo(args.replay_memo) if args.replay_memo else None
+    search_server = fake_servers.make_search_server(memo=memo, **PROFILES[profile])
+    api_base = fake_servers.start_in_background(completion_server)
+    search_url = fake_servers.start_in_background(search_server)
+
+    seeds_fname = os.path.join(tmp, "seeds.txt")
+    open(seeds_fname, "w").write(args.seeds)
+    outdir = os.path.join(tmp, "out")
+    os.makedirs(outdir)
+    memo_fname = os.path.join(tmp, "memo.db")
+    quota_fname = os.path.join(tmp, "quota.db")
+
+    gq_args = gpt_queries.get_parser().parse_args(["--seeds", seeds_fname, "--prompts", str(args.prompts), "--queries_per_prompt", str(args.queries_per_prompt), "--save", "--outdir", outdir,
+                                                   "--memo", memo_fname, "--quota_db", quota_fname, "--daily_limit", "1000000000", "--completion_cache", os.path.join(tmp, "completions.db"),
+                                                   "--api_base", api_base, "--search_url", search_url, "--search_qps", str(args.search_qps), "--rpm", str(args.rpm), "--tpm", str(args.tpm), "--depth", str(args.depth)] + PIPELINES[pipeline])
+    rr_args = rerun_google.get_parser().parse_args(["-f", outdir, "--memo", memo_fname, "--quota_db", quota_fname, "--daily_limit", "1000000000", "--search_url", search_url,
+                                                    "--qps", str(args.search_qps), "--workers", str(gq_args.search_workers), "--depth", str(args.depth)])
+
+    log = io.StringIO()
+    rows = []
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        start = time.time()
+        completion_policy, engine, cache = gpt_queries.main(gq_args)
+        rows.append(stage_row("gpt_queries", time.time() - start, engine, completion_policy, cache))
+        start = time.time()
+        engine = rerun_google.update_df(rr_args)
+        rows.append(stage_row("rerun_google", time.time() - start, engine))
+    if args.verbose:
+        print(log.getvalue())
+
+    fake_servers.stop(completion_server)
+    fake_servers.stop(search_server)
+    shutil.rmtree(tmp)
+    for row in rows:
+        row["pipeline"] = pipeline
+        row["profile"] = profile
+    return rows
+
+
+def main(args):
+    # the stand-in servers don't check keys, but the clients need one
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    terms = fake_servers.load_replay_terms(args.terms_dir)
+
+    rows = []
+    for pipeline in args.pipelines:
+        for profile in args.profiles:
+            print("running %s pipeline against %s servers" % (pipeline, profile))
+            rows.extend(run_config(pipeline, profile, args, terms))
+    report = pd.DataFrame(rows)
+    report = report[["pipeline", "profile"] + [c for c in report.columns if not c in ["pipeline", "profile"]]].convert_dtypes()
+    print(report.to_string(index=False))
+    if args.out:
+        report.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=str, help="comma-separated index terms to run the pipeline on", default="alprazolam,fentanyl")
+    parser.add_argument('--prompts', type=int, help="number of prompts per index term", default=5)
+    parser.add_argument('--queries_per_prompt', type=int, help="number of queries per prompt", default=2)
+    parser.add_argument('--depth', type=int, help="how deep to go for google search filter", default=10)
+    parser.add_argument('--pipelines', type=str, nargs="+", help="pipeline settings to run (%s)" % ", ".join(PIPELINES), default=list(PIPELINES))
+    parser.add_argument('--profiles', type=str, nargs="+", help="server profiles to run against (%s)" % ", ".join(PROFILES), default=["fast", "flaky"])
+    parser.add_argument('--terms_dir', type=str, help="directory of pipeline output csvs the completion server takes its terms from", default="data/big_run")
+    parser.add_argument('--replay_memo', type=str, help="memo whose recorded result pages the search server replays (made-up pages otherwise)", default=None)
+    parser.add_argument('--search_qps', type=float, help="client-side Google search API queries per second", default=100)
+    parser.add_argument('--rpm', type=float, help="client-side GPT-3 requests per minute", default=6000)
+    parser.add_argument('--tpm', type=float, help="client-side GPT-3 tokens per minute", default=10000000)
+    parser.add_argument('--verbose', action="store_true", help="Flag to show the output of the pipeline runs")
+    parser.add_argument('--out', type=str, help="csv file to write the report to", default=None)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,239 @@
+# renders the figures of the accompanying manuscript (see "Replicating figures"
+# in the README) in one command. each figure is a run of one of the plotting
+# scripts, rendered into a directory of its own under --outdir. figures are
+# independent, so they are rendered on a process pool whose workers import
+# matplotlib and sklearn once for all the figures they render. a figure is
+# only rendered again if the hash of its inputs (its data files, its command
+# line arguments and the source of the scripts it runs) changed since it was
+# last rendered, and the time spent on each figure is reported
+#
+# e.g. python build_figures.py --outdir figures
+#      python build_figures.py figure6 --force
+
+import argparse
+import ast
+import contextlib
+import hashlib
+import io
+import json
+import os
+import runpy
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from redmed_lexicon import LEXICON_PATH
+
+
+# the figures, in order: name, script, command line arguments (without
+# --plotdir) and the data files and directories the script reads
+FIGURES = [
+    ("figure2", "param_sweep_plots.py", ["-f", "data/param_search/alprazolam_grid_out.csv", "--plot", "box", "--col", "n_ungs", "--param", "all"], ["data/param_search/alprazolam_grid_out.csv"]),
+    ("figure3_heroin", "param_sweep_plots.py", ["-f", "data/param_search/heroin_grid_out.csv", "--plot", "box", "--col", "n_ungs", "--param", "all"], ["data/param_search/heroin_grid_out.csv"]),
+    ("figure3_benzphetamine", "param_sweep_plots.py", ["-f", "data/param_search/benzphetamine_grid_out.csv", "--plot", "box", "--col", "n_ungs", "--param", "all"], ["data/param_search/benzphetamine_grid_out.csv"]),
+    ("figure4_alprazolam", "param_sweep_plots.py", ["-f", "data/param_search/alprazolam_grid_out.csv", "--plot", "bar", "--col", "n_ungs", "--param", "all"], ["data/param_search/alprazolam_grid_out.csv"]),
+    ("figure4_heroin", "param_sweep_plots.py", ["-f", "data/param_search/heroin_grid_out.csv", "--plot", "bar", "--col", "n_ungs", "--param", "all"], ["data/param_search/heroin_grid_out.csv"]),
+    ("figure4_benzphetamine", "param_sweep_plots.py", ["-f", "data/param_search/benzphetamine_grid_out.csv", "--plot", "bar", "--col", "n_ungs", "--param", "all"], ["data/param_search/benzphetamine_grid_out.csv"]),
+    ("figure5_alprazolam", "manual_label_plots.py", ["-f", "data/manual_label/alprazolam.csv", "--seed", "alprazolam", "--plot", "depth", "--uniq", "--broad", "--namefilter"], ["data/manual_label/alprazolam.csv", LEXICON_PATH]),
+    ("figure5_fentanyl", "manual_label_plots.py", ["-f", "data/manual_label/fentanyl.csv", "--seed", "fentanyl", "--plot", "depth", "--uniq", "--broad", "--namefilter"], ["data/manual_label/fentanyl.csv", LEXICON_PATH]),
+    ("figure6a", "manual_label_plots.py", ["-f", "data/manual_label/alprazolam.csv", "--seed", "alprazolam", "--plot", "freq", "--uniq", "--broad", "--namefilter"], ["data/manual_label/alprazolam.csv", LEXICON_PATH]),
+    ("figure6b", "manual_label_plots.py", ["-f", "data/manual_label/fentanyl.csv", "--seed", "fentanyl", "--plot", "freq", "--uniq", "--broad", "--namefilter"], ["data/manual_label/fentanyl.csv", LEXICON_PATH]),
+    ("figure6c", "manual_label_plots.py", ["-f", "data/manual_label/alprazolam.csv", "--seed", "alprazolam", "--plot", "freq", "--uniq", "--broad", "--namefilter", "--googlefilter"], ["data/manual_label/alprazolam.csv", LEXICON_PATH]),
+    ("figure6d", "manual_label_plots.py", ["-f", "data/manual_label/fentanyl.csv", "--seed", "fentanyl", "--plot", "freq", "--uniq", "--broad", "--namefilter", "--googlefilter"], ["data/manual_label/fentanyl.csv", LEXICON_PATH]),
+    ("figure7_alprazolam", "manual_label_plots.py", ["-f", "data/manual_label/alprazolam.csv", "--seed", "alprazolam", "--plot", "cm", "--uniq", "--broad"], ["data/manual_label/alprazolam.csv", LEXICON_PATH]),
+    ("figure7_fentanyl", "manual_label_plots.py", ["-f", "data/manual_label/fentanyl.csv", "--seed", "fentanyl", "--plot", "cm", "--uniq", "--broad"], ["data/manual_label/fentanyl.csv", LEXICON_PATH]),
+    ("figure8", "largescale_plots.py", ["--plot", "-d", "data/big_run"], ["data/big_run", "controlled_widely_discussed.txt", LEXICON_PATH]),
+    ("figure8_widely_discussed", "largescale_plots.py", ["--plot", "-d", "data/big_run", "--widelydiscussed"], ["data/big_run", "controlled_widely_discussed.txt", LEXICON_PATH]),
+]
+
+# file in --outdir recording the hash, output files and time of each figure
+STATE = "_figures.json"
+
+
+# returns the source files of a script and of the modules of this repository
+# it imports (and that they import), in order
+#
+# params:
+# script (str) - python script
+def code_files(script):
+    files = [script]
+    for fname in files:
+        with open(fname) as f:
+            tree = ast.parse(f.read(), fname)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                path = module.split(".")[0] + ".py"
+                if os.path.isfile(path) and not path in files:
+                    files.append(path)
+    return files
+
+
+# returns the hash of everything a figure is rendered from: the script and the
+# modules it imports, its arguments and the contents of its data files (every
+# file of a directory). missing files are hashed as missing, so that the figure
+# is rendered (and fails) rather than skipped
+#
+# params:
+# script (str) - plotting script
+# args (list) - command line arguments of the script
+# inputs (list) - data files and directories the script reads
+def figure_hash(script, args, inputs):
+    h = hashlib.sha256()
+    h.update(json.dumps([script, args]).encode())
+    paths = []
+    for path in code_files(script) + inputs:
+        if os.path.isdir(path):
+            paths += sorted(os.path.join(root, f) for root, _, fs in os.walk(path) for f in fs)
+        else:
+            paths.append(path)
+    for path in paths:
+        h.update(path.encode() + b"\0")
+        if not os.path.isfile(path):
+            h.update(b"missing\0")
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+# renders one figure by running its script (as if from the command line) with
+# its own plot directory, which is emptied first. returns the names of the
+# files it wrote, what the script printed, and the time it took. runs in the
+# worker processes
+#
+# params:
+# script (str) - plotting script
+# args (list) - command line arguments of the script (without --plotdir)
+# plotdir (str) - directory to render the figure in
+def render(script, args, plotdir):
+    import matplotlib
+    matplotlib.use("agg")
+    import matplotlib.pyplot as plt
+
+    start = time.time()
+    if os.path.exists(plotdir):
+        shutil.rmtree(plotdir)
+    os.makedirs(plotdir)
+    out = io.StringIO()
+    argv = sys.argv
+    sys.argv = [script] + args + ["--plotdir", plotdir]
+    try:
+        with contextlib.redirect_stdout(out):
+            runpy.run_path(script, run_name="__main__")
+    finally:
+        sys.argv = argv
+        # scripts change rcParams and leave figures open, which would carry
+        # over to the next figure this worker renders
+        plt.close("all")
+        matplotlib.rcdefaults()
+    return sorted(os.listdir(plotdir)), out.getvalue(), time.time() - start
+
+
+# params:
+# outdir (str) - directory figures are rendered in
+def load_state(outdir):
+    try:
+        with open(os.path.join(outdir, STATE)) as f:
+            return json.load(f)
+    except Exception: # no figures rendered yet
+        return dict()
+
+
+# params:
+# state (dict) - hash, files and time of each figure (see build)
+# outdir (str) - directory figures are rendered in
+def save_state(state, outdir):
+    path = os.path.join(outdir, STATE)
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+# renders the figures whose inputs changed since they were last rendered (or
+# whose files are gone) on a process pool, longest first, and skips the rest.
+# returns a list of (name, status, seconds) tuples in the order of FIGURES,
+# where status is "rendered", "cached" or the error the script raised
+#
+# params:
+# names (list) - figures to build (names or prefixes of names, e.g. figure6),
+#                all of them if empty
+# outdir (str) - directory to render the figures in, one subdirectory each
+# workers (int) - number of worker processes
+# force (bool) - flag to render figures even if their inputs didn't change
+def build(names, outdir, workers, force=False):
+    figures = [fig for fig in FIGURES if len(names) == 0 or any(fig[0].startswith(n) for n in names)]
+    if len(figures) == 0:
+        raise ValueError("no figures named %s" % ", ".join(names))
+    os.makedirs(outdir, exist_ok=True)
+    state = load_state(outdir)
+
+    results = dict()
+    todo = []
+    for name, script, args, inputs in figures:
+        hash_ = figure_hash(script, args, inputs)
+        done = state.get(name)
+        if not force and done is not None and done["hash"] == hash_ and all(os.path.isfile(os.path.join(outdir, name, f)) for f in done["files"]):
+            results[name] = ("cached", 0.0)
+        else:
+            todo.append((name, script, args, hash_))
+    print("%d of %d figures to render (%d cached)" % (len(todo), len(figures), len(figures) - len(todo)))
+
+    # the figures that took longest last time go first, so that they don't
+    # hold up the end of the build
+    todo.sort(key=lambda job: -state.get(job[0], dict()).get("seconds", float("inf")))
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as executor:
+        futures = {executor.submit(render, script, args, os.path.join(outdir, name)): (name, hash_) for name, script, args, hash_ in todo}
+        for future in as_completed(futures):
+            name, hash_ = futures[future]
+            try:
+                files, printed, seconds = future.result()
+            except (Exception, SystemExit) as e: # SystemExit from argparse included
+                results[name] = ("failed: %s: %s" % (type(e).__name__, e), 0.0)
+                state.pop(name, None)
+                print("%s: failed (%s: %s)" % (name, type(e).__name__, e))
+                continue
+            if len(printed) > 0:
+                with open(os.path.join(outdir, name + ".log"), "w") as f:
+                    f.write(printed)
+            results[name] = ("rendered", seconds)
+            state[name] = {"hash": hash_, "files": files, "seconds": seconds}
+            save_state(state, outdir)
+            print("%s: %d files in %.1f s" % (name, len(files), seconds))
+    save_state(state, outdir)
+    return [(fig[0],) + results[fig[0]] for fig in figures]
+
+
+def main(args):
+    if args.list:
+        for name, script, fig_args, _ in FIGURES:
+            print("%s: python %s %s" % (name, script, " ".join(fig_args)))
+        return
+    start = time.time()
+    results = build(args.figures, args.outdir, args.workers, force=args.force)
+    print()
+    for name, status, seconds in results:
+        print("%-26s %-10s %6.1f s" % (name, status, seconds))
+    n_failed = sum(1 for _, status, _ in results if status.startswith("failed"))
+    print("%d figures in %.1f s (%d failed)" % (len(results), time.time() - start, n_failed))
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('figures', type=str, nargs="*", help="figures to build, by name or prefix (e.g. figure6). all of them if none are given")
+    parser.add_argument('--outdir', type=str, help="directory in which to render the figures, one subdirectory per figure", default="figures")
+    parser.add_argument('--workers', type=int, help="number of processes to render figures with", default=os.cpu_count())
+    parser.add_argument('--force', action="store_true", help="Flag to render figures even if their inputs haven't changed")
+    parser.add_argument('--list', action="store_true", help="Flag to list the figures and the commands they are rendered with")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,165 @@
+# persistent cache of GPT-3 completions, so that re-running a seed (e.g. to
+# change a filter or the response parser) doesn't pay for generation again.
+# entries are content-addressed: the key is a hash of the engine, prompt text,
+# sampling parameters and sample index (the i-th completion of the same prompt
+# in a run), and the value is the raw text of the completion. the cache is a
+# SQLite database with a size bound; the least recently used entries are
+# evicted when it grows past the bound.
+#
+# to share a cache between machines:
+# python completion_cache.py export completions.db completions.jsonl
+# python completion_cache.py import completions.db completions.jsonl
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+import sqlite3
+
+
+# returns the cache key for one completion
+#
+# params:
+# eng (str) - GPT-3 engine
+# prompt (str) - prompt text
+# temp (float) - temperature
+# maxt (int) - maximum number of tokens
+# freq (float) - frequency penalty
+# pres (float) - presence penalty
+# sample (int) - sample index of the completion for this prompt
+def completion_key(eng, prompt, temp, maxt, freq, pres, sample):
+    fields = json.dumps([eng, prompt, float(temp), int(maxt), float(freq), float(pres), int(sample)])
+    return hashlib.sha256(fields.encode()).hexdigest()
+
+
+# params:
+# path (str) - database file (created if it doesn't exist)
+# max_bytes (int) - size bound of the cached completion texts (0 for no bound)
+class CompletionCache:
+    def __init__(self, path, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conns = []
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, engine TEXT, prompt TEXT, temp REAL, maxt INTEGER, freq REAL, pres REAL, sample INTEGER, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        self.n_hits = 0
+        self.n_misses = 0
+
+    # returns this thread's connection to the database
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+
+    # returns the cached completion text, or None if it isn't cached
+    #
+    # params:
+    # eng, prompt, temp, maxt, freq, pres, sample - same as for completion_key
+    def get(self, eng, prompt, temp, maxt, freq, pres, sample):
+        key = completion_key(eng, prompt, temp, maxt, freq, pres, sample)
+        conn = self.connect()
+        row = conn.execute("SELECT text FROM completions WHERE key = ?", (key,)).fetchone()
+        with self.lock:
+            if row is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        if row is None:
+            return None
+        conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    # params:
+    # eng, prompt, temp, maxt, freq, pres, sample - same as for completion_key
+    # text (str) - raw text of the completion
+    def put(self, eng, prompt, temp, maxt, freq, pres, sample, text):
+        key = completion_key(eng, prompt, temp, maxt, freq, pres, sample)
+        size = len(text.encode())
+        conn = self.connect()
+        # a completion that is already cached is replaced, so only the
+        # difference in size counts towards the bound
+        old = conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, eng, prompt, float(temp), int(maxt), float(freq), float(pres), int(sample), text, size, time.time()))
+        with self.lock:
+            self.total_bytes += size - (0 if old is None else old[0])
+            over = self.max_bytes > 0 and self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    # deletes least recently used entries until the cache is below 90% of its
+    # size bound
+    def evict(self):
+        conn = self.connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        target = self.max_bytes * 0.9
+        if total > target:
+            doomed = []
+            for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_used"):
+                if total <= target:
+                    break
+                doomed.append((key,))
+                total -= size
+            conn.executemany("DELETE FROM completions WHERE key = ?", doomed)
+        with self.lock:
+            self.total_bytes = total
+
+    # writes every entry to a JSON lines file
+    #
+    # params:
+    # fname (str) - file to write
+    def export(self, fname):
+        n = 0
+        with open(fname, "w") as f:
+            for row in self.connect().execute("SELECT engine, prompt, temp, maxt, freq, pres, sample, text FROM completions"):
+                f.write(json.dumps(dict(zip(["engine", "prompt", "temp", "maxt", "freq", "pres", "sample", "text"], row))) + "\n")
+                n += 1
+        return n
+
+    # adds every entry of a JSON lines file written by export
+    #
+    # params:
+    # fname (str) - file to read
+    def import_file(self, fname):
+        n = 0
+        for line in open(fname, "r"):
+            if line.strip() == "":
+                continue
+            e = json.loads(line)
+            self.put(e["engine"], e["prompt"], e["temp"], e["maxt"], e["freq"], e["pres"], e["sample"], e["text"])
+            n += 1
+        return n
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+        self.local = threading.local()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, help="what to do (export or import)")
+    parser.add_argument('cache', type=str, help="completion cache database")
+    parser.add_argument('fname', type=str, help="JSON lines file to export to or import from")
+    args = parser.parse_args()
+
+    cache = CompletionCache(args.cache)
+    if args.command == "export":
+        print("exported %d completions to %s" % (cache.export(args.fname), args.fname))
+    elif args.command == "import":
+        print("imported %d completions from %s" % (cache.import_file(args.fname), args.fname))
+    else:
+        raise ValueError("unknown command: %s" % args.command)
+    cache.close()
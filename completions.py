@@ -0,0 +1,337 @@
+# submits prompts to GPT-3 and parses the responses. query() is the sequential
+# path (one blocking request at a time); run_queries() sends a whole batch of
+# prompts concurrently, spaced out by a shared CompletionLimiter;
+# run_batched_queries() additionally packs several prompts and all queries
+# per prompt into each request. all of them can look completions up in (and add
+# them to) a CompletionCache, so that a rerun doesn't pay for them again.
+# failed requests are retried according to a RetryPolicy (see retry.py).
+# completions that can't be parsed aren't API errors: the prompt is simply
+# queried again (up to the policy's max_attempts times), without counting
+# towards the policy's failures or circuit breaker. a query the policy gives up
+# on after errors that may go away is returned as None, so that the caller can
+# skip it; errors that can't (e.g. a bad API key) are raised
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from rate_limit import estimate_tokens
+from retry import PERMANENT, RetryPolicy, classify
+
+
+# cleans the raw text of a completion and parses it into a list of terms
+#
+# params:
+# text (str) - text of the completion (continuation of the numbered list in the prompt)
+def parse_response(text):
+    rtext = text.replace("\"","").lower()
+    rtext = rtext.split("\n")
+    clean_rtext = []
+    clean_rtext.append(rtext[0][1:].replace(" ","_"))
+    if len(rtext) > 1:
+        for i in range(1, len(rtext)):
+            if rtext[i][0].isnumeric() and rtext[i][1] == ".":
+                clean_rtext.append(rtext[i][2:].strip().replace(" ","_"))
+            elif rtext[i][:2].isnumeric() and rtext[i][2] == ".":
+                clean_rtext.append(rtext[i][3:].strip().replace(" ","_"))
+            else:
+                print("warning: response not formatted as list!")
+                print(rtext[i])
+
+    return clean_rtext
+
+
+# returns the parsed completion from the cache, or None if it isn't cached (or
+# no longer parses)
+#
+# params:
+# cache (CompletionCache) - completion cache (None to not use one)
+# eng, prompt, temp, maxt, freq, pres - same as for query
+# sample (int) - sample index of the completion for this prompt
+def cached_response(cache, eng, prompt, temp, maxt, freq, pres, sample):
+    if cache is None:
+        return None
+    text = cache.get(eng, prompt, temp, maxt, freq, pres, sample)
+    if text is None:
+        return None
+    try:
+        return parse_response(text)
+    except Exception:
+        return None
+
+
+# parses the text of a completion from the API. returns None (with a warning)
+# if it can't be parsed, so that the prompt is queried again
+#
+# params:
+# text (str) - text of the completion
+def parse_completion(text):
+    try:
+        return parse_response(text)
+    except Exception as e:
+        print("warning: could not parse completion (%r), querying again" % e)
+        return None
+
+
+# returns None for a query the retry policy gave up on, so that it is skipped,
+# unless the error can't go away by itself (e.g. a bad API key), which is
+# raised
+#
+# params:
+# e (Exception) - exception the retry policy gave up with
+def give_up(e):
+    if classify(e) == PERMANENT:
+        raise e
+    print("giving up on a query: %r" % e)
+    return None
+
+
+# submit query to GPT-3, collect response, clean and parse
+#
+# params:
+# eng (str) - GPT-3 engine to use
+# prompt (str) - prompt to give to GPT-3
+# temp (float) - temperature at which to run GPT-3 (lower temperature = more
+#                likely responses, higher temperature = more diverse responses)
+# maxt (int) - maximum number of tokens for GPT-3 query and response
+# freq (float) - frequency penalty (positive values penalize new tokens based
+#                on their existing frequency in the text so far, decreasing
+#                the model's likelihood to repeat the same line verbatim)
+# pres (float) - presence penalty (positive values penalize new tokens based
+#                on whether they appear in the text so far, increasing the
+#                model's likelihood to talk about new topics)
+# cache (CompletionCache) - completion cache (None to not use one)
+# sample (int) - sample index of the completion for this prompt (the number of
+#                earlier queries in the run with the same prompt)
+# policy (RetryPolicy) - retry policy for the request
+def query(eng, prompt, temp, maxt, freq, pres, cache=None, sample=0, policy=None):
+    clean_rtext = cached_response(cache, eng, prompt, temp, maxt, freq, pres, sample)
+    if clean_rtext is not None:
+        return clean_rtext
+    if policy is None:
+        policy = RetryPolicy()
+
+    def attempt():
+        response = openai.Completion.create(engine=eng,
+                                            prompt=prompt,
+                                            temperature=temp,
+                                            max_tokens=maxt,
+                                            frequency_penalty=freq,
+                                            presence_penalty=pres)
+        time.sleep(1.5) # must space out queries for rate limiting
+        return response["choices"][0]["text"]
+
+    for _ in range(policy.max_attempts):
+        try:
+            text = policy.call(attempt)
+        except Exception as e:
+            return give_up(e)
+        clean_rtext = parse_completion(text)
+        if clean_rtext is not None:
+            if cache is not None:
+                cache.put(eng, prompt, temp, maxt, freq, pres, sample, text)
+            return clean_rtext
+    print("giving up on a query: no completion could be parsed")
+    return None
+
+
+# async version of query. waits on the shared limiter instead of sleeping
+# after the request, and (like query) retries until a response is received and
+# parsed, or gives up. the blocking API call runs on the given thread pool so
+# that other requests can be in flight at the same time
+#
+# params:
+# eng, prompt, temp, maxt, freq, pres, cache, sample - same as for query
+# limiter (CompletionLimiter) - rate limiter shared by all requests
+# executor (Executor) - thread pool to make the blocking API calls on
+# policy (RetryPolicy) - retry policy shared by all requests
+async def aquery(eng, prompt, temp, maxt, freq, pres, limiter, executor, cache=None, sample=0, policy=None):
+    clean_rtext = cached_response(cache, eng, prompt, temp, maxt, freq, pres, sample)
+    if clean_rtext is not None:
+        return clean_rtext
+    loop = asyncio.get_running_loop()
+    estimated = estimate_tokens(prompt, maxt)
+    create = functools.partial(openai.Completion.create,
+                               engine=eng,
+                               prompt=prompt,
+                               temperature=temp,
+                               max_tokens=maxt,
+                               frequency_penalty=freq,
+                               presence_penalty=pres)
+    if policy is None:
+        policy = RetryPolicy()
+
+    async def attempt():
+        await limiter.acquire_async(estimated)
+        return await loop.run_in_executor(executor, create)
+
+    for _ in range(policy.max_attempts):
+        try:
+            response = await policy.call_async(attempt)
+        except Exception as e:
+            return give_up(e)
+        if "usage" in response:
+            limiter.settle(estimated, response["usage"]["total_tokens"])
+        text = response["choices"][0]["text"]
+        clean_rtext = parse_completion(text)
+        if clean_rtext is not None:
+            if cache is not None:
+                cache.put(eng, prompt, temp, maxt, freq, pres, sample, text)
+            return clean_rtext
+    print("giving up on a query: no completion could be parsed")
+    return None
+
+
+# queries GPT-3 queries_per_prompt times with each prompt, keeping up to
+# concurrency requests in flight. returns the parsed responses in the same
+# order as the sequential loop would (all queries for the first prompt, then
+# all queries for the second prompt, etc.), with None for queries that were
+# given up on
+#
+# params:
+# prompts (list) - prompts to query with
+# queries_per_prompt (int) - number of times to query with each prompt
+# eng, temp, maxt, freq, pres - same as for query
+# limiter (CompletionLimiter) - rate limiter shared by all requests
+# concurrency (int) - maximum number of requests in flight at once
+# cache (CompletionCache) - completion cache (None to not use one)
+# samples (list) - sample index of each query, in the same order as the
+#                  responses (defaults to the query index)
+# policy (RetryPolicy) - retry policy shared by all requests
+async def run_queries(prompts, queries_per_prompt, eng, temp, maxt, freq, pres, limiter, concurrency, cache=None, samples=None, policy=None):
+    jobs = [(prompt, j) for prompt in prompts for j in range(queries_per_prompt)]
+    if samples is None:
+        samples = [j for prompt, j in jobs]
+    if policy is None:
+        policy = RetryPolicy()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def one(prompt, sample):
+        async with in_flight:
+            return await aquery(eng, prompt, temp, maxt, freq, pres, limiter, executor, cache, sample, policy)
+
+    try:
+        return await asyncio.gather(*[one(prompt, sample) for (prompt, j), sample in zip(jobs, samples)])
+    finally:
+        executor.shutdown(wait=False)
+
+
+# async version of query for several prompts and n completions per prompt in
+# a single API request. returns a list with the parsed responses for each
+# prompt (n per prompt). completions that can't be parsed are re-queried one
+# at a time with aquery, like the sequential loop would. if the request is
+# given up on, every completion is None
+#
+# params:
+# eng, temp, maxt, freq, pres - same as for query
+# prompts (list) - prompts to query with
+# n (int) - number of completions to generate per prompt
+# limiter (CompletionLimiter) - rate limiter shared by all requests
+# executor (Executor) - thread pool to make the blocking API calls on
+# cache (CompletionCache) - completion cache to add the completions to (None to
+#                           not use one)
+# samples (list) - sample index of each completion, as a list of n per prompt
+#                  (defaults to 0, ..., n - 1)
+# policy (RetryPolicy) - retry policy shared by all requests
+async def aquery_batch(eng, prompts, n, temp, maxt, freq, pres, limiter, executor, cache=None, samples=None, policy=None):
+    if samples is None:
+        samples = [list(range(n)) for _ in prompts]
+    if policy is None:
+        policy = RetryPolicy()
+    loop = asyncio.get_running_loop()
+    estimated = sum(estimate_tokens(prompt, maxt * n) for prompt in prompts)
+    create = functools.partial(openai.Completion.create,
+                               engine=eng,
+                               prompt=prompts,
+                               n=n,
+                               temperature=temp,
+                               max_tokens=maxt,
+                               frequency_penalty=freq,
+                               presence_penalty=pres)
+
+    async def attempt():
+        await limiter.acquire_async(estimated)
+        return await loop.run_in_executor(executor, create)
+
+    try:
+        response = await policy.call_async(attempt)
+    except Exception as e:
+        give_up(e)
+        return [[None] * n for _ in prompts]
+    if "usage" in response:
+        limiter.settle(estimated, response["usage"]["total_tokens"])
+
+    # choices come back ordered by prompt, then by completion (index = prompt * n + k)
+    parsed = [[None] * n for _ in prompts]
+    for choice in response["choices"]:
+        a, b = choice["index"] // n, choice["index"] % n
+        parsed[a][b] = parse_completion(choice["text"])
+        if parsed[a][b] is None:
+            continue
+        if cache is not None:
+            cache.put(eng, prompts[a], temp, maxt, freq, pres, samples[a][b], choice["text"])
+    for a in range(len(prompts)):
+        for b in range(n):
+            if parsed[a][b] is None:
+                parsed[a][b] = await aquery(eng, prompts[a], temp, maxt, freq, pres, limiter, executor, cache, samples[a][b], policy)
+    return parsed
+
+
+# like run_queries, but packs up to batch_size prompts into each API request
+# and asks for all the queries of a prompt at once (using n). returns the
+# parsed response for each (prompt index, query index) slot, in the order of
+# slots (None for slots that were given up on). slots whose completion is
+# already cached aren't requested
+#
+# params:
+# slots (list) - (prompt index, query index) tuples to query for
+# prompts (list) - prompts, indexed by prompt index
+# batch_size (int) - maximum number of prompts per API request
+# eng, temp, maxt, freq, pres - same as for query
+# limiter (CompletionLimiter) - rate limiter shared by all requests
+# concurrency (int) - maximum number of requests in flight at once
+# cache (CompletionCache) - completion cache (None to not use one)
+# samples (dict) - sample index of each slot (defaults to the query index)
+# policy (RetryPolicy) - retry policy shared by all requests
+async def run_batched_queries(slots, prompts, batch_size, eng, temp, maxt, freq, pres, limiter, concurrency, cache=None, samples=None, policy=None):
+    if samples is None:
+        samples = {(i, j): j for i, j in slots}
+    if policy is None:
+        policy = RetryPolicy()
+    responses = dict()
+    pending = dict()
+    for i, j in slots:
+        parsed = cached_response(cache, eng, prompts[i], temp, maxt, freq, pres, samples[(i, j)])
+        if parsed is None:
+            pending.setdefault(i, []).append((i, j))
+        else:
+            responses[(i, j)] = parsed
+
+    # only prompts that need the same number of completions can share a request
+    by_n = dict()
+    for i, prompt_slots in pending.items():
+        by_n.setdefault(len(prompt_slots), []).append(i)
+    batches = []
+    for n, idxs in by_n.items():
+        for k in range(0, len(idxs), batch_size):
+            batches.append((n, idxs[k:k + batch_size]))
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def one(n, idxs):
+        async with in_flight:
+            return await aquery_batch(eng, [prompts[i] for i in idxs], n, temp, maxt, freq, pres, limiter, executor, cache, [[samples[slot] for slot in pending[i]] for i in idxs], policy)
+
+    try:
+        results = await asyncio.gather(*[one(n, idxs) for n, idxs in batches])
+    finally:
+        executor.shutdown(wait=False)
+
+    for (n, idxs), result in zip(batches, results):
+        for i, parsed in zip(idxs, result):
+            for slot, response in zip(pending[i], parsed):
+                responses[slot] = response
+    return [responses[slot] for slot in slots]
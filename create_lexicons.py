@@ -1,20 +1,105 @@
 # to create the TSVs in the `lexicon` directory
+# the row of each pipeline output file is cached (--cache), so rebuilding a
+# lexicon after some of the files changed only reads those files again
 
+import os
 import pandas as pd
 import numpy as np
-import os
 import argparse
+from redmed_lexicon import LEXICON_PATH, load_lexicon, source_fingerprint
+from run_store import file_fingerprint, load_cache, map_runs, save_cache, source_files
+from tqdm import tqdm
+
+
+# bump when generated_row or manual_row change, so cached rows are rebuilt
+ROWS_VERSION = 1
 
 
 # obtains the DrugBank ID for a given index term
 #
 # params:
-# redmed (DataFrame) - RedMed lexicon in a pandas DataFrame
+# lexicon (Lexicon) - RedMed lexicon (from redmed_lexicon.load_lexicon)
 # idx_term (str) - index term to look up
-def get_dbid(redmed, idx_term):
-    row = redmed.loc[redmed["drug"] == idx_term]
-    dbid = row["dbid"].tolist()[0]
-    return dbid
+def get_dbid(lexicon, idx_term):
+    return lexicon.dbids[idx_term]
+
+
+# returns the index term of a pipeline output file and its GPT-3 synonyms (as
+# written to the lexicon): the unique terms that pass the Google filter and
+# the drug name filter, in the order they were generated
+#
+# params:
+# f (str) - file name
+# file_columns (list) - columns of the file
+# df (DataFrame) - typed rows of the file (see run_store.py)
+def generated_row(f, file_columns, df):
+    drug_names = load_lexicon().drug_names
+    idx_term = df["seed for prompt"].unique().tolist()[0]
+    terms = df["GPT-3 term"]
+    passed = df["Google"].fillna(False).to_numpy(dtype=bool) & ((terms == df["seed for prompt"].astype(object)) | ~terms.isin(drug_names))
+    return idx_term, ",".join("\'%s\'" % t for t in terms[passed].unique())
+
+
+# returns the index term of a manually labeled pipeline output file and its
+# specific and broad synonyms (as written to the lexicon): the unique terms
+# labeled "True" and "?", in the order they were generated
+#
+# params:
+# f (str) - file name
+# file_columns (list) - columns of the file
+# df (DataFrame) - typed rows of the file (see run_store.py)
+def manual_row(f, file_columns, df):
+    idx_term = df["seed for prompt"].unique().tolist()[0]
+    terms = df["GPT-3 term"]
+    spec = terms[(df["manual label"] == "True").to_numpy()].unique()
+    broad = terms[(df["manual label"] == "?").to_numpy()].unique()
+    return idx_term, ",".join("\'%s\'" % t for t in spec), ",".join("\'%s\'" % t for t in broad)
+
+
+# returns the row of each pipeline output file in a directory (or dataset),
+# in order. rows of files that haven't changed since they were cached are
+# reused, the others are built from the files on a process pool
+#
+# params:
+# d (str) - directory of pipeline output files, or a dataset of them
+# fn (function) - generated_row or manual_row
+# columns (list) - columns of the files fn uses
+# cache (dict) - cache of rows (see run_store.load_cache), keyed by (absolute
+#                path, fn name), updated in place
+# workers (int) - number of worker processes
+def build_rows(d, fn, columns, cache, workers):
+    sources = source_files(d)
+    extra = (ROWS_VERSION, source_fingerprint(LEXICON_PATH))
+    keys = dict()
+    fingerprints = dict()
+    todo = []
+    for s in sources:
+        f = s["file"]
+        keys[f] = (os.path.abspath(os.path.join(d, f)), fn.__name__)
+        fingerprints[f] = file_fingerprint(s, extra)
+        if cache.get(keys[f], (None,))[0] != fingerprints[f]:
+            todo.append(f)
+    print("%d of %d files to read (%d cached)" % (len(todo), len(sources), len(sources) - len(todo)))
+
+    for f, row in tqdm(map_runs(d, fn, todo, columns=columns, workers=workers), total=len(todo)):
+        cache[keys[f]] = (fingerprints[f], row)
+    return [cache[keys[s["file"]]][1] for s in sources]
+
+
+# returns rows (lists or tuples starting with the index term) in the order of
+# the lexicon TSV they are about to replace, so that rebuilding a lexicon only
+# changes the rows of files that changed. index terms that aren't in the TSV
+# go last, in their original order
+#
+# params:
+# rows (list) - lexicon rows
+# outfname (str) - lexicon TSV (need not exist)
+def in_tsv_order(rows, outfname):
+    order = dict()
+    if os.path.isfile(outfname):
+        idxs = pd.read_csv(outfname, sep="\t", usecols=["index term"], keep_default_na=False)["index term"]
+        order = {idx_term: i for i, idx_term in enumerate(idxs)}
+    return sorted(rows, key=lambda row: order.get(row[0], len(order)))
 
 
 # creates the lexicon TSV for generated GPT-3 synonyms
@@ -22,31 +107,18 @@ def get_dbid(redmed, idx_term):
 # params:
 # d (str) - name of directory in which pipeline output files are located
 # outfname (str) - name of TSV file to write out
-def generated_lexicon(d, outfname):
-    redmed = pd.read_csv("redmed_lexicon.tsv",sep="\t")
+# cache (dict) - cache of rows (see build_rows)
+# workers (int) - number of worker processes
+def generated_lexicon(d, outfname, cache, workers=1):
+    lexicon = load_lexicon()
     discussed_list = open("controlled_widely_discussed.txt","r").read().split("\n")
-    csvs = [f for f in os.listdir(d) if f[-4:] == ".csv"]
-
-    idxs = []
-    dbids = []
-    widely_discussed = []
-    gpt_synonyms = []
-
-    for f in csvs:
-        df = pd.read_csv(os.path.join(d, f), index_col=0)
-        idx_term = df["seed for prompt"].unique().tolist()[0]
-        if "Google" in df.columns:
-            google_col = "Google"
-        else:
-            google_col = "GPT-3 term in Google"
-        filter_df = df.loc[df.apply(lambda row: (row[google_col] == True or row[google_col] == "True") and (row["GPT-3 term"] == row["seed for prompt"] or not row["GPT-3 term"] in redmed["drug"].tolist()),axis=1)]
-        terms = filter_df["GPT-3 term"].unique().tolist()
-        terms = ["\'%s\'" % t for t in terms]
-
-        idxs.append(idx_term)
-        dbids.append(get_dbid(redmed, idx_term))
-        widely_discussed.append(idx_term in discussed_list)
-        gpt_synonyms.append(",".join(terms))
+
+    rows = build_rows(d, generated_row, ["GPT-3 term", "seed for prompt", "Google"], cache, workers)
+    rows = in_tsv_order(rows, outfname)
+    idxs = [idx_term for idx_term, _ in rows]
+    dbids = [get_dbid(lexicon, idx_term) for idx_term in idxs]
+    widely_discussed = [idx_term in discussed_list for idx_term in idxs]
+    gpt_synonyms = [synonyms for _, synonyms in rows]
 
     data_dic = {"index term": idxs, "DrugBank ID": dbids, "widely discussed": widely_discussed, "GPT-3 synonyms": gpt_synonyms}
     outdf = pd.DataFrame(data=data_dic)
@@ -58,49 +130,42 @@ def generated_lexicon(d, outfname):
 # params:
 # d (str) - name of directory in which pipeline output files with manual labels are located
 # outfname (str) - name of TSV file to write out
-def manual_lexicon(d, outfname):
-    redmed = pd.read_csv("redmed_lexicon.tsv",sep="\t")
-    csvs = [f for f in os.listdir(d) if f[-4:] == ".csv"]
-
-    idxs = []
-    dbids = []
-    specific_syns = []
-    broad_syns = []
-
-    for f in csvs:
-        df = pd.read_csv(os.path.join(d, f), index_col=0)
-        idx_term = df["seed for prompt"].unique().tolist()[0]
-        true_df = df.loc[df["manual label"] == "True"]
-        spec = true_df["GPT-3 term"].unique().tolist()
-        spec = ["\'%s\'" % t for t in spec]
-        broad_df = df.loc[df["manual label"] == "?"]
-        broad = broad_df["GPT-3 term"].unique().tolist()
-        broad = ["\'%s\'" % t for t in broad]
-
-        idxs.append(idx_term)
-        dbids.append(get_dbid(redmed, idx_term))
-        specific_syns.append(",".join(spec))
-        broad_syns.append(",".join(broad))
+# cache (dict) - cache of rows (see build_rows)
+# workers (int) - number of worker processes
+def manual_lexicon(d, outfname, cache, workers=1):
+    lexicon = load_lexicon()
+
+    rows = build_rows(d, manual_row, ["GPT-3 term", "seed for prompt", "manual label"], cache, workers)
+    rows = in_tsv_order(rows, outfname)
+    idxs = [idx_term for idx_term, _, _ in rows]
+    dbids = [get_dbid(lexicon, idx_term) for idx_term in idxs]
+    specific_syns = [spec for _, spec, _ in rows]
+    broad_syns = [broad for _, _, broad in rows]
 
     data_dic = {"index term": idxs, "DrugBank ID": dbids, "specific synonyms": specific_syns, "broad synonyms": broad_syns}
     outdf = pd.DataFrame(data=data_dic)
     outdf.to_csv(outfname, index=False, sep="\t")
 
 def main(args):
+    cache = load_cache(args.cache) if args.cache else dict()
     if args.generated:
-        generated_lexicon(args.generated_dir, args.generated_fname)
+        generated_lexicon(args.generated_dir, args.generated_fname, cache, args.workers)
     if args.manual:
-        manual_lexicon(args.manual_dir, args.manual_fname)
+        manual_lexicon(args.manual_dir, args.manual_fname, cache, args.workers)
+    if args.cache:
+        save_cache(cache, args.cache)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--generated', action="store_true", help="Flag for creating the `drugs_of_abuse_lexicon.tsv` file with generated GPT-3 synonyms")
-    parser.add_argument('--generated_dir', type=str, help="directory in which output csvs from GPT-3 query pipeline are located", default="data/big_run")
+    parser.add_argument('--generated_dir', type=str, help="directory in which output csvs from GPT-3 query pipeline are located (or a dataset of them, see run_store.py)", default="data/big_run")
     parser.add_argument('--generated_fname', type=str, help="output filename for lexicon of generated GPT-3 synonyms", default="lexicon/drugs_of_abuse_lexicon.tsv")
     parser.add_argument('--manual', action="store_true", help="Flag for creating the `manual_label_lexicon.tsv` file with manually labeled synonyms")
-    parser.add_argument('--manual_dir', type=str, help="directory in which output csvs from GPT-3 query pipeline, WITH MANUAL LABELS, are located", default="data/manual_label")
+    parser.add_argument('--manual_dir', type=str, help="directory in which output csvs from GPT-3 query pipeline, WITH MANUAL LABELS, are located (or a dataset of them)", default="data/manual_label")
     parser.add_argument('--manual_fname', type=str, help="output filename for lexicon of manually-labeled generated synonyms", default="lexicon/manual_label_lexicon.tsv")
+    parser.add_argument('--cache', type=str, help="file caching the lexicon row built from each pipeline output file, so that unchanged files aren't read again ('' for no cache)", default="create_lexicons.cache")
+    parser.add_argument('--workers', type=int, help="number of processes to read pipeline output files with", default=os.cpu_count())
     args = parser.parse_args()
 
     main(args)
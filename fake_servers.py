@@ -0,0 +1,380 @@
+# local stand-ins for the external APIs used by the pipeline, for exercising
+# and timing the pipeline without spending API credits.
+# e.g. run `python fake_servers.py completion --port 8001` and then
+# `python gpt_queries.py --api_base http://localhost:8001/v1 ...`, or
+# `python fake_servers.py search --port 8002` and then
+# `python rerun_google.py --search_url http://localhost:8002/customsearch/v1 ...`
+#
+# to make the responses realistic, the completion server can answer with terms
+# generated for the same index term in an earlier run (--terms_dir
+# data/big_run), and the search server can replay the result pages recorded
+# in a memo (--replay_memo memo.db). both can add latency, errors and a rate
+# limit. see benchmark.py for timing the whole pipeline against them
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+from memo_store import open_memo
+from rate_limit import TokenBucket
+
+
+# terms the fake completion server picks from when making up a response
+FAKE_TERMS = ["xanax", "xannies", "bars", "zanbars", "school bus", "footballs", "benzo", "blues", "ladders", "planks"]
+
+# words the fake search server builds result titles and snippets from. about
+# one in FAKE_HIT_RATE results mentions one of FAKE_SEEDS
+FAKE_WORDS = ["what", "is", "street", "name", "for", "reddit", "pills", "the", "slang", "dictionary", "drug", "guide", "side", "effects"]
+FAKE_SEEDS = ["alprazolam", "fentanyl", "heroin", "oxycodone", "diazepam"]
+FAKE_HIT_RATE = 8
+
+
+# makes up the text of a completion that continues a numbered list prompt
+# (the format that completions.parse_response expects)
+#
+# params:
+# rng (random.Random) - random number generator to pick terms with
+# n_terms (int) - number of list items in the completion
+# pool (list) - terms to pick from
+def fake_completion_text(rng, n_terms=5, pool=FAKE_TERMS):
+    terms = rng.sample(pool, min(n_terms, len(pool)))
+    text = " " + terms[0]
+    for i, t in enumerate(terms[1:]):
+        text += "\n%d. %s" % (i + 5, t)
+    return text
+
+
+# returns the terms generated for each index term in the pipeline output
+# csvs of a directory, as a dict from index term to list of terms (with spaces
+# rather than "_")
+#
+# params:
+# d (str) - directory of pipeline output csvs (e.g. data/big_run)
+def load_replay_terms(d):
+    terms = dict()
+    seen = set()
+    for f in sorted(os.listdir(d)):
+        if f[-4:] != ".csv":
+            continue
+        df = pd.read_csv(os.path.join(d, f), index_col=0)
+        for seed, term in zip(df["seed for prompt"], df["GPT-3 term"]):
+            if not isinstance(term, str) or (seed, term) in seen:
+                continue
+            seen.add((seed, term))
+            terms.setdefault(seed, []).append(term.replace("_", " "))
+    return terms
+
+
+# returns the index term a pipeline prompt was built for (see
+# gpt_queries.get_prompt), or None if it isn't a pipeline prompt
+#
+# params:
+# prompt (str) - prompt text
+def prompt_seed(prompt):
+    m = re.match(r"(?:ways to say|these are not synonyms for) (.+?):", prompt)
+    if m is None:
+        return None
+    return m.group(1)
+
+
+# rebuilds the JSON of a page of search results from a page recorded in the
+# memo. titles and snippets are the recorded tokens joined with spaces, which
+# google_search.tokenize splits back into the same tokens
+#
+# params:
+# page (tuple) - parsed page (from google_search.parse_page)
+# q (str) - search query
+# start (int) - index of the first result on the page
+def recorded_search_page(page, q, start):
+    total, items = page
+    j = {"kind": "customsearch#search", "queries": {"request": [{"searchTerms": q, "startIndex": start}]}, "searchInformation": {"totalResults": str(total)}}
+    if items is not None:
+        j["items"] = []
+        for i, (title, snippet) in enumerate(items):
+            item = {"kind": "customsearch#result", "link": "https://example.com/%d" % (start + i)}
+            if title is not None:
+                item["title"] = " ".join(title)
+            if snippet is not None:
+                item["snippet"] = " ".join(snippet)
+            j["items"].append(item)
+    return j
+
+
+# base request handler for the fake servers
+class FakeHandler(BaseHTTPRequestHandler):
+    # params:
+    # status (int) - HTTP status code
+    # obj (dict) - JSON body
+    # headers (dict) - extra response headers
+    def send_json(self, status, obj, headers={}):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # waits for the server's latency (plus a random part of its jitter)
+    def wait(self):
+        server = self.server
+        with server.lock:
+            delay = server.latency + server.jitter * server.rng.random()
+        time.sleep(delay)
+
+    # answers the request with an error instead of a response if the server
+    # is down, over its rate limit or a fault is injected (see make_server).
+    # returns whether it did
+    def inject_fault(self):
+        server = self.server
+        with server.lock:
+            roll = server.rng.random()
+            retry_after = server.retry_after
+            over_limit = False
+            if server.limiter is not None:
+                wait = server.limiter.reserve(1)
+                if wait > 0:
+                    server.limiter.refund(1)
+                    over_limit = True
+                    retry_after = max(1, math.ceil(wait))
+            if server.down:
+                status = server.down_status
+            elif over_limit or roll < server.throttle_rate:
+                status = 429
+            elif roll < server.throttle_rate + server.error_rate:
+                status = 503
+            else:
+                return False
+            server.n_faults += 1
+        if status == 429:
+            self.send_json(429, {"error": {"code": 429, "message": "Rate limit reached for requests", "type": "requests", "errors": [{"reason": "rateLimitExceeded"}]}}, {"Retry-After": str(retry_after)})
+        elif status == 401:
+            self.send_json(401, {"error": {"code": 401, "message": "Incorrect API key provided.", "type": "invalid_request_error", "errors": [{"reason": "keyInvalid"}]}})
+        else:
+            self.send_json(503, {"error": {"code": 503, "message": "The server is overloaded or not ready yet.", "type": "server_error", "errors": [{"reason": "backendError"}]}})
+        return True
+
+    def log_message(self, format, *args):
+        pass
+
+
+# request handler for the fake completion server. responds to any POST ending
+# in /completions (e.g. /v1/engines/text-davinci-002/completions) with one
+# made-up choice per prompt per n, in the layout of the completions API. the
+# terms in each choice are picked from server.terms for the prompt's index
+# term if there are any, otherwise from FAKE_TERMS
+class FakeCompletionHandler(FakeHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/completions"):
+            self.send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        self.wait()
+        if self.inject_fault():
+            return
+
+        prompts = body.get("prompt", "")
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        n = body.get("n", 1)
+        choices = []
+        with server.lock:
+            server.n_requests += 1
+            for p in prompts:
+                pool = server.terms.get(prompt_seed(p)) or FAKE_TERMS
+                for _ in range(n):
+                    choices.append({"text": fake_completion_text(server.rng, 5, pool), "index": len(choices), "logprobs": None, "finish_reason": "stop"})
+        prompt_tokens = sum(len(p) // 4 for p in prompts)
+        completion_tokens = sum(len(c["text"]) // 4 for c in choices)
+        self.send_json(200, {"id": "cmpl-fake", "object": "text_completion", "created": int(time.time()), "model": body.get("model", "fake"), "choices": choices, "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}})
+
+
+# makes up one page of search results for a query. results only depend on the
+# query and the start index, so repeated searches give the same page
+#
+# params:
+# q (str) - search query
+# start (int) - index of the first result on the page
+def fake_search_page(q, start):
+    rng = random.Random(zlib.crc32(("%s|%d" % (q, start)).encode()))
+    items = []
+    for i in range(10):
+        title = rng.sample(FAKE_WORDS, 4)
+        snippet = rng.sample(FAKE_WORDS, 8)
+        if rng.randrange(FAKE_HIT_RATE) == 0:
+            words = rng.choice([title, snippet])
+            words.insert(rng.randrange(len(words) + 1), rng.choice(FAKE_SEEDS))
+        items.append({"kind": "customsearch#result", "title": " ".join(title), "snippet": " ".join(snippet), "link": "https://example.com/%d" % (start + i)})
+    return {"kind": "customsearch#search", "queries": {"request": [{"searchTerms": q, "startIndex": start}]}, "searchInformation": {"totalResults": "1000"}, "items": items}
+
+
+# request handler for the fake search server. responds to GETs of
+# /customsearch/v1?q=...&start=... in the layout of the Custom Search v1 API,
+# with the page recorded in server.memo if there is one, otherwise with a
+# made-up page
+class FakeSearchHandler(FakeHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if not url.path.rstrip("/").endswith("/customsearch/v1"):
+            self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+            return
+        params = parse_qs(url.query)
+        q = params.get("q", [""])[0]
+        start = int(params.get("start", ["1"])[0])
+        self.wait()
+        if self.inject_fault():
+            return
+        page = None
+        if server.memo is not None:
+            # the memo is only read from one thread, so that a SQLite memo
+            # doesn't open a connection for every request
+            page = server.replay.submit(server.memo.get_page, q, start).result()
+        with server.lock:
+            server.n_requests += 1
+            server.query_counts[(q, start)] += 1
+            if page is not None:
+                server.n_replayed += 1
+        if page is not None:
+            self.send_json(200, recorded_search_page(page, q, start))
+        else:
+            self.send_json(200, fake_search_page(q, start))
+
+
+# creates (but does not start) a fake server
+#
+# params:
+# handler (class) - request handler of the API to stand in for
+# port (int) - port to listen on (0 picks a free port)
+# latency (float) - seconds to wait before answering each request
+# seed (int) - random seed for made-up responses
+# error_rate (float) - fraction of requests answered with a 503 error
+# throttle_rate (float) - fraction of requests answered with a 429 error
+# retry_after (int) - Retry-After header (in seconds) of 429 errors
+# rate_limit (float) - requests per second allowed (0 for no limit). requests
+#                      over the limit are answered with a 429 error
+# jitter (float) - maximum extra seconds (picked at random) to wait on top of
+#                  latency
+#
+# setting server.down = True answers every request with a 503 error (an
+# outage) until it is set back to False. server.down_status can be set to 401
+# to answer with a bad API key error (which isn't worth retrying) instead.
+# server.n_faults counts the errors sent, server.n_requests the requests
+# answered normally
+def make_server(handler, port=0, latency=0.0, seed=0, error_rate=0.0, throttle_rate=0.0, retry_after=1, rate_limit=0.0, jitter=0.0):
+    server = ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.limiter = TokenBucket(rate_limit) if rate_limit > 0 else None
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.retry_after = retry_after
+    server.down = False
+    server.down_status = 503
+    server.n_requests = 0
+    server.n_faults = 0
+    server.query_counts = Counter()
+    server.terms = dict()
+    server.memo = None
+    server.n_replayed = 0
+    return server
+
+
+# params:
+# port, latency, seed, error_rate, throttle_rate, retry_after, rate_limit,
+# jitter - same as for make_server
+# terms (dict) - terms to answer with for each index term (from
+#                load_replay_terms)
+def make_completion_server(port=0, latency=0.0, seed=0, error_rate=0.0, throttle_rate=0.0, retry_after=1, rate_limit=0.0, jitter=0.0, terms=None):
+    server = make_server(FakeCompletionHandler, port, latency, seed, error_rate, throttle_rate, retry_after, rate_limit, jitter)
+    if terms is not None:
+        server.terms = terms
+    return server
+
+
+# params:
+# port, latency, seed, error_rate, throttle_rate, retry_after, rate_limit,
+# jitter - same as for make_server
+# memo (PickleMemo or SqliteMemo) - memo to replay recorded pages from
+#                                   (closed by stop)
+def make_search_server(port=0, latency=0.0, seed=0, error_rate=0.0, throttle_rate=0.0, retry_after=1, rate_limit=0.0, jitter=0.0, memo=None):
+    server = make_server(FakeSearchHandler, port, latency, seed, error_rate, throttle_rate, retry_after, rate_limit, jitter)
+    if memo is not None:
+        server.memo = memo
+        server.replay = ThreadPoolExecutor(max_workers=1)
+    return server
+
+
+# starts a server on a background thread and returns its base URL
+#
+# params:
+# server (HTTPServer) - server to start
+def start_in_background(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return base_url(server)
+
+
+# stops a server started with start_in_background and closes its memo
+#
+# params:
+# server (HTTPServer) - server to stop
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    if server.memo is not None:
+        server.replay.submit(server.memo.close).result()
+        server.replay.shutdown()
+
+
+# URL to point the pipeline at for a server (--api_base for the completion
+# server, --search_url for the search server)
+#
+# params:
+# server (HTTPServer) - fake server
+def base_url(server):
+    if server.RequestHandlerClass is FakeSearchHandler:
+        return "http://localhost:%d/customsearch/v1" % server.server_address[1]
+    return "http://localhost:%d/v1" % server.server_address[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('api', type=str, help="which API to stand in for (completion or search)")
+    parser.add_argument('--port', type=int, help="port to listen on", default=8001)
+    parser.add_argument('--latency', type=float, help="seconds to wait before answering each request", default=0.2)
+    parser.add_argument('--error_rate', type=float, help="fraction of requests to answer with a 503 error", default=0.0)
+    parser.add_argument('--throttle_rate', type=float, help="fraction of requests to answer with a 429 error", default=0.0)
+    parser.add_argument('--retry_after', type=int, help="Retry-After header (in seconds) of 429 errors", default=1)
+    parser.add_argument('--rate_limit', type=float, help="requests per second to allow before answering with 429 errors (0 for no limit)", default=0.0)
+    parser.add_argument('--jitter', type=float, help="maximum extra seconds (picked at random) to wait on top of --latency", default=0.0)
+    parser.add_argument('--terms_dir', type=str, help="completion server: directory of pipeline output csvs to take the terms of each index term from (e.g. data/big_run)", default=None)
+    parser.add_argument('--replay_memo', type=str, help="search server: memo to replay recorded result pages from (pages that aren't in it are made up)", default=None)
+    args = parser.parse_args()
+
+    if args.api == "completion":
+        terms = load_replay_terms(args.terms_dir) if args.terms_dir else None
+        server = make_completion_server(args.port, args.latency, 0, args.error_rate, args.throttle_rate, args.retry_after, args.rate_limit, args.jitter, terms)
+    elif args.api == "search":
+        memo = None
+        if args.replay_memo:
+            memo = open_memo(args.replay_memo)
+        server = make_search_server(args.port, args.latency, 0, args.error_rate, args.throttle_rate, args.retry_after, args.rate_limit, args.jitter, memo)
+    else:
+        raise ValueError("unknown API: %s" % args.api)
+    print("serving fake %s API at %s" % (args.api, base_url(server)))
+    server.serve_forever()
@@ -0,0 +1,170 @@
+# evaluates the ways of classifying GPT-3 generated terms as synonyms (Google
+# filter, drug name filter, generation frequency, RedMed) against manual
+# labels. every predictor is a boolean mask over the unique terms, built once,
+# so the confusion matrices of a whole grid of Google depth and frequency
+# cutoffs are counted at once (the depth x frequency combinations with a
+# single matrix product). manual_label_plots.py plots the confusion matrices
+# of figure 7 from these results
+#
+# e.g. to evaluate alprazolam at depths 1 to 30 and frequency cutoffs 0 to 5:
+# python filter_eval.py -f data/manual_label/alprazolam.csv --seed alprazolam --depths $(seq 1 30) --freqs 0 1 2 3 4 5 -o alprazolam_eval.csv
+
+import argparse
+import numpy as np
+import pandas as pd
+from redmed_lexicon import load_lexicon
+from run_store import read_csv_typed
+
+
+# columns of the evaluation results, in order
+COLUMNS = ["strategy", "depth", "freq_cutoff", "tn", "fp", "fn", "tp", "precision", "recall"]
+
+
+# returns one row per unique term of a manually labeled pipeline output (its
+# first row), with the predictor inputs: "freq" (number of times the term was
+# generated), "real" (manual label), "filtered name" (fails the drug name
+# filter) and "redmed" (in RedMed under the index term)
+#
+# params:
+# df (DataFrame) - output of pipeline run with manual labels
+# drug_names (set) - drug names of the RedMed lexicon
+# broad (bool) - flag for counting broad terms ("?") as real synonyms
+def term_table(df, drug_names, broad=True):
+    terms = df["GPT-3 term"]
+    freq = terms.map(terms.value_counts(dropna=False))
+    first = ~terms.duplicated()
+    table = df.loc[first].copy()
+    table["freq"] = freq[first].to_numpy()
+
+    real_labels = ["True", "?"] if broad else ["True"]
+    table["real"] = table["manual label"].isin(real_labels)
+    if not "filtered name" in table.columns:
+        table["filtered name"] = table["GPT-3 term"].isin(drug_names) & (table["GPT-3 term"] != table["seed for prompt"].astype(object))
+    table["redmed"] = table["Seed of GPT-3 term in RedMed"].astype(object) == table["seed for prompt"].astype(object)
+    return table
+
+
+# returns the confusion matrix counts of several predictions at once from the
+# number of predicted positives and true positives of each. arrays of any
+# (matching) shape
+#
+# params:
+# pos (array) - number of terms predicted True
+# tp (array) - number of terms predicted True that are real synonyms
+# n (int) - number of terms
+# n_real (int) - number of real synonyms
+def counts(pos, tp, n, n_real):
+    fp = pos - tp
+    fn = n_real - tp
+    tn = n - tp - fp - fn
+    return tn, fp, fn, tp
+
+
+# evaluates every strategy for classifying the unique terms of a manually
+# labeled pipeline output as synonyms. returns a DataFrame (see COLUMNS) with
+# one row per strategy and cutoff:
+# - google: found by Google at a depth <= depth and passes the name filter
+# - name: passes the drug name filter
+# - freq: generated more than freq_cutoff times and passes the name filter
+# - google_freq: google and freq combined, for every depth and freq_cutoff
+# - filter_prediction, filter_prediction_freq: the "filter prediction" column
+#   of the file (if it has one), alone and with freq
+# - all: every generated term
+# - redmed: in RedMed under the index term
+#
+# params:
+# df (DataFrame) - output of pipeline run with manual labels
+# depths (list) - Google depth cutoffs
+# freq_cutoffs (list) - frequency cutoffs
+# broad (bool) - flag for counting broad terms ("?") as real synonyms
+def evaluate(df, depths, freq_cutoffs, broad=True):
+    table = term_table(df, load_lexicon().drug_names, broad=broad)
+    depths = np.asarray(depths, dtype=np.int64)
+    freq_cutoffs = np.asarray(freq_cutoffs, dtype=np.int64)
+
+    real = table["real"].to_numpy(dtype=bool)
+    name = ~table["filtered name"].to_numpy(dtype=bool)
+    # terms that weren't found (or runs without depths) have a depth of -1
+    depth = table["Google depth"].fillna(-1).to_numpy(dtype=np.int64)
+    freq = table["freq"].to_numpy(dtype=np.int64)
+    n = len(table)
+    n_real = int(real.sum())
+
+    # one row of each mask per cutoff
+    google = (depth > 0) & (depth <= depths[:, None]) & name
+    frequent = freq > freq_cutoffs[:, None]
+
+    rows = []
+
+    # adds the rows of one strategy from its predicted positives and true
+    # positives, one per cutoff (or combination of cutoffs)
+    def add(strategy, pos, tp, depth=pd.NA, freq_cutoff=pd.NA):
+        tn, fp, fn, tp = counts(np.asarray(pos), np.asarray(tp), n, n_real)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = tp / (tp + fp)
+            recall = tp / (tp + fn)
+        for values in np.broadcast(depth, freq_cutoff, tn, fp, fn, tp, precision, recall):
+            rows.append((strategy,) + tuple(values))
+
+    add("google", google.sum(axis=1), (google & real).sum(axis=1), depth=depths)
+    add("name", name.sum(), (name & real).sum())
+    add("freq", (frequent & name).sum(axis=1), (frequent & name & real).sum(axis=1), freq_cutoff=freq_cutoffs)
+    # depth x frequency cutoff counts as products of the masks
+    frequent_t = frequent.T.astype(np.int64)
+    add("google_freq", google.astype(np.int64) @ frequent_t, (google & real).astype(np.int64) @ frequent_t, depth=depths[:, None], freq_cutoff=freq_cutoffs[None, :])
+    if "filter prediction" in table.columns:
+        pred = table["filter prediction"].fillna(False).to_numpy(dtype=bool)
+        add("filter_prediction", pred.sum(), (pred & real).sum())
+        add("filter_prediction_freq", (frequent & pred).sum(axis=1), (frequent & pred & real).sum(axis=1), freq_cutoff=freq_cutoffs)
+    add("all", n, n_real)
+    redmed = table["redmed"].to_numpy(dtype=bool)
+    add("redmed", redmed.sum(), (redmed & real).sum())
+
+    results = pd.DataFrame(rows, columns=COLUMNS)
+    for col in ["depth", "freq_cutoff", "tn", "fp", "fn", "tp"]:
+        results[col] = results[col].astype("Int64")
+    return results
+
+
+# returns the confusion matrix of one strategy (and cutoffs) of the evaluation
+# results, as [[tn, fp], [fn, tp]]
+#
+# params:
+# results (DataFrame) - output of evaluate
+# strategy (str) - name of strategy
+# depth (int) - Google depth cutoff, for strategies that use one
+# freq_cutoff (int) - frequency cutoff, for strategies that use one
+def confusion_matrix(results, strategy, depth=None, freq_cutoff=None):
+    row = results["strategy"] == strategy
+    if depth is not None:
+        row &= results["depth"] == depth
+    if freq_cutoff is not None:
+        row &= results["freq_cutoff"] == freq_cutoff
+    row = results.loc[row.to_numpy(dtype=bool)]
+    if len(row) != 1:
+        raise ValueError("no single result for strategy %s (depth %s, frequency cutoff %s)" % (strategy, depth, freq_cutoff))
+    row = row.iloc[0]
+    return np.array([[row["tn"], row["fp"]], [row["fn"], row["tp"]]], dtype=np.int64)
+
+
+def main(args):
+    df = read_csv_typed(args.f)
+    df = df.loc[df["seed for prompt"] == args.seed]
+    results = evaluate(df, args.depths, args.freqs, broad=not args.specific)
+    if args.o:
+        results.to_csv(args.o, index=False)
+    else:
+        print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', type=str, help="input filename (pipeline output with manual labels)")
+    parser.add_argument('--seed', type=str, help="index term (seed term)")
+    parser.add_argument('--depths', type=int, nargs="+", help="Google depth cutoffs to evaluate", default=[10])
+    parser.add_argument('--freqs', type=int, nargs="+", help="frequency cutoffs to evaluate (terms generated more often than the cutoff are predicted True)", default=[1])
+    parser.add_argument('--specific', action="store_true", help="flag for only counting terms labeled True as synonyms (broad terms, labeled \"?\", count by default)")
+    parser.add_argument('-o', type=str, help="name of csv file to write the results to (printed if not given)")
+    args = parser.parse_args()
+
+    main(args)
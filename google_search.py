@@ -0,0 +1,326 @@
+# Google search filter: checks whether an index term shows up in the Google
+# search results for a GPT-3 generated term. used by gpt_queries.py and
+# rerun_google.py. result pages are parsed and tokenized once when they are
+# fetched and kept in the memo in that form (see parse_page). searches go
+# through one pooled HTTP session, are spaced out by a QPS limiter instead of a
+# fixed sleep, and many terms can be validated concurrently; identical page
+# requests that are in flight at the same time are only sent once. failed
+# searches are retried according to a RetryPolicy (see retry.py), and can be
+# counted against a daily quota shared between processes (see quota.py)
+
+import os
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from quota import QuotaExhausted
+from rate_limit import TokenBucket
+from retry import RetryPolicy
+from term_matcher import seeds_matcher
+
+
+SEARCH_URL = "https://customsearch.googleapis.com/customsearch/v1"
+
+# tokens added to a term (in this order) until the Google search filter passes
+SUFFIXES = ["", " pill", " drug", " slang"]
+
+
+# splits a search result title or snippet into the tokens the filter matches
+# index terms against (lowercased, split on spaces and "_")
+#
+# params:
+# text (str) - title or snippet
+def tokenize(text):
+    return tuple(text.replace(" ","_").lower().split("_"))
+
+
+# parses the raw JSON text of one page of search results into the form kept in
+# the memo: a (total number of results, items) tuple. items is None if the page
+# has no results list, otherwise it holds a (title tokens, snippet tokens)
+# tuple per result, with None for a missing title or snippet
+#
+# params:
+# text (str) - raw JSON text of the page
+def parse_page(text):
+    j = json.loads(text)
+    total = int(j["searchInformation"]["totalResults"])
+    if not "items" in j:
+        return (total, None)
+    items = []
+    for elem in j["items"]:
+        title = tokenize(elem["title"]) if isinstance(elem.get("title"), str) else None
+        snippet = tokenize(elem["snippet"]) if isinstance(elem.get("snippet"), str) else None
+        items.append((title, snippet))
+    return (total, tuple(items))
+
+
+# validates GPT-3 generated terms with the Google Custom Search API, memoizing
+# both the raw search result pages and the per-seed results
+#
+# params:
+# memo (PickleMemo or SqliteMemo) - memo of previous google searches to reduce
+#                                   number of API queries (see memo_store.py)
+# depth (int) - maximum depth to check Google search results with
+# offline (bool) - flag indicating whether or not to only use results from the
+#                  memo (versus making a new Google search)
+# qps (float) - maximum number of search API queries per second (defaults to
+#               one query every 1.5 s, as the original sequential pipeline)
+# workers (int) - maximum number of searches in flight at once
+# url (str) - search API endpoint (e.g. a local test server)
+# policy (RetryPolicy) - retry policy for search API queries
+# quota (QuotaManager) - daily quota to spend each search API query from (None
+#                        for no quota)
+# priority (int) - priority to spend the quota with (0 for high priority)
+class SearchEngine:
+    def __init__(self, memo, depth=10, offline=False, qps=1 / 1.5, workers=8, url=SEARCH_URL, policy=None, quota=None, priority=0):
+        if policy is None:
+            policy = RetryPolicy()
+        self.memo = memo
+        self.policy = policy
+        self.quota = quota
+        self.priority = priority
+        self.out_of_quota = False
+        self.depth = depth
+        self.offline = offline
+        self.workers = workers
+        self.url = url
+        self.limiter = TokenBucket(qps)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.in_flight = dict()
+        self.executor = None # started by the first validate_many call
+        self.n_api_queries = 0
+        self.n_memo_hits = 0 # pages found in the memo
+        self.n_memo_misses = 0
+
+    # returns one page of search results for term, parsed with parse_page
+    # (from the memo if possible), or None if it could not be obtained (the
+    # retry policy gave up, the page couldn't be parsed or the quota is used
+    # up). also returns whether the search API was queried to get it
+    #
+    # params:
+    # term (str) - search query
+    # start (int) - index of the first result on the page (1, 11, 21, ...)
+    def fetch_page(self, term, start):
+        page = self.memo.get_page(term, start)
+        with self.lock:
+            if page is not None:
+                self.n_memo_hits += 1
+            else:
+                self.n_memo_misses += 1
+        if page is not None:
+            return page, False
+        if self.offline:
+            return None, False
+        with self.lock:
+            pending = self.in_flight.get((term, start))
+            if pending is None:
+                pending = Future()
+                self.in_flight[(term, start)] = pending
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result(), False
+
+        # another thread may have stored the page between the memo check and
+        # registering this request
+        page = self.memo.get_page(term, start)
+        if page is not None:
+            pending.set_result(page)
+            with self.lock:
+                self.in_flight.pop((term, start))
+            return page, False
+
+        def get():
+            if self.quota is not None:
+                self.quota.spend(1, self.priority)
+            self.limiter.acquire()
+            with self.lock:
+                self.n_api_queries += 1
+            response = self.session.get(self.url, params={"key": os.environ.get("GOOGLE_API_KEY"), "cx": os.environ.get("SEARCH_ENG_ID"), "q": term, "start": start})
+            response.raise_for_status()
+            return response.text
+
+        # a page that can't be parsed is given up on rather than retried, as
+        # asking again would most likely get (and spend quota on) the same page
+        try:
+            page = parse_page(self.policy.call(get))
+            self.memo.put_page(term, start, page)
+        except QuotaExhausted as e:
+            with self.lock:
+                if not self.out_of_quota:
+                    print(e)
+                self.out_of_quota = True
+            page = None
+        except Exception as e:
+            print(repr(e))
+            page = None
+        pending.set_result(page)
+        with self.lock:
+            self.in_flight.pop((term, start))
+        return page, True
+
+    # uses the google search api to search for a term, checking the results
+    # against several index terms in a single pass over each page.
+    # returns a dict with the result for each seed: true if the seed appears in
+    # the top `depth` search results, along with the depth at which it first
+    # appears (-1 if it doesn't), or "Error" if the search results could not be
+    # obtained. also returns whether the search API was queried. every seed's
+    # memo entry is filled in at once
+    #
+    # params:
+    # term (str) - the gpt-3 generated term to conduct the Google search for
+    # seeds (list) - the index terms to check the search results against
+    def search_seeds(self, term, seeds):
+        googled = False
+        term = term.replace("_"," ")
+        results = dict()
+        pending = []
+        for seed in seeds:
+            result = self.memo.get_result(term, seed)
+            if result is None or result["depth"] == -1:
+                if not seed in pending:
+                    pending.append(seed)
+            else:
+                results[seed] = (result["result"], result["depth"])
+        if len(pending) == 0:
+            return results, googled
+
+        matcher = seeds_matcher(tuple(sorted(pending)))
+        found = dict()
+        error = False
+        for start in range(1, self.depth, 10):
+            if len(found) == len(pending):
+                break
+            page, fetched = self.fetch_page(term, start)
+            googled = googled or fetched
+            if page is None:
+                error = True
+                break
+            total, items = page
+            if total < start:
+                break
+            if items is None:
+                print("page %d of results for %s has no items" % (start, term))
+                error = True
+                break
+            for idx, (title, snippet) in enumerate(items):
+                if title is None:
+                    print("result %d for %s has no title" % (idx + start, term))
+                    error = True
+                    break
+                hits = matcher.labels_in_tokens(title)
+                if snippet is not None:
+                    hits |= matcher.labels_in_tokens(snippet)
+                for seed in hits:
+                    if not seed in found:
+                        found[seed] = idx + start
+                if len(found) == len(pending):
+                    break
+            if error:
+                break
+
+        # seeds found before an error keep their result. the others are
+        # errors, and a malformed page also clears their memo entries
+        new_results = dict()
+        for seed in pending:
+            if seed in found:
+                new_results[seed] = (True, found[seed])
+            elif error:
+                results[seed] = ("Error", -1)
+                if page is not None:
+                    self.memo.drop_result(term, seed)
+            else:
+                new_results[seed] = (False, -1)
+        self.memo.put_results(term, new_results)
+        results.update(new_results)
+        return results, googled
+
+    # uses the google search api to search for a term
+    # will return true if a seed term appears in the top `depth` search results,
+    # along with the depth at which it first appears (-1 if it doesn't), and
+    # whether the search API was queried. returns "Error" if the search results
+    # could not be obtained
+    #
+    # params:
+    # term (str) - the gpt-3 generated term to conduct the Google search for
+    # seed (str) - the index term that the prompt was build for
+    def search(self, term, seed):
+        results, googled = self.search_seeds(term, [seed])
+        result, depth = results[seed]
+        return result, depth, googled
+
+    # runs the Google search filter for a term and several seeds, adding each
+    # of SUFFIXES to the term in turn until the filter passes for each seed.
+    # returns a dict with the result of validate for each seed (the number of
+    # searches that queried the search API is shared by all the seeds)
+    #
+    # params:
+    # term (str) - the gpt-3 generated term
+    # seeds (list) - the index terms to validate the term for
+    def validate_seeds(self, term, seeds):
+        n_googled = 0
+        validated = dict()
+        pending = list(seeds)
+        for google_add in SUFFIXES:
+            if len(pending) == 0:
+                break
+            results, googled = self.search_seeds(term + google_add, pending)
+            if googled:
+                n_googled += 1
+            still_pending = []
+            for seed in pending:
+                google, depth = results[seed]
+                if google == True:
+                    validated[seed] = (google, google_add, depth)
+                else:
+                    validated[seed] = (google, None, depth)
+                    still_pending.append(seed)
+            pending = still_pending
+        return {seed: (google, google_add, depth, n_googled) for seed, (google, google_add, depth) in validated.items()}
+
+    # runs the Google search filter for a term, adding each of SUFFIXES to the
+    # term in turn until the filter passes. returns the filter result, the
+    # suffix that passed (None if none did), the depth, and the number of
+    # searches that queried the search API
+    #
+    # params:
+    # term (str) - the gpt-3 generated term
+    # seed (str) - the index term that the prompt was build for
+    def validate(self, term, seed):
+        return self.validate_seeds(term, [seed])[seed]
+
+    # validates many (term, seed) pairs concurrently. the seeds of each term
+    # are validated together, so each page is only walked once. returns the
+    # results of validate in the same order as jobs
+    #
+    # params:
+    # jobs (list) - list of (term, seed) tuples
+    def validate_many(self, jobs):
+        seeds_by_term = dict()
+        for term, seed in jobs:
+            seeds = seeds_by_term.setdefault(term, [])
+            if not seed in seeds:
+                seeds.append(seed)
+        terms = list(seeds_by_term.keys())
+        if self.workers <= 1:
+            validated = [self.validate_seeds(term, seeds_by_term[term]) for term in terms]
+        else:
+            # one pool for all calls, so that callers validating in chunks
+            # don't open a new memo connection per chunk in each new thread
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            validated = list(self.executor.map(lambda term: self.validate_seeds(term, seeds_by_term[term]), terms))
+        by_term = dict(zip(terms, validated))
+        return [by_term[term][seed] for term, seed in jobs]
+
+    # stops the search workers. call before closing the memo
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -5,36 +5,22 @@
 import os
 import random
 import openai
-import numpy as np
-import pandas as pd
 import argparse
-import json
-import requests
-import pickle
-import time
+import asyncio
 from dotenv import load_dotenv
+from completion_cache import CompletionCache
+from completions import cached_response, query, run_batched_queries, run_queries
+from google_search import SEARCH_URL, SearchEngine
+from memo_store import open_memo
+from output_writer import OutputWriter
+from quota import QuotaManager
+from rate_limit import CompletionLimiter
+from redmed_lexicon import load_lexicon
+from retry import RetryPolicy
+from term_matcher import TermMatcher
 
 
 
-# obtains all the candidate redmed synonyms to sample from for prompt
-#
-# params:
-# seed (str) - index term being used to generate queries
-# redmed (DataFrame) - RedMed lexicon in a pandas DataFrame
-def get_candidate_examples(seed, redmed):
-    subdf = redmed.loc[redmed["drug"] == seed]
-    terms = set()
-    for col in subdf.columns[2:7]: # only include misspellings and pillmarks, and single words in known
-        l = subdf[col].tolist()[0].split(",")
-        if len(l) <= 1:
-            if l == "" or l == ["-"]:
-                continue
-        for t in l:
-            if col in subdf.columns[3:7] or len(t.split("_")) == 1:
-                terms.add(t)
-    return terms
-
-
 # uses a prompt template (either with or without counterexamples) and
 # randomly sampled redmed synonyms to create a prompt with which to query GPT-3
 #
@@ -43,11 +29,13 @@ def get_candidate_examples(seed, redmed):
 # terms (set) - set of candidate redmed synonyms to create prompt with
 # include_counterexamples (bool) - flag to use prompt template with counterexamples
 # verbose (bool) - flag to print the randomly selected examples 
-def get_prompt(seed, terms, include_counterexamples=False, verbose=True): 
+# rng (Random) - random number generator to sample the examples with (seed it
+#                to get the same prompts on every run)
+def get_prompt(seed, terms, include_counterexamples=False, verbose=True, rng=random): 
     if include_counterexamples:
-        examples = random.sample(list(terms),2)
+        examples = rng.sample(sorted(terms),2)
     else:
-        examples = random.sample(list(terms),3)
+        examples = rng.sample(sorted(terms),3)
     examples = [e.replace("_"," ") for e in examples]
     if verbose:
         print(examples)
@@ -65,48 +53,32 @@ def get_prompt(seed, terms, include_counterexamples=False, verbose=True):
     return prompt
 
 
-# submit query to GPT-3, collect response, clean and parse
+# queries GPT-3 queries_per_prompt times with each prompt, one request at a
+# time, retrying each query according to the retry policy. returns None for
+# queries that were given up on (see completions.py)
 #
 # params:
-# eng (str) - GPT-3 engine to use
-# prompt (str) - prompt to give to GPT-3
-# temp (float) - temperature at which to run GPT-3 (lower temperature = more
-#                likely responses, higher temperature = more diverse responses)
-# maxt (int) - maximum number of tokens for GPT-3 query and response
-# freq (float) - frequency penalty (positive values penalize new tokens based
-#                on their existing frequency in the text so far, decreasing
-#                the model's likelihood to repeat the same line verbatim)
-# pres (float) - presence penalty (positive values penalize new tokens based
-#                on whether they appear in the text so far, increasing the
-#                model's likelihood to talk about new topics)
-def query(eng, prompt, temp, maxt, freq, pres):
-    response = openai.Completion.create(engine=eng,
-                                        prompt=prompt,
-                                        temperature=temp,
-                                        max_tokens=maxt,
-                                        frequency_penalty=freq,
-                                        presence_penalty=pres)
-    time.sleep(1.5) # must space out queries for rate limiting
-
-    rtext = response["choices"][0]["text"].replace("\"","").lower()
-    rtext = rtext.split("\n")
-    clean_rtext = []
-    clean_rtext.append(rtext[0][1:].replace(" ","_"))
-    if len(rtext) > 1:
-        for i in range(1, len(rtext)):
-            if rtext[i][0].isnumeric() and rtext[i][1] == ".":
-                clean_rtext.append(rtext[i][2:].strip().replace(" ","_"))
-            elif rtext[i][:2].isnumeric() and rtext[i][2] == ".":
-                clean_rtext.append(rtext[i][3:].strip().replace(" ","_"))
-            else:
-                print("warning: response not formatted as list!")
-                print(rtext[i])
-
-    return clean_rtext
+# prompts (list) - prompts to query with
+# queries_per_prompt (int) - number of times to query with each prompt
+# args (argparse.Namespace) - command line args
+# cache (CompletionCache) - completion cache (None to not use one)
+# samples (list) - sample index of each query, in the same order as the
+#                  responses (defaults to the query index)
+# policy (RetryPolicy) - retry policy for the queries
+def sequential_queries(prompts, queries_per_prompt, args, cache=None, samples=None, policy=None):
+    if policy is None:
+        policy = RetryPolicy()
+    responses = []
+    for prompt in prompts:
+        for j in range(queries_per_prompt):
+            sample = j if samples is None else samples[len(responses)]
+            responses.append(query(args.engine, prompt, args.temp, args.tokens, args.freq, args.pres, cache, sample, policy))
+    return responses
 
 
 # checks to see if any of the terms in terms (a list) are present in
-# the generated response r (a string)
+# the generated response r (a string). when checking the same terms against
+# many responses, compile them once with term_matcher.TermMatcher instead
 #
 # params:
 # r (str) - the response from GPT-3
@@ -132,171 +104,142 @@ def redmed_term_in_response(r, terms):
     return False
 
 
-# uses the google search api to search for a term
-# will return true if a seed term appears in the top 10 search results
-#
-# params:
-# term (str) - the gpt-3 generated term to conduct the Google search for
-# seed (str) - the index term that the prompt was build for
-# memo (dic) - memo of previous google searches to reduce number of API queries
-# depth (int) - maximum depth to check Google search results with
-# count (bool) - flag indicating whether or not to take measures to keep track
-#                of number of API queries made so far (for daily query restriction purposes)
-# offline (bool) - flag indicating whether or not to only use results from the
-#                  memo (versus making a new Google search)
-def in_google_search(term, seed, memo, depth=10, count=False, offline=False):
-    googled = False
-    term = term.replace("_"," ")
-    if not term in memo.keys():
-        memo[term] = dict()
-    if not seed in memo[term].keys():
-        memo[term][seed] = dict()
-        memo[term][seed]["result"] = False
-        memo[term][seed]["depth"] = -1
-    if memo[term][seed]["depth"] == -1:
-        for start in range(1, depth, 10):
-            if not memo[term][seed]["depth"] == -1:
-                break
-            google_key_name = "google_search_response_%d" % (start)
-            if not google_key_name in memo[term].keys():
-                if offline:
-                    if count:
-                        return "Error", -1, memo, googled
-                    else:
-                        return "Error", -1, memo
-                    
-                response = requests.get("https://customsearch.googleapis.com/customsearch/v1?key=%s&cx=%s&q=%s&start=%d" % (os.environ.get("GOOGLE_API_KEY"), os.environ.get("SEARCH_ENG_ID"), term, start))
-                googled = True
-                time.sleep(1.5)
-                if response.status_code == 200:
-                    memo[term][google_key_name] = response.text
-                else:
-                    print(response.status_code)
-                    if count:
-                        return "Error", -1, memo, googled
-                    else:
-                        return "Error", -1, memo
-            j = json.loads(memo[term][google_key_name])
-            if int(j["searchInformation"]["totalResults"]) < start:
-                break
-            try:
-                for idx, elem in enumerate(j['items']):
-                    if redmed_term_in_response(elem["title"].replace(" ","_"), [seed]) or ("snippet" in elem.keys() and redmed_term_in_response(elem["snippet"].replace(" ","_"), [seed])):
-                        memo[term][seed]["result"] = True
-                        memo[term][seed]["depth"] = idx + start
-                        break
-            except Exception as e:
-                print(repr(e))
-                memo[term].pop(seed)
-                if count:
-                    return "Error", -1, memo, googled
-                else:
-                    return "Error", -1, memo
-    if count:
-        return memo[term][seed]["result"], memo[term][seed]["depth"], memo, googled
-    else:
-        return memo[term][seed]["result"], memo[term][seed]["depth"], memo
-
-
-# searches for a term in the whole redmed lexicon
-# if that term is present in the lexicon, will return the seed term it belongs to
-# if that term is not present in the lexicon, will return False
+# runs the pipeline. returns the completion retry policy, the search engine
+# and the completion cache (None if not used), for their counters
 #
 # params:
-# term (str) - GPT-3 generated term
-# df (DataFrame) - redmed lexicon as dataframe
-def find_seed_for_term(term, df):
-    df["all"] = df.apply(lambda row: row["drug"] + "," + row["known"] + "," + row["misspellingPhon"] + "," + row["edOne"] + "," + row["edTwo"] + "," + row["pillMark"] + "," + row["google_ms"] + "," + row["google_title"] + "," + row["google_snippet"] + "," + row["ud_slang"], axis=1)
-    df["contains_term"] = df.apply(lambda row: term in row["all"].split(","), axis=1)
-    df = df.loc[df["contains_term"]]
-    if len(df) == 0:
-        return [False, ""]
-    else:
-        return [True, df["drug"].tolist()[0]]
-
-
+# args (argparse.Namespace) - command line args
 def main(args):
     openai.api_key = os.environ.get("OPENAI_API_KEY")
-    redmed = pd.read_csv("redmed_lexicon.tsv",sep="\t")
+    if args.api_base:
+        openai.api_base = args.api_base
+    limiter = CompletionLimiter(args.rpm, args.tpm)
+    lexicon = load_lexicon()
     seeds = open(args.seeds,"r").read().strip().split(",")
     print(seeds)
 
-    if args.save:
-        gpt_terms = []
-        gpt_seeds = []
-        redmed_seeds_for_gpt_term = []
-        redmed_term_in_gpt_term = []
-        gpt_google = []
-        gpt_google_add = []
-        gpt_google_depth = []
+    # separate retry policies (and circuit breakers) for the two APIs
+    completion_policy = RetryPolicy(max_attempts=args.max_attempts)
+    search_policy = RetryPolicy(max_attempts=args.max_attempts)
+    memo = open_memo(args.memo, ttl=args.memo_ttl_days * 86400, max_bytes=int(args.memo_max_mb * 1e6))
+    quota = QuotaManager(args.quota_db, args.daily_limit)
+    search_engine = SearchEngine(memo, depth=args.depth, offline=args.offline, qps=args.search_qps, workers=args.search_workers, url=args.search_url, policy=search_policy, quota=quota)
 
+    # the memo, search engine and completion cache are closed even when a
+    # query fails for good, so that what was searched so far is kept
+    cache = None
     try:
-        memo = pickle.load(open(args.memo,"rb"))
-    except:
-        memo = dict()
+        # prompts are sampled with a fixed random seed per index term when
+        # completions are cached, so that a rerun builds the same prompts and
+        # finds their completions in the cache
+        prompt_seed = args.prompt_seed
+        if args.completion_cache:
+            cache = CompletionCache(args.completion_cache, max_bytes=int(args.cache_max_mb * 1e6))
+            if prompt_seed is None:
+                prompt_seed = 0
+        elif args.offline:
+            raise ValueError("--offline needs a --completion_cache to replay completions from")
+
+        # a resumed run rebuilds the prompts of the queries left to do, so they
+        # must be sampled with the seed the run was started with
+        writer = None
+        if args.save:
+            if len(seeds) == 1:
+                outfname = "%s.csv" % seeds[0]
+            else:
+                outfname = "_".join([args.engine, "temp", str(int(args.temp*100)), "freq", str(int(args.freq*100)), "pres", str(int(args.pres*100)), "prompts", str(args.prompts), "queries_per_prompt", str(args.queries_per_prompt), "counter", str(args.counterexamples)])+".csv"
+            if args.resume and prompt_seed is None:
+                raise ValueError("--resume needs --prompt_seed (or a --completion_cache), so that the remaining queries use the prompts the run was started with")
+            writer = OutputWriter(os.path.join(args.outdir, outfname), resume=args.resume, prompt_seed=prompt_seed)
+
+        # queries are made (and their rows written) a chunk at a time
+        if args.batch_prompts > 0:
+            chunk_size = max(args.concurrency, 1) * args.batch_prompts * args.queries_per_prompt
+        elif args.concurrency > 1:
+            chunk_size = args.concurrency * 4
+        else:
+            chunk_size = 1
 
-    for seed in seeds:
-        try:
-            terms = get_candidate_examples(seed, redmed)
-        except IndexError:
-            print("Insufficient RedMed terms to sample examples from. Exiting.")
-            continue
-        for i in range(args.prompts):
+        # queries given up on are skipped. they aren't checkpointed, so a
+        # --resume run tries them again
+        n_skipped = 0
+        for seed in seeds:
+            if not seed in lexicon.candidates:
+                print("Insufficient RedMed terms to sample examples from. Exiting.")
+                continue
+            terms = lexicon.candidates[seed]
+            terms_matcher = TermMatcher(terms)
+            rng = random if prompt_seed is None else random.Random("%d:%s" % (prompt_seed, seed))
             try:
-                prompt = get_prompt(seed, terms, include_counterexamples=args.counterexamples, verbose=not args.save)
+                prompts = [get_prompt(seed, terms, include_counterexamples=args.counterexamples, verbose=not args.save, rng=rng) for i in range(args.prompts)]
             except ValueError:
                 print("Insufficient RedMed terms to sample examples from. Exiting.")
-                break
-            for j in range(args.queries_per_prompt):
-                while True:
-                    try:
-                        response = query(args.engine, prompt, args.temp, args.tokens, args.freq, args.pres)
-                    except:
+                continue
+            slots = [(i, j) for i in range(args.prompts) for j in range(args.queries_per_prompt)]
+
+            # the sample index of a query is the number of earlier queries with
+            # the same prompt text (prompts can repeat when there are few terms)
+            samples = dict()
+            prompt_counts = dict()
+            for i, j in slots:
+                samples[(i, j)] = prompt_counts.get(prompts[i], 0)
+                prompt_counts[prompts[i]] = samples[(i, j)] + 1
+
+            if writer is not None:
+                slots = [(i, j) for i, j in slots if not writer.is_done(seed, i, j)]
+            if args.offline:
+                cached = [(i, j) for i, j in slots if cached_response(cache, args.engine, prompts[i], args.temp, args.tokens, args.freq, args.pres, samples[(i, j)]) is not None]
+                if len(cached) < len(slots):
+                    print("%d of %d queries for %s are not in the completion cache, skipping them" % (len(slots) - len(cached), len(slots), seed))
+                slots = cached
+            for chunk_start in range(0, len(slots), chunk_size):
+                chunk = slots[chunk_start:chunk_start + chunk_size]
+                chunk_prompts = [prompts[i] for i, j in chunk]
+                chunk_samples = [samples[slot] for slot in chunk]
+                if args.batch_prompts > 0:
+                    responses = asyncio.run(run_batched_queries(chunk, prompts, args.batch_prompts, args.engine, args.temp, args.tokens, args.freq, args.pres, limiter, max(args.concurrency, 1), cache, samples, completion_policy))
+                elif args.concurrency > 1:
+                    responses = asyncio.run(run_queries(chunk_prompts, 1, args.engine, args.temp, args.tokens, args.freq, args.pres, limiter, args.concurrency, cache, chunk_samples, completion_policy))
+                else:
+                    responses = sequential_queries(chunk_prompts, 1, args, cache, chunk_samples, completion_policy)
+                validations = iter(search_engine.validate_many([(r, seed) for response in responses if response is not None for r in response]))
+                for (i, j), response in zip(chunk, responses):
+                    if response is None:
+                        n_skipped += 1
                         continue
-                    else:
-                        break
-                for r in response:
-                    seed_for_term = find_seed_for_term(r, redmed)
-                    term_in_response = redmed_term_in_response(r, terms)
-                    for google_add in ["", " pill", " drug", " slang"]:
-                        google, depth, memo = in_google_search(r + google_add, seed, memo, depth=args.depth)
-                        if google == "True":
-                            break
-                    if google != "True":
-                        google_add = None
-                    if args.save:
-                        gpt_terms.append(r)
-                        gpt_seeds.append(seed)
-                        if seed_for_term[0]:
-                            redmed_seeds_for_gpt_term.append(seed_for_term[1])
+                    rows = []
+                    for r in response:
+                        seed_for_term = lexicon.find_seed_for_term(r)
+                        term_in_response = terms_matcher.matches(r)
+                        google, google_add, depth, _ = next(validations)
+                        if args.save:
+                            if seed_for_term[0]:
+                                rows.append([r, seed, seed_for_term[1], term_in_response, google, google_add, depth])
+                            else:
+                                rows.append([r, seed, seed_for_term[0], term_in_response, google, google_add, depth])
                         else:
-                            redmed_seeds_for_gpt_term.append(seed_for_term[0])
-                        redmed_term_in_gpt_term.append(term_in_response)
-                        gpt_google.append(google)
-                        gpt_google_add.append(google_add)
-                        gpt_google_depth.append(depth)
+                            if seed_for_term[0]:
+                                seed_for_term[1] = " (%s)" % seed_for_term[1]
+                            print("%s (In RedMed: %s%s; Includes RedMed Term for %s: %s; Google Search validation: %s (%s))" % (r, seed_for_term[0], seed_for_term[1], seed, term_in_response, google, google_add))
+                    if args.save:
+                        writer.write(seed, i, j, rows)
                     else:
-                        if seed_for_term[0]:
-                            seed_for_term[1] = " (%s)" % seed_for_term[1]
-                        print("%s (In RedMed: %s%s; Includes RedMed Term for %s: %s; Google Search validation: %s (%s))" % (r, seed_for_term[0], seed_for_term[1], seed, term_in_response, google, google_add))
-                if not args.save:
-                    print("")
-
-    pickle.dump(memo, open(args.memo, "wb"))
-
-    if args.save:
-        if len(seeds) == 1:
-            outfname = "%s.csv" % seeds[0]
-        else:
-            outfname = "_".join([args.engine, "temp", str(int(args.temp*100)), "freq", str(int(args.freq*100)), "pres", str(int(args.pres*100)), "prompts", str(args.prompts), "queries_per_prompt", str(args.queries_per_prompt), "counter", str(args.counterexamples)])+".csv"
-
-        outdf = pd.DataFrame(data=np.array([gpt_terms, gpt_seeds, redmed_seeds_for_gpt_term, redmed_term_in_gpt_term, gpt_google, gpt_google_add, gpt_google_depth]).T, columns=['GPT-3 term','seed for prompt', 'Seed of GPT-3 term in RedMed', 'RedMed term inside GPT-3 term', 'Google', 'Google added token', 'Google depth'])
-        outdf.to_csv(os.path.join(args.outdir, outfname))
-
+                        print("")
+    finally:
+        search_engine.close()
+        memo.close()
+        if cache is not None:
+            cache.close()
+    if n_skipped > 0:
+        print("%d queries were given up on and skipped%s" % (n_skipped, " (run again with --resume to retry them)" if args.save else ""))
+    print("completion API: %s" % completion_policy.summary())
+    print("search API: %s" % search_policy.summary())
+    print("%d of %d search API queries used today" % (quota.used(), quota.limit))
+    return completion_policy, search_engine, cache
 
-if __name__ == "__main__":
-    load_dotenv()
 
+# returns the parser for the command line arguments
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--engine', type=str, help="GPT-3 engine to use.", default="text-davinci-002")
     parser.add_argument('--temp', type=float, help="Sampling temperature. Higher values means the model will take more risks.", default=0.5)
@@ -306,11 +249,34 @@ if __name__ == "__main__":
     parser.add_argument('--prompts', type=int, help="Number of prompts to generate per seed.", default=1)
     parser.add_argument('--queries_per_prompt', type=int, help="Number of times to query with each prompt.", default=1)
     parser.add_argument('--counterexamples', action="store_true", help="Flag for including counterexamples in the prompt.")
-    parser.add_argument('--memo', type=str, help="Memo file name to reduce API requests.", default="memo.p")
-    parser.add_argument('--save', action="store_true", help="Flag for saving outputs to csv.")
+    parser.add_argument('--memo', type=str, help="Memo file name to reduce API requests. .p files are read and written as pickles, .shards directories hold a sharded SQLite memo, anything else is a SQLite database.", default="memo.p")
+    parser.add_argument('--memo_ttl_days', type=float, help="Days after which memoized searches expire and are searched for again. 0 to keep them forever (not supported for .p memos).", default=0)
+    parser.add_argument('--memo_max_mb', type=float, help="Size bound of the memoized result pages in MB, least recently used pages are evicted past it. 0 for no bound (not supported for .p memos).", default=0)
+    parser.add_argument('--save', action="store_true", help="Flag for saving outputs to csv. Rows are written as each query completes, along with a checkpoint of the queries that are done (see --resume).")
+    parser.add_argument('--resume', action="store_true", help="Flag for resuming an interrupted --save run with the same arguments: queries already in the output csv are skipped. Needs --prompt_seed (or a --completion_cache). Without it the output csv is started over.")
     parser.add_argument('--seeds', type=str, help="file containing seeds to use for prompts", default="defaultseed.txt")
     parser.add_argument('--outdir', type=str, help="directory in which to save the outputs", default="")
     parser.add_argument('--depth', type=int, help="how deep to go for google search filter", default=10)
-    args = parser.parse_args()
+    parser.add_argument('--concurrency', type=int, help="maximum number of GPT-3 requests in flight at once. 1 queries sequentially", default=1)
+    parser.add_argument('--batch_prompts', type=int, help="number of prompts to pack into each GPT-3 request, with all queries per prompt requested at once. 0 sends one request per query", default=0)
+    parser.add_argument('--rpm', type=float, help="GPT-3 API rate limit in requests per minute (used when concurrency > 1 or batch_prompts > 0)", default=60)
+    parser.add_argument('--tpm', type=float, help="GPT-3 API rate limit in tokens per minute (used when concurrency > 1 or batch_prompts > 0)", default=150000)
+    parser.add_argument('--api_base', type=str, help="base URL of the completion API (e.g. a local test server)", default=None)
+    parser.add_argument('--search_qps', type=float, help="maximum number of Google search API queries per second (default: one query every 1.5 s)", default=1 / 1.5)
+    parser.add_argument('--search_workers', type=int, help="maximum number of Google searches in flight at once", default=8)
+    parser.add_argument('--search_url', type=str, help="Google Custom Search API endpoint (e.g. a local test server)", default=SEARCH_URL)
+    parser.add_argument('--quota_db', type=str, help="SQLite file tracking the daily Google Search API quota, shared by all runs", default="quota.db")
+    parser.add_argument('--daily_limit', type=int, help="Google Search API queries allowed per day", default=10000)
+    parser.add_argument('--max_attempts', type=int, help="maximum number of tries for each GPT-3 or Google search API query before giving up on it (rate limited and transient errors are retried with backoff)", default=8)
+    parser.add_argument('--completion_cache', type=str, help="SQLite file to cache GPT-3 completions in, so that rerunning a seed doesn't query GPT-3 again", default=None)
+    parser.add_argument('--cache_max_mb', type=float, help="size bound of the completion cache in MB, least recently used completions are evicted past it. 0 for no bound", default=0)
+    parser.add_argument('--prompt_seed', type=int, help="random seed for sampling prompt examples (defaults to 0 when using a completion cache, unseeded otherwise)", default=None)
+    parser.add_argument('--offline', action="store_true", help="Flag for only using the completion cache and the memo (no GPT-3 or Google queries). Queries that aren't cached are skipped.")
+    return parser
+
+
+if __name__ == "__main__":
+    load_dotenv()
 
+    args = get_parser().parse_args()
     main(args)
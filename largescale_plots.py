@@ -1,12 +1,13 @@
 # creates largescale evaluation plots after pipeline run and filters
 # used to create figure 8 in the accompanying manuscript
 
-import pandas as pd
 import os
 import matplotlib
 matplotlib.use("agg")
 import matplotlib.pyplot as plt
 import argparse
+from redmed_lexicon import load_lexicon
+from run_store import iter_runs, source_files
 
 
 def main(args):
@@ -23,32 +24,28 @@ def main(args):
     n_uniq = []
     n_filter = []
     n_ungs = []
-    redmed = pd.read_csv("redmed_lexicon.tsv",sep="\t")
-    for fname in os.listdir(args.d):
-        if args.widelydiscussed and not fname[:-4] in discussed_list: 
-        continue
-        df = pd.read_csv(os.path.join(args.d, fname), index_col=0)
-        if "Google" in df.columns:
-            google_col = "Google"
-        else:
-            google_col = "GPT-3 term in Google"
+    drug_names = load_lexicon().drug_names
+    files = None
+    if args.widelydiscussed:
+        files = [s["file"] for s in source_files(args.d) if s["file"][:-4] in discussed_list]
+    columns = ["GPT-3 term", "seed for prompt", "Seed of GPT-3 term in RedMed", "Google"]
+    for fname, file_columns, df in iter_runs(args.d, columns=columns, files=files):
         if len(df) == 0:
             n_blank += 1
             continue
-        if "Error" in df[google_col].tolist():
+        if df["Google"].isna().any(): # searches that errored
             print(fname)
             continue
         n += 1
-        
+
+        terms = df["GPT-3 term"]
+        seeds = df["seed for prompt"].astype(object)
         n_terms.append(len(df))
-        n_uniq.append(len(df["GPT-3 term"].unique()))
-        filter_df = df.loc[df.apply(lambda row: (row[google_col] == True or row[google_col] == "True") and (row["GPT-3 term"] == row["seed for prompt"] or not row["GPT-3 term"] in redmed["drug"].tolist()),axis=1)]
-        if len(filter_df) == 0:
-            n_filter.append(0)
-            n_ungs.append(0)
-        else:
-            n_filter.append(len(filter_df["GPT-3 term"].unique()))
-            n_ungs.append(len(filter_df.loc[filter_df.apply(lambda row: row["seed for prompt"] != row["Seed of GPT-3 term in RedMed"], axis=1)]["GPT-3 term"].unique()))
+        n_uniq.append(terms.nunique(dropna=False))
+        passed = df["Google"].to_numpy(dtype=bool) & ((terms == seeds) | ~terms.isin(drug_names))
+        n_filter.append(terms[passed].nunique(dropna=False))
+        novel = passed & (seeds != df["Seed of GPT-3 term in RedMed"].astype(object))
+        n_ungs.append(terms[novel].nunique(dropna=False))
 
     if args.plot:
         plt.hist(n_terms, 20, color="darkgray", edgecolor="black")
@@ -87,7 +84,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--plot', action="store_true", help="Flag to generate new plots and save as .png")
     parser.add_argument('--widelydiscussed', action="store_true", help="Flag to indicate that only widely-discussed drugs should be included in analysis")
-    parser.add_argument('-d', type=str, help="directory of query pipeline output files to analyze")
+    parser.add_argument('-d', type=str, help="directory of query pipeline output files to analyze, or a dataset of them (see run_store.py)")
     parser.add_argument('--plotdir', type=str, help="directory in which to save plots")
     args = parser.parse_args()
 
@@ -8,11 +8,13 @@
 import matplotlib
 matplotlib.use("agg")
 import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
 import argparse
 import os
 from sklearn.metrics import ConfusionMatrixDisplay
+from filter_eval import confusion_matrix, evaluate
+from redmed_lexicon import load_lexicon
+from run_store import read_csv_typed
 
 
 # codes for colors in plots to indicate manual label
@@ -22,6 +24,68 @@ from sklearn.metrics import ConfusionMatrixDisplay
 COLOR_DICT = {"True": "deepskyblue", "False": "firebrick", "Unknown": "dimgray", "?": "lemonchiffon"}
 
 
+# returns the histogram of each group of values: counts[i] is the number of
+# values of the group equal to i, for i from 0 to the largest value (values
+# below 0, e.g. a Google depth of -1 for terms that weren't found, are left
+# out). with a cap, the last bin (at the cap) counts every value at the cap
+# and above it. all histograms have the same length
+#
+# params:
+# values (array) - ints to bin
+# groups (dict) - boolean mask over values of each group, by group name
+# cap (int) - last bin, -1 for no cap
+def histograms(values, groups, cap=-1):
+    values = np.asarray(values, dtype=np.int64)
+    kept = values >= 0
+    if cap > 0:
+        values = np.minimum(values, cap)
+    n = int(values[kept].max()) + 1 if kept.any() else 1
+    return {name: np.bincount(values[kept & np.asarray(mask, dtype=bool)], minlength=n) for name, mask in groups.items()}
+
+
+# returns the number of times each unique term was generated and its manual
+# label (the label of its first row, "Unknown" for runs without manual labels),
+# as arrays with one entry per unique term
+#
+# params:
+# df (DataFrame) - output of pipeline run
+def term_frequencies(df):
+    terms = df["GPT-3 term"]
+    first = df.loc[terms.notna() & ~terms.duplicated()]
+    freqs = terms.value_counts().reindex(first["GPT-3 term"]).to_numpy()
+    if "manual label" in df.columns:
+        labels = first["manual label"].to_numpy()
+    else:
+        labels = np.full(len(first), "Unknown", dtype=object)
+    return freqs, labels
+
+
+# returns the last bin of a set of histograms that holds any value
+#
+# params:
+# hists (list) - histograms (see histograms)
+def last_bin(hists):
+    return max(int(np.flatnonzero(h).max()) if h.any() else 0 for h in hists)
+
+
+# draws stacked bars from histograms, one stack per bin from 1 to n. every
+# histogram is drawn over the previous ones, so each should count a subset of
+# the values of the one before it
+#
+# params:
+# ax (Axes) - axes to draw on
+# layers (list) - (histogram, color) tuples, from back to front
+# n (int) - last bin to draw
+# bar_width (int) - width of a bar
+def stacked_bars(ax, layers, n, bar_width):
+    counts = np.zeros((len(layers), n + 1), dtype=np.int64)
+    for layer, (h, _) in enumerate(layers):
+        counts[layer, :min(len(h), n + 1)] = h[:n + 1]
+    X = np.arange(n) * bar_width
+    for layer, (_, color) in enumerate(layers):
+        ax.bar(X, counts[layer, 1:], width=bar_width, color=color)
+
+
 # creates a histogram of google search depth at which a term was
 # found vs. number of terms found at that depth
 #
@@ -34,12 +98,6 @@ COLOR_DICT = {"True": "deepskyblue", "False": "firebrick", "Unknown": "dimgray",
 # namefilter (bool) - flag for whether to remove terms that don't pass the
 #                     drug name filter before plotting
 def depths_bar(df, plotdir, uniq=True, broad=False, namefilter=False):
-    def get_len(df):
-        if uniq:
-            return len(df["GPT-3 term"].unique())
-        else:
-            return len(df)
-
     fig, ax = plt.subplots()
     if uniq:
         ylab = "unique "
@@ -52,27 +110,36 @@ def depths_bar(df, plotdir, uniq=True, broad=False, namefilter=False):
     if namefilter:
         fname = fname[:-4] + "_namefilter.png"
     bar_width = 5
-    X = 0
-
-    for i in range(1, max(df["Google depth"]) + 1):
-        subdf = df.loc[df["Google depth"] == i]
-        if "manual label" in df.columns:
-            ax.bar(X, get_len(subdf), width=bar_width, color=COLOR_DICT["True"])
-            if not broad:
-                ax.bar(X, get_len(subdf.loc[subdf["manual label"] != "True"]), width=bar_width, color=COLOR_DICT["?"])
-            ax.bar(X, get_len(subdf.loc[subdf["manual label"] == "False"]), width=bar_width, color=COLOR_DICT["False"])
-        else:
-            ax.bar(X, get_len(subdf), width=bar_width, color=COLOR_DICT["Unknown"])
-        X += bar_width
+    max_depth = int(df["Google depth"].max())
+
+    if "manual label" in df.columns:
+        groups = {"True": np.ones(len(df), dtype=bool), "?": (df["manual label"] != "True").to_numpy(), "False": (df["manual label"] == "False").to_numpy()}
+    else:
+        groups = {"Unknown": np.ones(len(df), dtype=bool)}
+    # a unique term is counted once per depth it was found at, in each group
+    if uniq:
+        for label, mask in groups.items():
+            groups[label] = mask.copy()
+            groups[label][mask] = ~df.loc[mask].duplicated(subset=["GPT-3 term", "Google depth"]).to_numpy()
+    hists = histograms(df["Google depth"].fillna(-1), groups)
+
+    if "manual label" in df.columns:
+        layers = [(hists["True"], COLOR_DICT["True"])]
+        if not broad:
+            layers.append((hists["?"], COLOR_DICT["?"]))
+        layers.append((hists["False"], COLOR_DICT["False"]))
+    else:
+        layers = [(hists["Unknown"], COLOR_DICT["Unknown"])]
+    stacked_bars(ax, layers, max_depth, bar_width)
     plt.xlabel("Google Search Depth", fontsize=15)
     plt.ylabel("Number of %sterms" % ylab, fontsize=15) 
-    plt.title(d, fontsize=18)
+    plt.title(", ".join(df["seed for prompt"].astype(object).unique()), fontsize=18)
     if "manual label" in df.columns:
         if broad:
             ax.legend(labels=['True','False'], prop={"size":15})
         else:
             ax.legend(labels=['True','?','False'], prop={"size":15})
-    plt.xticks(np.arange(0, bar_width * max(df["Google depth"]), bar_width), range(1, max(df["Google depth"] + 1)))
+    plt.xticks(np.arange(0, bar_width * max_depth, bar_width), range(1, max_depth + 1))
     plt.savefig(fname, dpi=300, bbox_inches = "tight")
     plt.clf()
 
@@ -84,7 +151,8 @@ def depths_bar(df, plotdir, uniq=True, broad=False, namefilter=False):
 # df (DataFrame) - output of pipeline run with manual labels
 # plotdir (str) - directory in which to save output image
 # cap (int) - cap for x axis (excluding outliers for prettier plotting)
-#             setting this to -1 means there is no cap
+#             setting this to -1 means there is no cap. the bar at the cap
+#             accounts for all terms generated that often or more often
 # broad (bool) - flag for considering broad terms (terms that refer to the
 #                specified drug but also other drugs, e.g. benzo) as True
 # namefilter (bool) - flag for whether to remove terms that don't pass the
@@ -92,51 +160,14 @@ def depths_bar(df, plotdir, uniq=True, broad=False, namefilter=False):
 # googlefilter (bool) - flag for whether to remove terms that don't pass the
 #                       Google search filter before plotting  
 def freq_bar(df, plotdir, cap=-1, broad=False, namefilter=False, googlefilter=False):
-    # helper function. returns the number of terms with a given label that occur
-    # with the given frequency. if there is an x axis cap, then the bar at that
-    # cap will account for all terms occuring at that frequency and more frequently.
-    #
-    # params:
-    # l (list) - list of frequencies for all terms of a given manual label
-    # i (int) - which frequency to provide count for
-    def count(l, i):
-        if cap > 0 and i == cap:
-            total = 0
-            for j in range(i, max(l) + 1):
-                total += l.count(j)
-            return total 
-        else:
-            return l.count(i)
-
     if type(cap) == type(None):
         cap = -1
 
     if googlefilter:
-        df = df.loc[df["Google"]]
-
-    true_freqs = []
-    false_freqs = []
-    truish_freqs = []
-    freqs = []
-    n_true_ones = 0
-    n_false_ones = 0
-    for term in df["GPT-3 term"].unique():
-        subdf = df.loc[df["GPT-3 term"] == term]
-        if len(subdf) == 0:
-            continue
-        n = len(subdf)
-        if "manual label" in df.columns:
-            if subdf["manual label"].tolist()[0] == "True":
-                true_freqs.append(n)
-                if n == 1: n_true_ones += 1
-            elif subdf["manual label"].tolist()[0] == "False":
-                false_freqs.append(n)
-                if n == 1: n_false_ones += 1
-            elif subdf["manual label"].tolist()[0] == "?":
-                truish_freqs.append(n)
-                if n == 1: n_true_ones += 1
-        else:
-            freqs.append(n)
+        df = df.loc[df["Google"].fillna(False).to_numpy(dtype=bool)]
+
+    freqs, labels = term_frequencies(df)
+    hists = histograms(freqs, {label: labels == label for label in ["True", "False", "?", "Unknown"]}, cap=cap)
 
     fig, ax = plt.subplots()
     fname = os.path.join(plotdir, "regoogle_freq_bar.png")
@@ -147,29 +178,23 @@ def freq_bar(df, plotdir, cap=-1, broad=False, namefilter=False, googlefilter=Fa
     if googlefilter:
         fname = fname[:-4] + "_googlefilter.png"
     bar_width = 50
-    X = 0
-    if len(freqs) > 0:
-        maxn = max(freqs)
-    elif broad:
-        maxn = max(max(true_freqs), max(false_freqs))
-    else:
-        maxn = max(max(true_freqs), max(false_freqs), max(truish_freqs))
-    if cap > 0:
-        maxn = min(maxn, cap)
-
-    for i in range(1, maxn + 1):
-        if "manual label" in df.columns:
-            ax.bar(X, count(true_freqs,i) + count(false_freqs,i) + count(truish_freqs,i), width=bar_width, color=COLOR_DICT["True"])
-            if not broad:
-                ax.bar(X, count(false_freqs,i) + count(truish_freqs,i), width=bar_width, color=COLOR_DICT["?"])
-            ax.bar(X, count(false_freqs,i), width=bar_width, color=COLOR_DICT["False"])
+    if "manual label" in df.columns:
+        if broad:
+            maxn = last_bin([hists["True"], hists["False"]])
         else:
-            ax.bar(X, count(freqs,i), width=bar_width, color=COLOR_DICT["Unknown"])
-        X += bar_width
+            maxn = last_bin([hists["True"], hists["False"], hists["?"]])
+        layers = [(hists["True"] + hists["False"] + hists["?"], COLOR_DICT["True"])]
+        if not broad:
+            layers.append((hists["False"] + hists["?"], COLOR_DICT["?"]))
+        layers.append((hists["False"], COLOR_DICT["False"]))
+    else:
+        maxn = last_bin([hists["Unknown"]])
+        layers = [(hists["Unknown"], COLOR_DICT["Unknown"])]
+    stacked_bars(ax, layers, maxn, bar_width)
     plt.xlabel("Number of times generated by GPT-3", fontsize=15)
     plt.ylabel("Number of terms (log scale)", fontsize=15) 
     plt.yscale("log")
-    plt.title(d, fontsize=18)
+    plt.title(", ".join(df["seed for prompt"].astype(object).unique()), fontsize=18)
     if "manual label" in df.columns:
         if broad:
             ax.legend(labels=['True','False'], prop={"size":15})
@@ -180,36 +205,15 @@ def freq_bar(df, plotdir, cap=-1, broad=False, namefilter=False, googlefilter=Fa
     plt.clf()
 
 
-# creates np array version of confusion matrix
-# precursor step to creating the actual plot
-# must assign predicted and real labels first
-#
-# params:
-# df (DataFrame) - output of pipeline run with manual labels and predicted
-#                  labels
-def confusion_matrix(df):
-    df["tn"] = df.apply(lambda row: not row["pred"] and not row["real"], axis=1)
-    df["fp"] = df.apply(lambda row: row["pred"] and not row["real"], axis=1)
-    df["fn"] = df.apply(lambda row: not row["pred"] and row["real"], axis=1)
-    df["tp"] = df.apply(lambda row: row["pred"] and row["real"], axis=1)
-    tn = len(df.loc[df["tn"]])
-    fp = len(df.loc[df["fp"]])
-    fn = len(df.loc[df["fn"]])
-    tp = len(df.loc[df["tp"]])
-    return np.array([[tn, fp],[fn, tp]])
-
-
 # plots a confusion matrix using sklearn functions
-# must assign predicted and real labels first
 #
 # params:
-# df (DataFrame) - output of pipeline run with manual labels and predicted
-#                  labels
+# cm (array) - confusion matrix, as [[tn, fp], [fn, tp]] (see
+#              filter_eval.confusion_matrix)
 # plotdir (str) - directory in which to save output image
 # fname (str) - filename of output image
 # title (str) - title to put on plot
-def save_cm_plot(df, plotdir, fname, title):
-    cm = confusion_matrix(df)
+def save_cm_plot(cm, plotdir, fname, title):
     disp = ConfusionMatrixDisplay(confusion_matrix=cm)
     plt.rcParams.update({'font.size': 20})
     disp.plot(im_kw={"vmin": 0, "vmax": 1100})
@@ -220,54 +224,47 @@ def save_cm_plot(df, plotdir, fname, title):
 
 # creates several different confusion matrices using different ways to
 # classify gpt-3 generated terms as "true" (i.e. as gpt-3 synonyms).
-# plots are saved in separate files.
+# plots are saved in separate files. the matrices are computed by
+# filter_eval.evaluate, which can also evaluate other depth and frequency
+# cutoffs without plotting
 #
 # params:
 # df (DataFrame) - output of pipeline run with manual labels
 # plotdir (str) - directory in which to save output images
 def make_all_cms(df, plotdir):
     fname = "regoogle_cm_"
+    depth = 10
     freq_cutoff = 1
 
-    # put frequency information into  df before dropping duplicates
-    df["freq"] = df.apply(lambda row: df["GPT-3 term"].value_counts()[row["GPT-3 term"]], axis=1)
+    # allows broad terms -- pass broad=False if you want higher specificity!
+    results = evaluate(df, [depth], [freq_cutoff], broad=True)
 
-    df.drop_duplicates(subset=["GPT-3 term"], inplace=True)
-    df["real"] = df.apply(lambda row: row["manual label"] == "True" or row["manual label"] == "?", axis=1) # allows broad terms -- change if you want higher specificity!
-
-    if not "filtered name" in df.columns:
-        df = drugname_filter(df)
-    
     # using google depth 10 to classify gpt3 results
     # also uses drug name filter
     if "filter prediction" in df.columns:
-        df["pred"] = df["filter prediction"]
+        cm = confusion_matrix(results, "filter_prediction")
     else:
-        df["pred"] = df.apply(lambda row: row["Google depth"] > 0 and row["Google depth"] <= 10 and not row["filtered name"], axis=1)
-    save_cm_plot(df, plotdir, fname + "all_google_10_true.png", "Confusion Matrix when all terms passing any Google filter with depth 10 are predicted True")
+        cm = confusion_matrix(results, "google", depth=depth)
+    save_cm_plot(cm, plotdir, fname + "all_google_10_true.png", "Confusion Matrix when all terms passing any Google filter with depth 10 are predicted True")
     
     # only using drug name filter to classify gpt3 results
-    df["pred"] = df.apply(lambda row: not row["filtered name"], axis=1)
-    save_cm_plot(df, plotdir, fname + "drugname_only_true.png", "Confusion Matrix when all terms passing drugname filter are predicted True")
+    save_cm_plot(confusion_matrix(results, "name"), plotdir, fname + "drugname_only_true.png", "Confusion Matrix when all terms passing drugname filter are predicted True")
     
     # using frequency + drug name filter
-    df["pred"] = df.apply(lambda row: row["freq"] > freq_cutoff and not row["filtered name"], axis=1)
-    save_cm_plot(df, plotdir, fname + "freq%d_true.png" % freq_cutoff, "Confusion Matrix when all terms with frequency %d and passing name filter are predicted True" % freq_cutoff)
+    save_cm_plot(confusion_matrix(results, "freq", freq_cutoff=freq_cutoff), plotdir, fname + "freq%d_true.png" % freq_cutoff, "Confusion Matrix when all terms with frequency %d and passing name filter are predicted True" % freq_cutoff)
 
     # using frequency + drug name filter + google
     if "filter prediction" in df.columns:
-        df["pred"] = df.apply(lambda row: row["filter prediction"] and row["freq"] > freq_cutoff, axis=1)
+        cm = confusion_matrix(results, "filter_prediction_freq", freq_cutoff=freq_cutoff)
     else:
-        df["pred"] = df.apply(lambda row: row["Google depth"] > 0 and row["Google depth"] <= 10 and not row["filtered name"] and row["freq"] > freq_cutoff, axis=1)
-    save_cm_plot(df, plotdir, fname + "all_google_10_name_freq%d_true.png" % freq_cutoff, "Confusion Matrix when all terms passing any Google filter with depth 10 and name and freq filters are predicted True")
+        cm = confusion_matrix(results, "google_freq", depth=depth, freq_cutoff=freq_cutoff)
+    save_cm_plot(cm, plotdir, fname + "all_google_10_name_freq%d_true.png" % freq_cutoff, "Confusion Matrix when all terms passing any Google filter with depth 10 and name and freq filters are predicted True")
     
     # blindly all taking gpt3 results as true
-    df["pred"] = True * len(df)
-    save_cm_plot(df, plotdir, fname + "gpt3_true.png", "Confusion Matrix when all GPT-3 generated terms are predicted True")
+    save_cm_plot(confusion_matrix(results, "all"), plotdir, fname + "gpt3_true.png", "Confusion Matrix when all GPT-3 generated terms are predicted True")
 
     # using redmed to classify gpt3 results
-    df["pred"] = df.apply(lambda row: row["Seed of GPT-3 term in RedMed"] == row["seed for prompt"], axis=1)
-    save_cm_plot(df, plotdir, fname + "redmed_true.png", "Confusion Matrix when all terms present in RedMed are predicted True")
+    save_cm_plot(confusion_matrix(results, "redmed"), plotdir, fname + "redmed_true.png", "Confusion Matrix when all terms present in RedMed are predicted True")
     
 
 
@@ -278,18 +275,18 @@ def make_all_cms(df, plotdir):
 # drop (bool) - whether to drop rows that don't pass drug name filter (versus
 #               adding a False label in the "filtered name" column being created
 def drugname_filter(df, drop=False):
-    redmed = pd.read_csv("redmed_lexicon.tsv",sep="\t")
-    df["filtered name"] = df.apply(lambda row: row["GPT-3 term"] in redmed["drug"].tolist() and not row["GPT-3 term"] == row["seed for prompt"], axis=1)
+    drug_names = load_lexicon().drug_names
+    df["filtered name"] = df["GPT-3 term"].isin(drug_names) & (df["GPT-3 term"] != df["seed for prompt"].astype(object))
     if drop:
         df = df.loc[df["filtered name"] == False]
     return df
 
 
 def main(args):
-    df = pd.read_csv(args.f, index_col=0)
+    df = read_csv_typed(args.f)
     df = df.loc[df["seed for prompt"] == args.seed]
     if args.broad:
-        df["manual label"] = df.apply(lambda row: "True" if row["manual label"] == "?" else row["manual label"], axis=1)
+        df["manual label"] = df["manual label"].astype(object).where(df["manual label"] != "?", "True").astype("category")
     if args.namefilter:
         drop = args.plot != "cm"
         if "name filter" in df.columns:
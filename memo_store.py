@@ -0,0 +1,636 @@
+# storage backends for the memo of Google searches, which saves search API
+# queries across runs. the memo holds two kinds of entries:
+# - pages: one page of search results, keyed by query string and start index
+#   (1, 11, 21, ...). pages are kept parsed and tokenized (see
+#   google_search.parse_page) so that checking them doesn't parse JSON again
+# - results: whether an index term appears in the search results for a term,
+#   keyed by (term, seed), with the depth at which it first appears (-1 if not)
+#
+# SqliteMemo writes every entry as soon as it is added, so a crash or Ctrl-C
+# doesn't lose anything, and reads entries only when they are needed. it is safe
+# to share one database between several processes. pages are stored compressed,
+# and entries can be given a time to live and pages a size bound (least
+# recently used pages are evicted past it). ShardedMemo spreads the entries
+# over several such databases in a directory. PickleMemo keeps the old memo.p
+# format (one pickled dict, loaded at the start and written at the end, that
+# grows without bound). memos from before pages were kept parsed (holding the
+# raw JSON text of each page) are migrated when they are opened.
+#
+# to import an existing memo.p into a database (or either into a .shards
+# directory):
+# python memo_store.py import memo.p memo.db
+# python memo_store.py import memo.db memo.shards
+# to drop expired entries and pages no result refers to, and shrink the files:
+# python memo_store.py compact memo.db --ttl_days 180 --max_mb 500
+# to see the number of entries, bytes, hit rate and ages of the entries:
+# python memo_store.py stats memo.db
+
+import argparse
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from google_search import parse_page
+
+
+# prefix of the keys that hold result pages in the pickled memo dicts
+PAGE_KEY_PREFIX = "google_search_response_"
+
+# file extensions of pickled memos
+PICKLE_EXTENSIONS = [".p", ".pkl", ".pickle"]
+
+
+# returns the number of old style (raw JSON text) pages in a pickled memo dict
+# that were converted to parsed pages. pages that can't be parsed are dropped,
+# so that they are searched for again
+#
+# params:
+# memo (dict) - memo dict, modified in place
+def migrate_pickled_pages(memo):
+    n = 0
+    for entries in memo.values():
+        for key in [k for k, v in entries.items() if k.startswith(PAGE_KEY_PREFIX) and isinstance(v, str)]:
+            try:
+                entries[key] = parse_page(entries[key])
+                n += 1
+            except Exception:
+                del entries[key]
+    return n
+
+
+# memo kept in memory as a dict and pickled to a file on close, in the same
+# layout as the memo.p files: memo[term]["google_search_response_<start>"]
+# holds a parsed page, memo[term][seed] holds {"result", "depth"}
+#
+# params:
+# path (str) - pickle file to load from (if it exists) and save to
+class PickleMemo:
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.memo = pickle.load(open(path,"rb"))
+        except:
+            self.memo = dict()
+        migrate_pickled_pages(self.memo)
+
+    # params:
+    # query (str) - search query
+    # start (int) - index of the first result on the page
+    def get_page(self, query, start):
+        return self.memo.get(query, {}).get(PAGE_KEY_PREFIX + str(start))
+
+    # params:
+    # query (str) - search query
+    # start (int) - index of the first result on the page
+    # page (tuple) - parsed page (from google_search.parse_page)
+    def put_page(self, query, start, page):
+        self.memo.setdefault(query, dict())[PAGE_KEY_PREFIX + str(start)] = page
+
+    # returns {"result": bool, "depth": int} or None if there is no entry
+    #
+    # params:
+    # term (str) - searched term
+    # seed (str) - index term
+    def get_result(self, term, seed):
+        return self.memo.get(term, {}).get(seed)
+
+    # params:
+    # term (str) - searched term
+    # seed (str) - index term
+    # result (bool) - whether the index term appears in the search results
+    # depth (int) - depth at which it first appears (-1 if it doesn't)
+    def put_result(self, term, seed, result, depth):
+        self.memo.setdefault(term, dict())[seed] = {"result": result, "depth": depth}
+
+    # params:
+    # term (str) - searched term
+    # results (dict) - (result, depth) of each index term
+    def put_results(self, term, results):
+        entries = self.memo.setdefault(term, dict())
+        for seed, (result, depth) in results.items():
+            entries[seed] = {"result": result, "depth": depth}
+
+    # params:
+    # term (str) - searched term
+    # seed (str) - index term
+    def drop_result(self, term, seed):
+        self.memo.get(term, {}).pop(seed, None)
+
+    # returns every result as a (term, seed, result, depth) tuple
+    def result_rows(self):
+        return [(term, seed, bool(value["result"]), value["depth"]) for term, entries in self.memo.items() for seed, value in entries.items() if not seed.startswith(PAGE_KEY_PREFIX)]
+
+    # returns a (query, start, total, has items) tuple for every page, without
+    # the items themselves
+    def page_rows(self):
+        return [(query, int(key[len(PAGE_KEY_PREFIX):]), value[0], value[1] is not None) for query, entries in self.memo.items() for key, value in entries.items() if key.startswith(PAGE_KEY_PREFIX)]
+
+    def close(self):
+        pickle.dump(self.memo, open(self.path, "wb"))
+
+
+# memo stored in a SQLite database in WAL mode. each thread gets its own
+# connection, and every put is committed immediately. a page is stored as its
+# total number of results and its pickled, zlib-compressed items. every entry
+# records when it was added, and every page when it was last read (kept in
+# memory and written in one go before evicting and on close), so that entries
+# can be expired after a time to live and pages evicted least recently used
+# first when the pages grow past a size bound
+#
+# params:
+# path (str) - database file (created if it doesn't exist)
+# timeout (float) - seconds to wait for another process's write lock
+# ttl (float) - seconds after which entries expire: they are treated as
+#               missing (so they are searched for again) and deleted by
+#               compact (0 to never expire)
+# max_bytes (int) - size bound of the stored pages (0 for no bound)
+class SqliteMemo:
+    def __init__(self, path, timeout=60, ttl=0, max_bytes=0):
+        self.path = path
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conns = []
+        self.n_hits = 0
+        self.n_misses = 0
+        self.last_used = dict() # (query, start) -> time of pages read since the last save
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS parsed_pages (query TEXT NOT NULL, start INTEGER NOT NULL, total INTEGER NOT NULL, items BLOB, size INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL DEFAULT 0, last_used REAL NOT NULL DEFAULT 0, PRIMARY KEY (query, start))")
+        conn.execute("CREATE TABLE IF NOT EXISTS results (term TEXT NOT NULL, seed TEXT NOT NULL, result INTEGER NOT NULL, depth INTEGER NOT NULL, created REAL NOT NULL DEFAULT 0, PRIMARY KEY (term, seed))")
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.migrate_columns()
+        self.migrate_pages()
+        conn.execute("CREATE INDEX IF NOT EXISTS parsed_pages_last_used ON parsed_pages (last_used)")
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM parsed_pages").fetchone()[0]
+
+    # returns this thread's connection to the database
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+
+    # adds the size and timestamp columns to the tables of a database from
+    # before they existed. entries already in it count as added (and last
+    # used) now
+    def migrate_columns(self):
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            page_columns = [row[1] for row in conn.execute("PRAGMA table_info(parsed_pages)")]
+            if not "size" in page_columns:
+                conn.execute("ALTER TABLE parsed_pages ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE parsed_pages ADD COLUMN created REAL NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE parsed_pages ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE parsed_pages SET size = COALESCE(LENGTH(items), 0), created = ?, last_used = ?", (now, now))
+            result_columns = [row[1] for row in conn.execute("PRAGMA table_info(results)")]
+            if not "created" in result_columns:
+                conn.execute("ALTER TABLE results ADD COLUMN created REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE results SET created = ?", (now,))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    # moves the raw JSON pages of a database from before pages were kept
+    # parsed (the pages table) into parsed_pages, then drops the old table.
+    # pages that can't be parsed are dropped, so that they are searched for
+    # again. returns the number of pages migrated
+    def migrate_pages(self):
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'pages'").fetchone() is None:
+                conn.execute("COMMIT")
+                return 0
+            n = 0
+            cursor = conn.execute("SELECT query, start, response FROM pages")
+            while True:
+                rows = cursor.fetchmany(1000)
+                if len(rows) == 0:
+                    break
+                parsed = []
+                for query, start, text in rows:
+                    try:
+                        parsed.append(page_row(query, start, parse_page(text), now))
+                    except Exception:
+                        continue
+                conn.executemany("INSERT OR REPLACE INTO parsed_pages VALUES (?, ?, ?, ?, ?, ?, ?)", parsed)
+                n += len(parsed)
+            conn.execute("DROP TABLE pages")
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return n
+
+    # returns the oldest creation time of entries that haven't expired
+    def fresh_after(self):
+        if self.ttl > 0:
+            return time.time() - self.ttl
+        return 0
+
+    def get_page(self, query, start):
+        conn = self.connect()
+        row = conn.execute("SELECT total, items FROM parsed_pages WHERE query = ? AND start = ? AND created >= ?", (query, start, self.fresh_after())).fetchone()
+        with self.lock:
+            if row is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+                self.last_used[(query, start)] = time.time()
+        if row is None:
+            return None
+        return decode_page(row)
+
+    def put_page(self, query, start, page):
+        row = page_row(query, start, page, time.time())
+        conn = self.connect()
+        # a page that is already stored is replaced, so only the difference in
+        # size counts towards the bound
+        old = conn.execute("SELECT size FROM parsed_pages WHERE query = ? AND start = ?", (query, start)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO parsed_pages VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+        with self.lock:
+            self.total_bytes += row[4] - (0 if old is None else old[0])
+            over = self.max_bytes > 0 and self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def get_result(self, term, seed):
+        row = self.connect().execute("SELECT result, depth FROM results WHERE term = ? AND seed = ? AND created >= ?", (term, seed, self.fresh_after())).fetchone()
+        if row is None:
+            return None
+        return {"result": bool(row[0]), "depth": row[1]}
+
+    def put_result(self, term, seed, result, depth):
+        self.connect().execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (term, seed, int(result), depth, time.time()))
+
+    def put_results(self, term, results):
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", [(term, seed, int(result), depth, now) for seed, (result, depth) in results.items()])
+        conn.execute("COMMIT")
+
+    def drop_result(self, term, seed):
+        self.connect().execute("DELETE FROM results WHERE term = ? AND seed = ?", (term, seed))
+
+    def result_rows(self):
+        return [(term, seed, bool(result), depth) for term, seed, result, depth in self.connect().execute("SELECT term, seed, result, depth FROM results WHERE created >= ?", (self.fresh_after(),))]
+
+    def page_rows(self):
+        return [(query, start, total, bool(has_items)) for query, start, total, has_items in self.connect().execute("SELECT query, start, total, items IS NOT NULL FROM parsed_pages WHERE created >= ?", (self.fresh_after(),))]
+
+    # yields every page as a (query, start, parsed page) tuple
+    def iter_pages(self):
+        cursor = self.connect().execute("SELECT query, start, total, items FROM parsed_pages WHERE created >= ?", (self.fresh_after(),))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                break
+            for query, start, total, items in rows:
+                yield query, start, decode_page((total, items))
+
+    # adds many pages and results at once (e.g. when importing a memo)
+    #
+    # params:
+    # pages (list) - (query, start, parsed page) tuples
+    # results (list) - (term, seed, result, depth) tuples
+    def put_many(self, pages, results):
+        now = time.time()
+        rows = [page_row(query, start, page, now) for query, start, page in pages]
+        conn = self.connect()
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR REPLACE INTO parsed_pages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", [(term, seed, int(result), depth, now) for term, seed, result, depth in results])
+        # pages that were already stored are replaced, so the size is summed
+        # again rather than added to
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM parsed_pages").fetchone()[0]
+        conn.execute("COMMIT")
+        with self.lock:
+            self.total_bytes = total
+
+    # deletes least recently used pages until the pages are below 90% of the
+    # size bound. returns the number of pages deleted
+    def evict(self):
+        self.save_counts()
+        conn = self.connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM parsed_pages").fetchone()[0]
+        target = self.max_bytes * 0.9
+        doomed = []
+        if self.max_bytes > 0 and total > target:
+            for query, start, size in conn.execute("SELECT query, start, size FROM parsed_pages ORDER BY last_used"):
+                if total <= target:
+                    break
+                doomed.append((query, start))
+                total -= size
+            conn.executemany("DELETE FROM parsed_pages WHERE query = ? AND start = ?", doomed)
+        with self.lock:
+            self.total_bytes = total
+        return len(doomed)
+
+    # deletes expired entries and pages that no result refers to (pages of a
+    # query without any results, e.g. left behind by an interrupted search or
+    # an expired result), compresses pages stored by older versions, applies
+    # the size bound and then shrinks the database file. returns the number of
+    # pages and results deleted
+    def compact(self):
+        conn = self.connect()
+        fresh_after = self.fresh_after()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            n_results = conn.execute("DELETE FROM results WHERE created < ?", (fresh_after,)).rowcount
+            n_pages = conn.execute("DELETE FROM parsed_pages WHERE created < ?", (fresh_after,)).rowcount
+            n_pages += conn.execute("DELETE FROM parsed_pages WHERE NOT query IN (SELECT term FROM results)").rowcount
+            recompressed = []
+            for query, start, total, items in conn.execute("SELECT query, start, total, items FROM parsed_pages WHERE items IS NOT NULL AND SUBSTR(items, 1, 1) = X'80'"):
+                blob = encode_page(decode_page((total, items)))[1]
+                recompressed.append((blob, len(blob), query, start))
+            conn.executemany("UPDATE parsed_pages SET items = ?, size = ? WHERE query = ? AND start = ?", recompressed)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        n_pages += self.evict()
+        conn.execute("VACUUM")
+        return n_pages, n_results
+
+    # returns statistics of the memo as a dict: number of pages and results,
+    # bytes of stored pages and of the database file, lookups of pages (hits
+    # and misses, over every run that used the database) and the number of
+    # entries in each age bucket of AGE_BUCKETS
+    def stats(self):
+        self.save_counts()
+        conn = self.connect()
+        stats = dict()
+        stats["pages"], stats["page bytes"] = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM parsed_pages").fetchone()
+        stats["results"] = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        stats["file bytes"] = sum(os.path.getsize(f) for f in [self.path, self.path + "-wal"] if os.path.exists(f))
+        for name, value in conn.execute("SELECT name, value FROM stats"):
+            stats[name] = value
+        now = time.time()
+        for i, (label, max_age) in enumerate(AGE_BUCKETS):
+            min_age = AGE_BUCKETS[i - 1][1] if i > 0 else 0
+            stats["age " + label] = conn.execute("SELECT (SELECT COUNT(*) FROM parsed_pages WHERE created <= ? AND created > ?) + (SELECT COUNT(*) FROM results WHERE created <= ? AND created > ?)", (now - min_age, now - max_age, now - min_age, now - max_age)).fetchone()[0]
+        return stats
+
+    # writes the last read time of the pages read since the last save, and
+    # adds their hits and misses to the totals kept in the database
+    def save_counts(self):
+        with self.lock:
+            counts = [("hits", self.n_hits), ("misses", self.n_misses)]
+            self.n_hits = 0
+            self.n_misses = 0
+            used = [(t, query, start) for (query, start), t in self.last_used.items()]
+            self.last_used = dict()
+        conn = self.connect()
+        conn.execute("BEGIN")
+        conn.executemany("UPDATE parsed_pages SET last_used = ? WHERE query = ? AND start = ?", used)
+        conn.executemany("INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", counts)
+        conn.execute("COMMIT")
+
+    def close(self):
+        self.save_counts()
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+        self.local = threading.local()
+
+
+# memo split over several SqliteMemo databases (shards) in a directory, by a
+# hash of the query string. a term's pages and results are in the same shard.
+# smaller databases are quicker to open, compact and evict from, and runs that
+# write to different shards don't wait for each other's write locks
+#
+# params:
+# path (str) - directory of the shards (created if it doesn't exist)
+# n_shards (int) - number of shards for a new directory (an existing one keeps
+#                  its number of shards)
+# ttl, max_bytes - same as for SqliteMemo. max_bytes is split evenly between
+#                  the shards
+class ShardedMemo:
+    def __init__(self, path, n_shards=16, ttl=0, max_bytes=0):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        existing = [f for f in os.listdir(path) if f.startswith("shard_") and f.endswith(".db")]
+        if len(existing) > 0:
+            n_shards = len(existing)
+        self.shards = [SqliteMemo(os.path.join(path, "shard_%03d.db" % i), ttl=ttl, max_bytes=max_bytes // n_shards) for i in range(n_shards)]
+
+    # returns the shard that holds a query
+    #
+    # params:
+    # query (str) - search query (or searched term)
+    def shard(self, query):
+        return self.shards[zlib.crc32(query.encode()) % len(self.shards)]
+
+    def get_page(self, query, start):
+        return self.shard(query).get_page(query, start)
+
+    def put_page(self, query, start, page):
+        self.shard(query).put_page(query, start, page)
+
+    def get_result(self, term, seed):
+        return self.shard(term).get_result(term, seed)
+
+    def put_result(self, term, seed, result, depth):
+        self.shard(term).put_result(term, seed, result, depth)
+
+    def put_results(self, term, results):
+        self.shard(term).put_results(term, results)
+
+    def drop_result(self, term, seed):
+        self.shard(term).drop_result(term, seed)
+
+    def result_rows(self):
+        return [row for shard in self.shards for row in shard.result_rows()]
+
+    def page_rows(self):
+        return [row for shard in self.shards for row in shard.page_rows()]
+
+    def iter_pages(self):
+        for shard in self.shards:
+            yield from shard.iter_pages()
+
+    def put_many(self, pages, results):
+        shard_pages = dict()
+        shard_results = dict()
+        for p in pages:
+            shard_pages.setdefault(id(self.shard(p[0])), []).append(p)
+        for r in results:
+            shard_results.setdefault(id(self.shard(r[0])), []).append(r)
+        for shard in self.shards:
+            shard.put_many(shard_pages.get(id(shard), []), shard_results.get(id(shard), []))
+
+    def evict(self):
+        return sum(shard.evict() for shard in self.shards)
+
+    def compact(self):
+        counts = [shard.compact() for shard in self.shards]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    # same as SqliteMemo.stats, summed over the shards
+    def stats(self):
+        stats = dict()
+        for shard in self.shards:
+            for name, value in shard.stats().items():
+                stats[name] = stats.get(name, 0) + value
+        stats["shards"] = len(self.shards)
+        return stats
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+# age buckets of the memo statistics, as (label, maximum age in seconds)
+AGE_BUCKETS = [("< 1 day", 86400), ("< 1 week", 7 * 86400), ("< 30 days", 30 * 86400), ("< 1 year", 365 * 86400), (">= 1 year", float("inf"))]
+
+
+# returns the (total, items) database columns of a parsed page. items are
+# pickled and compressed
+#
+# params:
+# page (tuple) - parsed page (from google_search.parse_page)
+def encode_page(page):
+    total, items = page
+    if items is None:
+        return (total, None)
+    return (total, zlib.compress(pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+# inverse of encode_page. also reads the uncompressed items of pages stored by
+# older versions (a pickle starts with 0x80, a zlib stream never does)
+#
+# params:
+# row (tuple) - (total, items) database columns
+def decode_page(row):
+    total, items = row
+    if items is None:
+        return (total, None)
+    if items[:1] == b"\x80":
+        return (total, pickle.loads(items))
+    return (total, pickle.loads(zlib.decompress(items)))
+
+
+# returns the parsed_pages row of a page added at time now
+#
+# params:
+# query (str) - search query
+# start (int) - index of the first result on the page
+# page (tuple) - parsed page (from google_search.parse_page)
+# now (float) - time the page is added
+def page_row(query, start, page, now):
+    total, items = encode_page(page)
+    return (query, start, total, items, 0 if items is None else len(items), now, now)
+
+
+# opens the memo backend that matches the file name: .p/.pkl/.pickle for
+# PickleMemo, .shards (a directory) for ShardedMemo, anything else for
+# SqliteMemo
+#
+# params:
+# path (str) - memo file name
+# ttl (float) - seconds after which entries expire (0 to never expire, not
+#               supported by PickleMemo)
+# max_bytes (int) - size bound of the stored pages (0 for no bound, not
+#                   supported by PickleMemo)
+def open_memo(path, ttl=0, max_bytes=0):
+    ext = os.path.splitext(path.rstrip("/"))[1]
+    if ext in PICKLE_EXTENSIONS:
+        if ttl > 0 or max_bytes > 0:
+            raise ValueError("pickled memos don't support expiry or a size bound, import %s into a database first" % path)
+        return PickleMemo(path)
+    if ext == ".shards":
+        return ShardedMemo(path, ttl=ttl, max_bytes=max_bytes)
+    return SqliteMemo(path, ttl=ttl, max_bytes=max_bytes)
+
+
+# copies every entry of a pickled memo dict into a memo backend (parsing old
+# style raw JSON pages). returns the number of pages and results imported
+#
+# params:
+# pickle_path (str) - memo.p file to import
+# memo (SqliteMemo or ShardedMemo) - memo to import into
+def import_pickle(pickle_path, memo):
+    old = pickle.load(open(pickle_path,"rb"))
+    migrate_pickled_pages(old)
+    pages = []
+    results = []
+    for term, entries in old.items():
+        for key, value in entries.items():
+            if key.startswith(PAGE_KEY_PREFIX):
+                pages.append((term, int(key[len(PAGE_KEY_PREFIX):]), value))
+            else:
+                results.append((term, key, value["result"], value["depth"]))
+    memo.put_many(pages, results)
+    return len(pages), len(results)
+
+
+# copies every entry of a database memo into another memo backend (e.g. to
+# move a memo.db into a .shards directory). returns the number of pages and
+# results imported
+#
+# params:
+# src (SqliteMemo or ShardedMemo) - memo to import
+# memo (SqliteMemo or ShardedMemo) - memo to import into
+def import_memo(src, memo):
+    n_pages = 0
+    pages = []
+    for page in src.iter_pages():
+        pages.append(page)
+        if len(pages) == 10000:
+            memo.put_many(pages, [])
+            n_pages += len(pages)
+            pages = []
+    results = src.result_rows()
+    memo.put_many(pages, results)
+    return n_pages + len(pages), len(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, help="what to do: import (a memo.p file or a memo database into a database or .shards directory), compact or stats")
+    parser.add_argument('paths', type=str, nargs="+", help="for import: memo to import and memo to import into. for compact and stats: memo")
+    parser.add_argument('--ttl_days', type=float, help="compact: delete entries older than this many days (0 to keep them)", default=0)
+    parser.add_argument('--max_mb', type=float, help="compact: evict least recently used pages until they take up less than this many MB (0 for no bound)", default=0)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        memo = open_memo(args.paths[1])
+        if os.path.splitext(args.paths[0])[1] in PICKLE_EXTENSIONS:
+            n_pages, n_results = import_pickle(args.paths[0], memo)
+        else:
+            src = open_memo(args.paths[0])
+            n_pages, n_results = import_memo(src, memo)
+            src.close()
+        memo.close()
+        print("imported %d pages and %d results into %s" % (n_pages, n_results, args.paths[1]))
+    elif args.command in ["compact", "stats"]:
+        memo = open_memo(args.paths[0], ttl=args.ttl_days * 86400, max_bytes=int(args.max_mb * 1e6))
+        if isinstance(memo, PickleMemo):
+            raise ValueError("%s needs a database memo, import %s into one first" % (args.command, args.paths[0]))
+        if args.command == "compact":
+            n_pages, n_results = memo.compact()
+            print("deleted %d pages and %d results from %s" % (n_pages, n_results, args.paths[0]))
+        else:
+            stats = memo.stats()
+            for name, value in stats.items():
+                print("%s: %d" % (name, value))
+            if stats["hits"] + stats["misses"] > 0:
+                print("hit rate: %.3f" % (stats["hits"] / (stats["hits"] + stats["misses"])))
+        memo.close()
+    else:
+        raise ValueError("unknown command: %s" % args.command)
@@ -0,0 +1,98 @@
+# streams the output rows of gpt_queries.py to a CSV as each query completes,
+# and keeps a checkpoint of which (seed, prompt index, query index) slots are
+# finished so that a restarted run with the same arguments (and --resume) can
+# skip them. a slot's prompt is rebuilt when the run is resumed, so resuming
+# needs seeded prompts: the checkpoint records the prompt seed of the run and
+# a run with another seed (or none) can't resume it.
+# the CSV has the same layout as before (pandas index column first), so it can
+# be read with pd.read_csv(fname, index_col=0)
+
+import csv
+import os
+
+
+# output columns of the pipeline
+COLUMNS = ['GPT-3 term','seed for prompt', 'Seed of GPT-3 term in RedMed', 'RedMed term inside GPT-3 term', 'Google', 'Google added token', 'Google depth']
+
+
+# params:
+# path (str) - output CSV file. the checkpoint is kept next to it in
+#              <path>.checkpoint
+# resume (bool) - whether to resume the run checkpointed at path (if there is
+#                 one) instead of starting a new one
+# prompt_seed (int) - random seed the run samples its prompts with (None if
+#                     unseeded, which can't be resumed)
+class OutputWriter:
+    def __init__(self, path, resume=False, prompt_seed=None):
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.done = set()
+        self.n_rows = 0
+        if resume and prompt_seed is None:
+            raise ValueError("resuming a run needs a prompt seed, so that the prompts of the remaining queries are the ones the run was started with")
+
+        # the first checkpoint line is "prompt_seed<TAB>seed", the others are
+        # "seed<TAB>prompt index<TAB>query index<TAB>rows written so far". a
+        # line is only added after its rows are on disk
+        if resume and os.path.exists(self.checkpoint_path):
+            lines = open(self.checkpoint_path, "r").read().split("\n")
+            recorded = lines[0][len("prompt_seed\t"):] if lines[0].startswith("prompt_seed\t") else ""
+            if recorded != str(prompt_seed):
+                raise ValueError("%s was checkpointed by a run with %s, it can't be resumed with prompt seed %d" % (self.path, "prompt seed " + recorded if recorded else "unseeded prompts", prompt_seed))
+            for line in lines[1:]:
+                fields = line.split("\t")
+                if len(fields) != 4:
+                    continue # partially written line
+                seed, i, j, n_rows = fields
+                self.done.add((seed, int(i), int(j)))
+                self.n_rows = int(n_rows)
+
+        if os.path.exists(self.path) and len(self.done) > 0:
+            self.truncate()
+        else:
+            with open(self.path, "w", newline="") as f:
+                csv.writer(f, lineterminator="\n").writerow([""] + COLUMNS)
+            with open(self.checkpoint_path, "w") as f:
+                f.write("prompt_seed\t%s\n" % ("" if prompt_seed is None else prompt_seed))
+            self.done = set()
+            self.n_rows = 0
+
+    # drops any rows that were written after the last checkpoint (e.g. by a
+    # run that was killed between writing rows and checkpointing them)
+    def truncate(self):
+        with open(self.path, "r", newline="") as f:
+            rows = list(csv.reader(f))
+        if len(rows) - 1 == self.n_rows:
+            return
+        with open(self.path + ".tmp", "w", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerows(rows[:self.n_rows + 1])
+        os.replace(self.path + ".tmp", self.path)
+
+    # params:
+    # seed (str) - index term
+    # i (int) - prompt index
+    # j (int) - query index
+    def is_done(self, seed, i, j):
+        return (seed, i, j) in self.done
+
+    # appends the rows for one query and marks it as done
+    #
+    # params:
+    # seed (str) - index term
+    # i (int) - prompt index
+    # j (int) - query index
+    # rows (list) - output rows for the query, each with a value for every
+    #               column in COLUMNS. None is written as an empty field
+    def write(self, seed, i, j, rows):
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for row in rows:
+                writer.writerow([self.n_rows] + row)
+                self.n_rows += 1
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.checkpoint_path, "a") as f:
+            f.write("%s\t%d\t%d\t%d\n" % (seed, i, j, self.n_rows))
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add((seed, i, j))
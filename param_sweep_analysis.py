@@ -1,141 +1,177 @@
 # This script is for analyzing the results of the parameter sweep.
 # The resulting output file can be visualized with param_sweep_plots.py
+# the metrics of each file are cached (--cache), so rerunning after adding a
+# parameter setting only reads the new file. several seeds can be analyzed
+# from one directory at once, e.g.
+# python param_sweep_analysis.py --seed heroin benzphetamine -d data/param_search/heroin_benzphetamine -o {seed}_grid_out.csv
 
+import numpy as np
 import pandas as pd
 import os
+from functools import partial
 from tqdm import tqdm
 import argparse
+from redmed_lexicon import LEXICON_PATH, load_lexicon, source_fingerprint
+from run_store import file_fingerprint, load_cache, map_runs, params_from_fname, save_cache, source_files
+
+
+# computes the term counts of one parameter sweep output file in a single
+# pass: each filter is a boolean mask over the rows, built once and combined,
+# and the terms are factorized once so that the unique terms selected by a
+# mask are counted by marking their codes. returns a dict with the value of
+# every n_* column of the analysis file
+#
+# params:
+# df (DataFrame) - parameter sweep output file (typed, see run_store.py)
+# seed (str) - index term (seed term)
+# drug_names (set) - drug names of the RedMed lexicon
+def file_metrics(df, seed, drug_names):
+    df = df.loc[df["seed for prompt"] == seed]
+    terms = df["GPT-3 term"]
+    # missing terms get a code of their own, so that they count as one term
+    codes, uniques = pd.factorize(terms)
+    codes[codes == -1] = len(uniques)
+    n_codes = len(uniques) + 1
+
+    # returns the number of unique terms of the rows selected by mask
+    def n_uniq(mask):
+        seen = np.zeros(n_codes, dtype=bool)
+        seen[codes[mask]] = True
+        return int(seen.sum())
+
+    # searches that errored are null, so they are neither True nor False
+    redmed_seed = df["Seed of GPT-3 term in RedMed"].astype(object).to_numpy()
+    inside = df["RedMed term inside GPT-3 term"].to_numpy(dtype=bool)
+    google_alone = df["GPT-3 term in Google"].fillna(False).to_numpy(dtype=bool)
+    google_pill = df["GPT-3 term + pill in Google"].fillna(False).to_numpy(dtype=bool)
+    not_google_alone = (~df["GPT-3 term in Google"]).fillna(False).to_numpy(dtype=bool)
+    not_google_pill = (~df["GPT-3 term + pill in Google"]).fillna(False).to_numpy(dtype=bool)
+    # validated by google in some way: alone, or with "pill" added if not alone
+    google = df["Google"].fillna(False).to_numpy(dtype=bool)
+    not_redmed = redmed_seed != seed
+
+    masks = dict()
+    masks["same_redmed_seed"] = redmed_seed == seed
+    masks["other_redmed_seed"] = not_redmed & pd.notna(redmed_seed)
+    masks["redmed_inside"] = inside
+    masks["not_seed_yes_inside"] = not_redmed & inside
+    masks["not_seed_not_inside"] = not_redmed & ~inside
+    masks["google_alone"] = google_alone
+    masks["google_pill"] = google_pill
+    masks["google"] = google
+    masks["not_redmed_not_google"] = not_redmed & not_google_alone & not_google_pill
+
+    metrics = dict()
+    metrics["n_terms"] = len(df)
+    metrics["n_uniq"] = n_uniq(np.ones(len(df), dtype=bool))
+    for name, mask in masks.items():
+        metrics["n_terms_" + name] = int(mask.sum())
+        metrics["n_uniq_" + name] = n_uniq(mask)
+
+    # number of terms that are not in redmed but are validated by google in
+    # some way. a unique term counts if it is validated by google in some row
+    # and not in redmed in some (possibly other) row
+    metrics["n_terms_not_redmed_yes_google"] = int(not_redmed.sum()) - metrics["n_terms_not_redmed_not_google"]
+    not_redmed_yes_google = np.zeros(n_codes, dtype=bool)
+    not_redmed_yes_google[codes[masks["google"]]] = True
+    in_not_redmed = np.zeros(n_codes, dtype=bool)
+    in_not_redmed[codes[not_redmed]] = True
+    not_redmed_yes_google &= in_not_redmed
+    metrics["n_uniq_not_redmed_yes_google"] = int(not_redmed_yes_google.sum())
+
+    # number of UNGSes (unique novel gpt-3 synonyms)
+    # aka unique terms not in redmed that pass google and drug name filter
+    pass_name_filter = np.zeros(n_codes, dtype=bool)
+    pass_name_filter[codes[(~terms.isin(drug_names) | (terms == df["seed for prompt"].astype(object))).to_numpy()]] = True
+    metrics["n_ungs"] = int((pass_name_filter & not_redmed_yes_google).sum())
+    return metrics
+
+
+# columns of the analysis file, in order
+COLUMNS = ["model", "temp", "freq", "pres", "prompts", "queries_per_prompt", "counter", "n_terms", "n_uniq",
+           "n_terms_same_redmed_seed", "n_terms_other_redmed_seed", "n_terms_redmed_inside", "n_terms_not_seed_yes_inside", "n_terms_not_seed_not_inside",
+           "n_terms_google_alone", "n_terms_google_pill", "n_terms_google", "n_terms_not_redmed_yes_google", "n_terms_not_redmed_not_google",
+           "n_uniq_same_redmed_seed", "n_uniq_other_redmed_seed", "n_uniq_redmed_inside", "n_uniq_not_seed_yes_inside", "n_uniq_not_seed_not_inside",
+           "n_uniq_google_alone", "n_uniq_google_pill", "n_uniq_google", "n_uniq_not_redmed_yes_google", "n_uniq_not_redmed_not_google",
+           "n_ungs"]
+
+# columns of the sweep output files that file_metrics uses
+INPUT_COLUMNS = ["GPT-3 term", "seed for prompt", "Seed of GPT-3 term in RedMed", "RedMed term inside GPT-3 term", "GPT-3 term in Google", "GPT-3 term + pill in Google", "Google"]
+
+# bump when file_metrics changes, so cached metrics are recomputed
+METRICS_VERSION = 1
+
+
+# returns the metrics of each seed for one sweep output file (see
+# run_store.map_runs)
+#
+# params:
+# f (str) - file name
+# file_columns (list) - columns of the file
+# df (DataFrame) - typed rows of the file
+# seeds (list) - index terms to compute the metrics for
+def analyze_file(f, file_columns, df, seeds):
+    drug_names = load_lexicon().drug_names
+    return {seed: file_metrics(df, seed, drug_names) for seed in seeds}
+
+
+# returns the analysis DataFrame of each seed for the sweep output files in a
+# directory (or dataset). metrics of files that haven't changed since they
+# were cached are reused. the other files are read once for all seeds, on a
+# process pool for a directory of csvs, or in one scan of a dataset
+#
+# params:
+# d (str) - directory of parameter sweep output files, or a dataset of them
+# seeds (list) - index terms
+# cache (dict) - metrics cache (see run_store.load_cache), keyed by (absolute
+#                path, seed), updated in place
+# workers (int) - number of worker processes
+def analyze_dir(d, seeds, cache, workers):
+    sources = source_files(d)
+    fs = [s["file"] for s in sources]
+    extra = (METRICS_VERSION, source_fingerprint(LEXICON_PATH))
+
+    todo = []
+    fingerprints = dict()
+    for s in sources:
+        f = s["file"]
+        path = os.path.abspath(os.path.join(d, f))
+        fingerprints[f] = file_fingerprint(s, extra)
+        if any(cache.get((path, seed), (None,))[0] != fingerprints[f] for seed in seeds):
+            todo.append(f)
+    print("%d of %d files to analyze (%d cached)" % (len(todo), len(fs), len(fs) - len(todo)))
+
+    results = map_runs(d, partial(analyze_file, seeds=seeds), todo, columns=INPUT_COLUMNS, seeds=seeds, workers=workers)
+    for f, metrics in tqdm(results, total=len(todo)):
+        path = os.path.abspath(os.path.join(d, f))
+        for seed, m in metrics.items():
+            cache[(path, seed)] = (fingerprints[f], m)
+
+    dfs = dict()
+    for seed in seeds:
+        rows = [dict(params_from_fname(f), **cache[(os.path.abspath(os.path.join(d, f)), seed)][1]) for f in fs]
+        dfs[seed] = pd.DataFrame(rows, columns=COLUMNS)
+    return dfs
 
 
 def main(args):
-    fs = os.listdir(args.d)
-    fs = [f for f in fs if os.path.isfile(os.path.join(args.d, f))]
-
-    dic = dict()
-    dic["model"] = []
-    dic["temp"] = []
-    dic["freq"] = []
-    dic["pres"] = []
-    dic["prompts"] = []
-    dic["queries_per_prompt"] = []
-    dic["counter"] = []
-    dic["n_terms"] = []
-    dic["n_uniq"] = []
-    dic["n_terms_same_redmed_seed"] = []
-    dic["n_terms_other_redmed_seed"] = []
-    dic["n_terms_redmed_inside"] = []
-    dic["n_terms_not_seed_yes_inside"] = []
-    dic["n_terms_not_seed_not_inside"] = []
-    dic["n_terms_google_alone"] = []
-    dic["n_terms_google_pill"] = []
-    dic["n_terms_google"] = []
-    dic["n_terms_not_redmed_yes_google"] = []
-    dic["n_terms_not_redmed_not_google"] = []
-    dic["n_uniq_same_redmed_seed"] = []
-    dic["n_uniq_other_redmed_seed"] = []
-    dic["n_uniq_redmed_inside"] = []
-    dic["n_uniq_not_seed_yes_inside"] = []
-    dic["n_uniq_not_seed_not_inside"] = []
-    dic["n_uniq_google_alone"] = []
-    dic["n_uniq_google_pill"] = []
-    dic["n_uniq_google"] = []
-    dic["n_uniq_not_redmed_yes_google"] = []
-    dic["n_uniq_not_redmed_not_google"] = []
-    dic["n_ungs"] = []
-
-    redmed_df = pd.read_csv("redmed_lexicon.tsv",sep="\t")
-
-    for f in tqdm(fs):
-        model, _, temp, _, freq, _, pres, _, prompts, _, _, _, queries_per_prompt, _, counter = f[:-4].split("_")
-        dic["model"].append(model)
-        dic["temp"].append(float(temp) / 100)
-        dic["freq"].append(float(freq) / 100)
-        dic["pres"].append(float(pres) / 100)
-        dic["prompts"].append(prompts)
-        dic["queries_per_prompt"].append(queries_per_prompt)
-        dic["counter"].append(counter)
-
-        df = pd.read_csv(os.path.join(args.d, f))
-        df = df.loc[df["seed for prompt"] == args.seed]
-
-        # number of terms generated
-        dic["n_terms"].append(len(df))
-
-        # number of unique terms generated
-        dic["n_uniq"].append(len(df["GPT-3 term"].unique()))
-
-        # number of terms in redmed under the same seed
-        tmp = df.loc[df["Seed of GPT-3 term in RedMed"] == args.seed]
-        dic["n_terms_same_redmed_seed"].append(len(tmp))
-        dic["n_uniq_same_redmed_seed"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms in redmed under a different seed
-        not_redmed = df.loc[df["Seed of GPT-3 term in RedMed"] != args.seed]
-        tmp = not_redmed.loc[not_redmed["Seed of GPT-3 term in RedMed"] != "False"]
-        dic["n_terms_other_redmed_seed"].append(len(tmp))
-        dic["n_uniq_other_redmed_seed"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms with a redmed term inside of them
-        tmp = df.loc[df["RedMed term inside GPT-3 term"]]
-        dic["n_terms_redmed_inside"].append(len(tmp))
-        dic["n_uniq_redmed_inside"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms that are not in redmed but have a redmed term inside of them
-        tmp = not_redmed.loc[not_redmed["RedMed term inside GPT-3 term"]]
-        dic["n_terms_not_seed_yes_inside"].append(len(tmp))
-        dic["n_uniq_not_seed_yes_inside"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms that are not in redmed and don't have a redmed term inside of them
-        tmp = not_redmed.loc[-not_redmed["RedMed term inside GPT-3 term"]]
-        dic["n_terms_not_seed_not_inside"].append(len(tmp))
-        dic["n_uniq_not_seed_not_inside"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms validated by google
-        tmp = df.loc[df["GPT-3 term in Google"] == "True"]
-        google_terms = tmp["GPT-3 term"].tolist()
-        dic["n_terms_google_alone"].append(len(tmp))
-        dic["n_uniq_google_alone"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms validated by google when adding "pill"
-        tmp = df.loc[df["GPT-3 term + pill in Google"] == "True"]
-        dic["n_terms_google_pill"].append(len(tmp))
-        dic["n_uniq_google_pill"].append(len(tmp["GPT-3 term"].unique()))
-
-        # total number of terms validated by google in some way
-        tmp = df.loc[df["GPT-3 term in Google"] == "False"]
-        tmp = tmp.loc[tmp["GPT-3 term + pill in Google"] == "True"]
-        yes_google_terms = set(google_terms + tmp["GPT-3 term"].tolist())
-        dic["n_terms_google"].append(dic["n_terms_google_alone"][-1] + len(tmp))
-        dic["n_uniq_google"].append(len(yes_google_terms))
-
-        # number of terms not in redmed and not validated by google
-        tmp = not_redmed.loc[not_redmed["GPT-3 term in Google"] == "False"]
-        tmp = tmp.loc[tmp["GPT-3 term + pill in Google"] == "False"]
-        dic["n_terms_not_redmed_not_google"].append(len(tmp))
-        dic["n_uniq_not_redmed_not_google"].append(len(tmp["GPT-3 term"].unique()))
-
-        # number of terms that are not in redmed but are validated by google in some way
-        dic["n_terms_not_redmed_yes_google"].append(len(not_redmed) - dic["n_terms_not_redmed_not_google"][-1])
-        not_redmed_yes_google = set(not_redmed["GPT-3 term"].tolist()).intersection(yes_google_terms)
-        dic["n_uniq_not_redmed_yes_google"].append(len(not_redmed_yes_google))
-
-        # number of UNGSes (unique novel gpt-3 synonyms)
-        # aka unique terms not in redmed that pass google and drug name filter
-        df["pass name filter"] = df.apply(lambda row: not row["GPT-3 term"] in redmed_df["drug"].tolist() or row["GPT-3 term"] == row["seed for prompt"], axis=1)
-        pass_name_filter = set(df.loc[df["pass name filter"]]["GPT-3 term"].tolist())
-        dic["n_ungs"].append(len(pass_name_filter.intersection(not_redmed_yes_google)))
-
-    df = pd.DataFrame()
-    for k in dic.keys():
-        df[k] = dic[k]
-    df.to_csv(args.outfname)
+    if len(args.seed) > 1 and not "{seed}" in args.o:
+        raise ValueError("-o must contain {seed} when analyzing several seeds")
+    cache = load_cache(args.cache) if args.cache else dict()
+    dfs = analyze_dir(args.d, args.seed, cache, args.workers)
+    if args.cache:
+        save_cache(cache, args.cache)
+    for seed, df in dfs.items():
+        df.to_csv(args.o.replace("{seed}", seed))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seed', type=str, help="index term (seed term)")
-    parser.add_argument('-d', type=str, help="directory of parameter search output files")
-    parser.add_argument('-o', type=str, help="name of analysis output file")
+    parser.add_argument('--seed', type=str, nargs="+", help="index term(s) (seed terms) to analyze the files for")
+    parser.add_argument('-d', type=str, help="directory of parameter search output files, or a dataset of them (see run_store.py)")
+    parser.add_argument('-o', type=str, help="name of analysis output file. with several seeds, {seed} is replaced by each seed (e.g. {seed}_grid_out.csv)")
+    parser.add_argument('--cache', type=str, help="file caching the metrics of each sweep output file, so that unchanged files aren't read again ('' for no cache)", default="param_sweep_analysis.cache")
+    parser.add_argument('--workers', type=int, help="number of processes to analyze files with", default=os.cpu_count())
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,151 @@
+# daily quota of the Google Custom Search API, shared by every process that
+# uses the same quota database (e.g. several rerun_google.py runs in parallel
+# and gpt_queries.py). usage is counted per API key and per provider day: the
+# Custom Search quota resets at midnight Pacific time. callers spend the quota
+# one query at a time, and low priority callers (e.g. background reruns) can be
+# kept from using the last part of the day's budget so that they don't starve
+# high priority ones
+#
+# to see today's usage:
+# python quota.py quota.db
+
+import argparse
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+
+# timezone whose midnight starts a new quota day
+QUOTA_TZ = "America/Los_Angeles"
+
+
+# raised instead of making a search API query when the quota is used up
+class QuotaExhausted(Exception):
+    pass
+
+
+# returns an identifier for an API key that is safe to store
+#
+# params:
+# key (str) - API key
+def key_id(key):
+    return hashlib.sha256((key or "").encode()).hexdigest()[:16]
+
+
+# params:
+# path (str) - database file (created if it doesn't exist)
+# limit (int) - number of queries allowed per day
+# key (str) - API key the quota belongs to (defaults to GOOGLE_API_KEY)
+# reserve (int) - number of queries at the end of each day's budget that only
+#                 priority 0 callers may spend
+# clock (function) - returns the current time in seconds since the epoch (can
+#                    be replaced for testing)
+# tz (str) - timezone of the provider's day boundary
+class QuotaManager:
+    def __init__(self, path, limit=10000, key=None, reserve=0, clock=time.time, tz=QUOTA_TZ):
+        if key is None:
+            key = os.environ.get("GOOGLE_API_KEY")
+        self.path = path
+        self.limit = limit
+        self.key = key_id(key)
+        self.reserve = reserve
+        self.clock = clock
+        self.tz = ZoneInfo(tz)
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS usage (key TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (key, day))")
+
+    # returns this thread's connection to the database
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.local.conn = conn
+        return conn
+
+    # returns the current provider day (as YYYY-MM-DD)
+    def day(self):
+        return datetime.datetime.fromtimestamp(self.clock(), self.tz).date().isoformat()
+
+    # returns the number of seconds until the quota resets. subtracted as
+    # timestamps, since datetimes in the same timezone subtract as wall clock
+    # times (off by an hour on the days daylight saving starts or ends)
+    def seconds_until_reset(self):
+        now = self.clock()
+        today = datetime.datetime.fromtimestamp(now, self.tz).date()
+        midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time(), self.tz)
+        return midnight.timestamp() - now
+
+    # returns the number of queries used today
+    def used(self):
+        row = self.connect().execute("SELECT used FROM usage WHERE key = ? AND day = ?", (self.key, self.day())).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    # returns the number of queries a caller with the given priority may still
+    # make today
+    #
+    # params:
+    # priority (int) - 0 for high priority, anything else for low priority
+    def remaining(self, priority=0):
+        limit = self.limit if priority == 0 else self.limit - self.reserve
+        return max(0, limit - self.used())
+
+    # takes n queries from today's quota if there are enough left. returns
+    # whether they were taken
+    #
+    # params:
+    # n (int) - number of queries
+    # priority (int) - 0 for high priority, anything else for low priority
+    def try_spend(self, n=1, priority=0):
+        limit = self.limit if priority == 0 else self.limit - self.reserve
+        day = self.day()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT used FROM usage WHERE key = ? AND day = ?", (self.key, day)).fetchone()
+            used = 0 if row is None else row[0]
+            if used + n > limit:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO usage VALUES (?, ?, ?)", (self.key, day, used + n))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    # like try_spend, but raises QuotaExhausted if the queries can't be taken
+    #
+    # params:
+    # n (int) - number of queries
+    # priority (int) - 0 for high priority, anything else for low priority
+    def spend(self, n=1, priority=0):
+        if not self.try_spend(n, priority):
+            raise QuotaExhausted("search API quota used up for %s (resets in %d s)" % (self.day(), self.seconds_until_reset()))
+
+    # raises today's usage to at least n (e.g. to account for queries made
+    # without the quota manager)
+    #
+    # params:
+    # n (int) - number of queries known to be used today
+    def record_usage_at_least(self, n):
+        day = self.day()
+        conn = self.connect()
+        conn.execute("INSERT INTO usage VALUES (?, ?, ?) ON CONFLICT (key, day) DO UPDATE SET used = MAX(used, excluded.used)", (self.key, day, n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help="quota database")
+    parser.add_argument('--limit', type=int, help="number of queries allowed per day", default=10000)
+    args = parser.parse_args()
+
+    quota = QuotaManager(args.path, args.limit)
+    print("%s: %d of %d queries used, resets in %.1f hours" % (quota.day(), quota.used(), quota.limit, quota.seconds_until_reset() / 3600))
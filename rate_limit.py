@@ -0,0 +1,129 @@
+# token-bucket rate limiting for API requests. used in place of a fixed sleep
+# after every query so that requests can be spaced out (or run concurrently)
+# according to the actual rate limit of the API being used
+
+import asyncio
+import threading
+import time
+
+
+# a token bucket that refills at a constant rate. a caller reserves some number
+# of tokens and is told how long to wait before using them; the bucket is allowed
+# to go into debt so that callers are served in the order they reserve, and a
+# request bigger than the bucket just waits for the equivalent refill time.
+# safe to share between threads and between tasks on one event loop
+#
+# params:
+# rate (float) - tokens added to the bucket per second
+# capacity (float) - maximum number of tokens the bucket holds (i.e. the largest
+#                    burst allowed). defaults to one second's worth of tokens
+# clock (function) - monotonic clock to use (can be replaced for testing)
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        if capacity is None:
+            capacity = rate
+        self.capacity = max(capacity, 1)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    # takes n tokens from the bucket and returns the number of seconds the
+    # caller must wait before it can act on them (0 if it can act immediately)
+    #
+    # params:
+    # n (float) - number of tokens to take
+    def reserve(self, n=1):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # gives back tokens that were reserved but not used (e.g. when a request
+    # turned out to be smaller than estimated)
+    #
+    # params:
+    # n (float) - number of tokens to give back
+    def refund(self, n):
+        if n <= 0:
+            return
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+    # blocks until n tokens are available
+    #
+    # params:
+    # n (float) - number of tokens to take
+    def acquire(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    # waits (without blocking the event loop) until n tokens are available
+    #
+    # params:
+    # n (float) - number of tokens to take
+    async def acquire_async(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# rate limiter for completion requests, which are limited both in requests per
+# minute and in tokens per minute (prompt tokens + max tokens of the completion)
+#
+# params:
+# rpm (float) - requests per minute
+# tpm (float) - tokens per minute
+# clock (function) - monotonic clock to use (can be replaced for testing)
+class CompletionLimiter:
+    def __init__(self, rpm, tpm, clock=time.monotonic):
+        self.requests = TokenBucket(rpm / 60, clock=clock)
+        self.tokens = TokenBucket(tpm / 60, clock=clock)
+
+    # seconds to wait before sending a request of the given size
+    #
+    # params:
+    # n_tokens (int) - estimated number of tokens the request will use
+    def reserve(self, n_tokens):
+        return max(self.requests.reserve(1), self.tokens.reserve(n_tokens))
+
+    # params:
+    # n_tokens (int) - estimated number of tokens the request will use
+    def acquire(self, n_tokens):
+        delay = self.reserve(n_tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    # params:
+    # n_tokens (int) - estimated number of tokens the request will use
+    async def acquire_async(self, n_tokens):
+        delay = self.reserve(n_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # corrects the token count once the real usage of a request is known
+    #
+    # params:
+    # estimated (int) - number of tokens that were reserved for the request
+    # used (int) - number of tokens the request actually used
+    def settle(self, estimated, used):
+        self.tokens.refund(estimated - used)
+
+
+# rough number of tokens a completion request will count against the
+# tokens-per-minute limit (~4 characters per token for the prompt, plus the
+# maximum length of the completion, which the API reserves up front)
+#
+# params:
+# prompt (str) - prompt text
+# maxt (int) - maximum number of tokens for the completion
+def estimate_tokens(prompt, maxt):
+    return len(prompt) // 4 + 1 + maxt
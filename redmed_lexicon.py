@@ -0,0 +1,173 @@
+# shared loader for the RedMed lexicon (redmed_lexicon.tsv), used by every
+# script that needs it. the TSV is parsed once into a compiled snapshot (a
+# pickle next to the TSV, <tsv>.snapshot) holding everything the scripts look
+# up: the exploded term lists of each drug, the set of drug names, the
+# candidate prompt examples of each drug and an inverted index from terms to
+# drugs. the snapshot is rebuilt automatically when the TSV changes, so loading
+# the lexicon costs one unpickle instead of a pd.read_csv
+#
+# to (re)build the snapshot by hand:
+# python redmed_lexicon.py [redmed_lexicon.tsv]
+
+import argparse
+import os
+import pickle
+import pandas as pd
+
+
+LEXICON_PATH = "redmed_lexicon.tsv"
+
+# bump when the contents of the snapshot change, so old snapshots are rebuilt
+SNAPSHOT_VERSION = 1
+
+# columns of the RedMed lexicon that hold comma-separated surface forms of
+# each drug (the drug name itself is included so index terms map to themselves)
+TERM_COLUMNS = ["drug", "known", "misspellingPhon", "edOne", "edTwo", "pillMark", "google_ms", "google_title", "google_snippet", "ud_slang"]
+
+# columns that prompt examples are sampled from (only single words of known)
+EXAMPLE_COLUMNS = ["known", "misspellingPhon", "edOne", "edTwo", "pillMark"]
+
+
+# builds an inverted index mapping every surface form in the RedMed lexicon
+# to the drug(s) it belongs to, in lexicon order. build this once at load time
+# and pass it to find_seed_for_term instead of rescanning the lexicon per term
+#
+# params:
+# redmed (DataFrame) - RedMed lexicon in a pandas DataFrame
+def build_term_index(redmed):
+    index = dict()
+    for row in redmed[TERM_COLUMNS].itertuples(index=False):
+        drug = row[0]
+        for col in row:
+            if not isinstance(col, str): # empty cells are read in as NaN
+                continue
+            for t in col.split(","):
+                owners = index.setdefault(t, [])
+                if not drug in owners:
+                    owners.append(drug)
+    return index
+
+
+# searches for a term in the whole redmed lexicon
+# if that term is present in the lexicon, will return the seed term it belongs to
+# if that term is not present in the lexicon, will return False
+#
+# params:
+# term (str) - GPT-3 generated term
+# index (dict) - term index of the redmed lexicon (from build_term_index)
+def find_seed_for_term(term, index):
+    owners = index.get(term)
+    if not owners:
+        return [False, ""]
+    else:
+        return [True, owners[0]]
+
+
+# obtains all the candidate redmed synonyms to sample from for a prompt
+#
+# params:
+# terms (dict) - term lists of one drug, keyed by column (see Lexicon.terms)
+def get_candidate_examples(terms):
+    examples = set()
+    for col in EXAMPLE_COLUMNS: # only include misspellings and pillmarks, and single words in known
+        l = terms[col]
+        if len(l) <= 1:
+            if l == "" or l == ["-"]:
+                continue
+        for t in l:
+            if col != "known" or len(t.split("_")) == 1:
+                examples.add(t)
+    return examples
+
+
+# the compiled contents of the RedMed lexicon
+#
+# params:
+# redmed (DataFrame) - RedMed lexicon in a pandas DataFrame
+class Lexicon:
+    def __init__(self, redmed):
+        # drug names in lexicon order, and as a set for membership tests
+        self.drugs = redmed["drug"].tolist()
+        self.drug_names = set(self.drugs)
+        # DrugBank ID of each drug
+        self.dbids = dict(zip(redmed["drug"], redmed["dbid"]))
+        # terms[drug][column] is the list of terms in that cell
+        self.terms = dict()
+        for row in redmed[["drug"] + TERM_COLUMNS[1:]].itertuples(index=False):
+            cells = dict()
+            for col, cell in zip(TERM_COLUMNS, row):
+                cells[col] = cell.split(",") if isinstance(cell, str) else []
+            self.terms.setdefault(row[0], cells)
+        # candidate prompt examples of each drug
+        self.candidates = {drug: get_candidate_examples(cells) for drug, cells in self.terms.items()}
+        self.index = build_term_index(redmed)
+
+    # returns the drug a term belongs to, like find_seed_for_term
+    #
+    # params:
+    # term (str) - GPT-3 generated term
+    def find_seed_for_term(self, term):
+        return find_seed_for_term(term, self.index)
+
+
+# identifies the version of the TSV a snapshot was built from
+#
+# params:
+# path (str) - lexicon TSV
+def source_fingerprint(path):
+    st = os.stat(path)
+    return (SNAPSHOT_VERSION, st.st_size, st.st_mtime_ns)
+
+
+# parses the TSV and writes a fresh snapshot. returns the Lexicon
+#
+# params:
+# path (str) - lexicon TSV
+def build_snapshot(path=LEXICON_PATH):
+    fingerprint = source_fingerprint(path)
+    lexicon = Lexicon(pd.read_csv(path, sep="\t"))
+    tmp = path + ".snapshot.%d.tmp" % os.getpid()
+    with open(tmp, "wb") as f:
+        pickle.dump((fingerprint, lexicon), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path + ".snapshot")
+    return lexicon
+
+
+# loaded lexicons, by TSV path, with the fingerprint they were built from
+loaded = dict()
+
+
+# returns the Lexicon for a TSV, from the snapshot if it is up to date
+# (rebuilding it otherwise). repeated calls in one process share one Lexicon,
+# so treat it as read-only
+#
+# params:
+# path (str) - lexicon TSV
+def load_lexicon(path=LEXICON_PATH):
+    fingerprint = source_fingerprint(path)
+    if path in loaded and loaded[path][0] == fingerprint:
+        return loaded[path][1]
+    lexicon = None
+    try:
+        with open(path + ".snapshot", "rb") as f:
+            built_from, lexicon = pickle.load(f)
+        if built_from != fingerprint:
+            lexicon = None
+    except Exception: # missing, partially written or from an older version
+        lexicon = None
+    if lexicon is None:
+        lexicon = build_snapshot(path)
+    loaded[path] = (fingerprint, lexicon)
+    return lexicon
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs="?", help="lexicon TSV to build the snapshot of", default=LEXICON_PATH)
+    args = parser.parse_args()
+
+    # build through the imported module so that the pickled Lexicon refers to
+    # redmed_lexicon.Lexicon rather than __main__.Lexicon
+    import redmed_lexicon
+    lexicon = redmed_lexicon.build_snapshot(args.path)
+    print("wrote %s.snapshot (%d drugs, %d terms)" % (args.path, len(lexicon.drugs), len(lexicon.index)))
@@ -5,9 +5,15 @@
 
 import pandas as pd
 import argparse
-import redmed_gpt
+import glob
+import os
+import time
+from collections import Counter
+from google_search import SEARCH_URL, SearchEngine
+from memo_store import open_memo
+from quota import QuotaManager
+from retry import RetryPolicy
 from tqdm import tqdm
-import pickle
 
 
 # creates an entirely new DataFrame with the re-Googled results
@@ -17,37 +23,23 @@ import pickle
 # small (bool) - flag to create small version of df for testing purposes
 #                will only create a new df with a max of 30 rows
 def make_df(args, small=False):
-    try:
-        memo = pickle.load(open(args.memo,"rb"))
-    except:
-        memo = dict()
+    memo = open_memo(args.memo, ttl=args.memo_ttl_days * 86400, max_bytes=int(args.memo_max_mb * 1e6))
 
     df = pd.read_csv(args.f, index_col=0)
 
-    results = []
-    added = []
-    depths = []
-
+    rows = df
     if small:
-        counter = 0
-    for _, row in tqdm(df.iterrows()):
-        if small:
-            if counter == 30:
-                break
-            else:
-                counter += 1
-        for google_add in ["", " pill", " drug", " slang"]:
-            google, depth, memo = redmed_gpt.in_google_search(row["GPT-3 term"] + google_add, row["seed for prompt"], memo, depth=args.depth)
-            if google == True:
-                break
-        if google != True:
-            google_add = None
-
-        results.append(google)
-        added.append(google_add)
-        depths.append(depth)
-        
-    pickle.dump(memo, open(args.memo, "wb"))
+        rows = df.head(30)
+    quota = QuotaManager(args.quota_db, args.daily_limit, reserve=args.reserve)
+    engine = SearchEngine(memo, depth=args.depth, qps=args.qps, workers=args.workers, url=args.search_url, policy=RetryPolicy(max_attempts=args.max_attempts), quota=quota, priority=args.priority)
+    validations = engine.validate_many(list(zip(rows["GPT-3 term"], rows["seed for prompt"])))
+    print("search API: %s" % engine.policy.summary())
+    results = [v[0] for v in validations]
+    added = [v[1] for v in validations]
+    depths = [v[2] for v in validations]
+
+    engine.close()
+    memo.close()
     
     df = df.drop(labels=["GPT-3 term in Google","GPT-3 term + pill in Google"],axis=1)
     if small:
@@ -58,82 +50,189 @@ def make_df(args, small=False):
     df.to_csv(args.f.split("/")[-1][:-4] + args.suffix + ".csv")
 
 
-# reruns Google search and updates the pipeline-created csv with an additional
-# column that has the new Google information
+# returns the CSV files to update for the -f argument: the file itself, every
+# CSV in a directory, or the files matching a glob pattern
 #
 # params:
-# args (argparse.Namespace) - command line args
-def update_df(args):
-    api_count = args.count_start
-    try:
-        memo = pickle.load(open(args.memo,"rb"))
-    except:
-        memo = dict()
+# pattern (str) - file, directory or glob pattern
+def input_files(pattern):
+    if os.path.isfile(pattern):
+        return [pattern]
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, "*.csv")))
+    return sorted(glob.glob(pattern))
+
+
+# returns the names of the Google filter result and added token columns of a
+# pipeline-created csv, and whether it has a Google depth column (older runs
+# use different column names and don't record the depth)
+#
+# params:
+# df (DataFrame) - output of pipeline run
+def google_columns(df):
+    if "Google" in df.columns:
+        return "Google", "Google added token", True
+    return "GPT-3 term in Google", "token added to Google", False
 
-    df = pd.read_csv(args.f, index_col=0)
-    updates = []
 
-    if "Google" in df.columns:
-        google_col = "Google"
-        added_col = "Google added token"
-        keeps_depth = True
-    else:
-        google_col = "GPT-3 term in Google"
-        added_col = "token added to Google"
-        keeps_depth = False
-
-    for idx, row in tqdm(df.iterrows()):
-        try:
-            if row[google_col] != "Error" and not "_" in row["GPT-3 term"]:
-                continue
-        except:
-            continue
-
-        ud = dict()
-        ud["idx"] = idx
-
-        for google_add in ["", " pill", " drug", " slang"]:
-            google, depth, memo, googled = redmed_gpt.in_google_search(str(row["GPT-3 term"]) + google_add, row["seed for prompt"], memo, depth=args.depth, count=True, offline=args.offline)
-            if googled:
-                api_count += 1
-            if google == True:
+# returns the rows whose Google filter should be rerun (those whose search
+# errored, and multi-token terms) as a list of (index, term, seed) tuples
+#
+# params:
+# df (DataFrame) - output of pipeline run
+# google_col (str) - name of the Google filter result column
+def rows_to_rerun(df, google_col):
+    terms = df["GPT-3 term"]
+    is_str = terms.map(lambda t: isinstance(t, str))
+    multi_token = terms.where(is_str, "").str.contains("_", regex=False)
+    rerun = (df[google_col] == "Error") | (is_str & multi_token)
+    return list(zip(df.index[rerun], terms[rerun].astype(str), df["seed for prompt"][rerun]))
+
+
+# writes a csv in place without ever leaving a partially written file behind
+#
+# params:
+# df (DataFrame) - DataFrame to write
+# fname (str) - name of csv file
+def write_csv_atomic(df, fname):
+    tmp = fname + ".%d.tmp" % os.getpid()
+    df.to_csv(tmp)
+    os.replace(tmp, fname)
+
+
+# reruns Google search and updates pipeline-created csvs with the new Google
+# information. the (term, seed) pairs to rerun are collected from all the files
+# first, so that a pair appearing in several files (and every search with a
+# suffix added to its term) is only checked once, and are then validated by a
+# pool of search workers sharing one memo. each file is rewritten as soon as
+# all of its pairs are done. returns the search engine, for its counters
+#
+# params:
+# args (argparse.Namespace) - command line args
+# fnames (list) - names of csv files to update
+def update_files(args, fnames):
+    memo = open_memo(args.memo, ttl=args.memo_ttl_days * 86400, max_bytes=int(args.memo_max_mb * 1e6))
+    quota = QuotaManager(args.quota_db, args.daily_limit, reserve=args.reserve)
+    quota.record_usage_at_least(args.count_start)
+
+    files = []
+    counts = Counter()
+    for fname in fnames:
+        df = pd.read_csv(fname, index_col=0)
+        google_col, added_col, keeps_depth = google_columns(df)
+        rows = rows_to_rerun(df, google_col)
+        counts.update(df["GPT-3 term"].astype(str))
+        files.append(dict(fname=fname, df=df, columns=(google_col, added_col, keeps_depth), rows=rows, pending=set((term, seed) for _, term, seed in rows), written=False))
+
+    # spend the quota on the pairs that are cheapest to check first (those
+    # whose first page is already in the memo), then on the terms generated
+    # most often. pairs of the same term end up in the same chunk, so that all
+    # their seeds are checked in one pass over each page
+    todo = list(dict.fromkeys((term, seed) for f in files for _, term, seed in f["rows"]))
+    todo.sort(key=lambda job: (memo.get_page(job[0].replace("_"," "), 1) is None, -counts[job[0]], job[0]))
+    n_rows = sum(len(f["rows"]) for f in files)
+    print("%d rows to rerun in %d files (%d distinct term/seed pairs)" % (n_rows, len(files), len(todo)))
+
+    files_by_job = dict()
+    for f in files:
+        for job in f["pending"]:
+            files_by_job.setdefault(job, []).append(f)
+
+    # applies the results gathered so far to one file and writes it
+    def write_file(f):
+        df = f["df"]
+        google_col, added_col, keeps_depth = f["columns"]
+        done = [(idx, results[(term, seed)]) for idx, term, seed in f["rows"] if (term, seed) in results]
+        for idx, (google, google_add, depth, n_googled) in done:
+            df.at[idx, google_col] = google
+            df.at[idx, added_col] = google_add
+            if keeps_depth:
+                df.at[idx, "Google depth"] = depth
+        write_csv_atomic(df, f["fname"])
+        f["written"] = True
+        return len(done)
+
+    # validate in chunks so that the quota is checked regularly (and finished
+    # files are written) while still keeping all search workers busy
+    engine = SearchEngine(memo, depth=args.depth, offline=args.offline, qps=args.qps, workers=args.workers, url=args.search_url, policy=RetryPolicy(max_attempts=args.max_attempts), quota=quota, priority=args.priority)
+    results = dict()
+    n_written = 0
+    started = time.time()
+    chunk_size = max(args.workers, 1) * 4
+    with tqdm(total=len(todo)) as pbar:
+        for chunk_start in range(0, len(todo), chunk_size):
+            chunk = todo[chunk_start:chunk_start + chunk_size]
+            for job, validation in zip(chunk, engine.validate_many(chunk)):
+                results[job] = validation
+                for f in files_by_job[job]:
+                    f["pending"].discard(job)
+            pbar.update(len(chunk))
+
+            for f in files:
+                if not f["written"] and len(f["pending"]) == 0:
+                    n_updated = write_file(f)
+                    n_written += 1
+                    elapsed = time.time() - started
+                    pbar.write("[%d/%d] %s: %d rows updated (%.1f pairs/s, %d search API queries)" % (n_written, len(files), f["fname"], n_updated, len(results) / max(elapsed, 1e-9), engine.n_api_queries))
+
+            if not args.offline and quota.remaining(args.priority) == 0:
+                pbar.write("Search API query quota exceeded. Exiting...")
                 break
-        if google != True:
-            google_add = None
 
-        ud[google_col] = google
-        ud[added_col] = google_add
-        if keeps_depth:
-            ud["Google depth"] = depth
-        updates.append(ud)
+    # files with pairs left over (the quota ran out) keep whatever was done
+    for f in files:
+        if not f["written"]:
+            n_updated = write_file(f)
+            print("%s: %d of %d rows updated" % (f["fname"], n_updated, len(f["rows"])))
 
-        if api_count >= 10000:
-            print("Search API query quota exceeded. Exiting...")
-            break
+    engine.close()
+    memo.close()
+    elapsed = time.time() - started
+    print("%d term/seed pairs validated in %.1f s (%.1f pairs/s)" % (len(results), elapsed, len(results) / max(elapsed, 1e-9)))
+    print("search API: %s" % engine.policy.summary())
+    print("%d of %d search API queries used today" % (quota.used(), quota.limit))
+    return engine
 
-    for ud in updates:
-        df.at[ud["idx"], google_col] = ud[google_col]
-        df.at[ud["idx"], added_col] = ud[added_col]
-        if keeps_depth:
-            df.at[ud["idx"], "Google depth"] = ud["Google depth"]
 
-    pickle.dump(memo, open(args.memo, "wb"))
-    df.to_csv(args.f)
-    print(api_count)
+# reruns Google search and updates the pipeline-created csv(s) given by -f (a
+# file, directory or glob pattern) with the new Google information. returns
+# the search engine, for its counters
+#
+# params:
+# args (argparse.Namespace) - command line args
+def update_df(args):
+    fnames = input_files(args.f)
+    if len(fnames) == 0:
+        raise ValueError("no csv files found for %s" % args.f)
+    return update_files(args, fnames)
 
 
 def main(args):
-    update_df(args)
+    return update_df(args)
 
 
-if __name__ == "__main__":
+# returns the parser for the command line arguments
+def get_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', type=str, help="file of gpt3 outputs on which to rerun google")
-    parser.add_argument('--memo', type=str, help="memo file name to reduce API requests", default="memo.p")
+    parser.add_argument('-f', type=str, help="file of gpt3 outputs on which to rerun google, or a directory or glob pattern (quote it) of such files to update together")
+    parser.add_argument('--memo', type=str, help="memo file name to reduce API requests. .p files are read and written as pickles, .shards directories hold a sharded SQLite memo, anything else is a SQLite database", default="memo.p")
+    parser.add_argument('--memo_ttl_days', type=float, help="days after which memoized searches expire and are searched for again. 0 to keep them forever (not supported for .p memos)", default=0)
+    parser.add_argument('--memo_max_mb', type=float, help="size bound of the memoized result pages in MB, least recently used pages are evicted past it. 0 for no bound (not supported for .p memos)", default=0)
     parser.add_argument('--depth', type=int, help="how deep to go for google search filter", default=10)
     parser.add_argument('--suffix', type=str, help="suffix to append to new filename")
-    parser.add_argument('--count_start', type=int, help="current Google Search API query count for the day", default=0)
+    parser.add_argument('--count_start', type=int, help="Google Search API queries already used today that the quota database doesn't know about", default=0)
+    parser.add_argument('--quota_db', type=str, help="SQLite file tracking the daily Google Search API quota, shared by all runs", default="quota.db")
+    parser.add_argument('--daily_limit', type=int, help="Google Search API queries allowed per day", default=10000)
+    parser.add_argument('--priority', type=int, help="0 to spend all of the daily quota, 1 to leave the last --reserve queries to priority 0 runs", default=0)
+    parser.add_argument('--reserve', type=int, help="queries at the end of each day's quota reserved for priority 0 runs", default=500)
     parser.add_argument('--offline', action="store_true", help="Flag to not use Google API, only memoized results")
-    args = parser.parse_args()
+    parser.add_argument('--qps', type=float, help="maximum number of Google search API queries per second (default: one query every 1.5 s)", default=1 / 1.5)
+    parser.add_argument('--workers', type=int, help="maximum number of Google searches in flight at once", default=8)
+    parser.add_argument('--search_url', type=str, help="Google Custom Search API endpoint (e.g. a local test server)", default=SEARCH_URL)
+    parser.add_argument('--max_attempts', type=int, help="maximum number of tries for each Google search API query before giving up on it (rate limited and transient errors are retried with backoff)", default=8)
+    return parser
+
 
+if __name__ == "__main__":
+    args = get_parser().parse_args()
     main(args)
@@ -0,0 +1,212 @@
+# re-scores the Google filter of pipeline output csvs for a different depth
+# cutoff (or set of suffixes) from the memo alone, without running any searches.
+# the memo records the depth at which each index term first appears in the
+# search results for each searched term, and its pages show how far down the
+# results have been looked at, so all memoized results are loaded into one
+# table and every row of every csv is re-scored with a few vectorised lookups.
+# (index terms that weren't found are looked for again in their query's pages
+# while loading, which walks those pages once per query.) rows that can't be
+# decided from the memo (results never searched, or not searched deep enough
+# for the new cutoff) get "Error", like searches that fail in the pipeline, so
+# that rerun_google.py can fill them in later.
+# the cutoff is applied to the exact depth, as in filter_eval.py: at a cutoff
+# of 5 only index terms within the first 5 results pass. the pipeline checks
+# whole pages of 10 results (its --depth 5 passes an index term at result 8),
+# so the two agree on cutoffs that are multiples of 10
+#
+# e.g. to re-score data/big_run at depths 10, 20 and 30:
+# python rescore.py -d data/big_run --memo memo.db --depth 10 20 30 --outdir rescored
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from google_search import SUFFIXES
+from memo_store import open_memo
+from rerun_google import google_columns, input_files, write_csv_atomic
+from term_matcher import seeds_matcher
+
+
+# returns a DataFrame of every memoized result, indexed by (query, seed), with
+# the depth at which the seed first appears (-1 if it doesn't in the memo's
+# pages) and how many results of the query the pages cover (inf if they cover
+# all of them)
+#
+# params:
+# memo (PickleMemo or SqliteMemo) - memo of Google searches (see memo_store.py)
+def load_results(memo):
+    results = pd.DataFrame(memo.result_rows(), columns=["query", "seed", "result", "depth"])
+    pages = pd.DataFrame(memo.page_rows(), columns=["query", "start", "total", "has_items"])
+
+    # a search walks pages 1, 11, 21, ... until it has seen every result, so
+    # the results of a query are covered up to the end of the first run of
+    # consecutive usable pages (a page without items is a failed search,
+    # unless it is past the last result)
+    pages = pages[pages["has_items"] | (pages["total"] < pages["start"])].sort_values(["query", "start"])
+    in_run = pages["start"] == 1 + 10 * pages.groupby("query").cumcount()
+    run = pages[in_run.groupby(pages["query"]).cummin()]
+    coverage = (run.groupby("query")["start"].max() + 9).astype(float)
+    complete = run.loc[run["total"] < run["start"] + 10, "query"].unique()
+    coverage[complete] = np.inf
+
+    # a result of -1 only covers the pages its own search looked at, which can
+    # be fewer than the memo holds for the query now (a later search for other
+    # seeds may have gone deeper). as in the pipeline (see
+    # SearchEngine.search_seeds), those seeds are looked for again in the
+    # query's pages
+    results = results.set_index(["query", "seed"])
+    starts = run.groupby("query")["start"].agg(list)
+    misses = results.index[results["depth"].to_numpy() == -1].to_frame(index=False)
+    found_rows = []
+    for query, seeds in misses.groupby("query")["seed"]:
+        if not query in starts.index:
+            continue
+        found, covered = scan_pages(memo, query, starts[query], seeds.unique())
+        found_rows.extend((query, seed, depth) for seed, depth in found.items())
+        if covered is not None:
+            coverage[query] = covered
+    if len(found_rows) > 0:
+        found = pd.DataFrame(found_rows, columns=["query", "seed", "depth"]).set_index(["query", "seed"])["depth"]
+        results.loc[found.index, "result"] = True
+        results.loc[found.index, "depth"] = found
+
+    results["coverage"] = results.index.get_level_values("query").map(coverage).fillna(0.0).to_numpy()
+    return results
+
+
+# looks for seeds in the memoized pages of a query, as a search does. returns
+# the depth at which each seed found first appears, and how many results the
+# pages cover if that is cut short by a result without a title (None if not)
+#
+# params:
+# memo (PickleMemo or SqliteMemo) - memo of Google searches
+# query (str) - searched term
+# starts (list) - start of each page to scan, in order (1, 11, 21, ...)
+# seeds (list) - index terms to look for
+def scan_pages(memo, query, starts, seeds):
+    matcher = seeds_matcher(tuple(sorted(seeds)))
+    found = dict()
+    for start in starts:
+        total, items = memo.get_page(query, start)
+        if items is None:
+            break
+        for idx, (title, snippet) in enumerate(items):
+            if title is None:
+                return found, idx + start - 1
+            hits = matcher.labels_in_tokens(title)
+            if snippet is not None:
+                hits |= matcher.labels_in_tokens(snippet)
+            for seed in hits:
+                if not seed in found:
+                    found[seed] = idx + start
+    return found, None
+
+
+# looks up the memoized result of each row with each suffix added to its term.
+# returns a (known, first hit depth, coverage) tuple of arrays per suffix. the
+# lookups don't depend on the cutoff, so they are shared by all cutoffs
+#
+# params:
+# queries (Series) - searched term of each row ("_" replaced with " ")
+# seeds (Series) - index term of each row
+# results (DataFrame) - memoized results (from load_results)
+# suffixes (list) - suffixes to add to each term, in order
+def lookup(queries, seeds, results, suffixes):
+    lookups = []
+    for suffix in suffixes:
+        r = results.reindex(pd.MultiIndex.from_arrays([queries + suffix, seeds]))
+        lookups.append((r["result"].notna().to_numpy(), r["depth"].fillna(-1).to_numpy(dtype=np.int64), r["coverage"].to_numpy()))
+    return lookups
+
+
+# returns the re-scored Google filter result, added token and depth of each
+# row, as in rerun_google.py: each suffix is added to the term in turn until
+# the seed is found within the cutoff, and a row that doesn't pass gets the
+# result of its last suffix (False, or "Error" if it can't be decided)
+#
+# params:
+# lookups (list) - memoized results of each row (from lookup)
+# suffixes (list) - suffixes added to each term, in the same order
+# depth (int) - depth cutoff
+def rescore(lookups, suffixes, depth):
+    n = len(lookups[0][0])
+    passed = np.zeros(n, dtype=bool)
+    added = np.full(n, None, dtype=object)
+    found_depth = np.full(n, -1, dtype=np.int64)
+    decided = np.zeros(n, dtype=bool)
+    for suffix, (known, hit, coverage) in zip(suffixes, lookups):
+        found = known & (hit != -1) & (hit <= depth)
+        decided = known & (found | (hit > depth) | (coverage >= depth))
+        first = found & ~passed
+        added[first] = suffix
+        found_depth[first] = hit[first]
+        passed |= found
+    google = np.full(n, "Error", dtype=object)
+    google[passed] = True
+    google[~passed & decided] = False
+    return google, added, found_depth
+
+
+# re-scores every csv for each depth cutoff and writes the re-scored copies.
+# returns a DataFrame with the number of rows that pass, fail and can't be
+# decided at each cutoff
+#
+# params:
+# fnames (list) - pipeline output csvs
+# memo (PickleMemo or SqliteMemo) - memo of Google searches
+# depths (list) - depth cutoffs
+# suffixes (list) - suffixes to add to each term, in order
+# outdir (str) - directory to write the re-scored csvs to (in a subdirectory
+#                per cutoff if there is more than one)
+def rescore_files(fnames, memo, depths, suffixes, outdir):
+    results = load_results(memo)
+    dfs = [pd.read_csv(fname, index_col=0) for fname in fnames]
+    sizes = [len(df) for df in dfs]
+    queries = pd.concat([df["GPT-3 term"].astype(str).str.replace("_", " ") for df in dfs], ignore_index=True)
+    seeds = pd.concat([df["seed for prompt"] for df in dfs], ignore_index=True)
+    bounds = np.cumsum([0] + sizes)
+    lookups = lookup(queries, seeds, results, suffixes)
+
+    summary = []
+    for depth in depths:
+        google, added, found_depth = rescore(lookups, suffixes, depth)
+        d = outdir if len(depths) == 1 else os.path.join(outdir, "depth_%d" % depth)
+        os.makedirs(d, exist_ok=True)
+        for fname, df, lo, hi in zip(fnames, dfs, bounds[:-1], bounds[1:]):
+            google_col, added_col, keeps_depth = google_columns(df)
+            out = df.copy()
+            out[google_col] = google[lo:hi]
+            out[added_col] = added[lo:hi]
+            if keeps_depth:
+                out["Google depth"] = found_depth[lo:hi]
+            write_csv_atomic(out, os.path.join(d, os.path.basename(fname)))
+        n_error = int(np.sum(google == "Error"))
+        n_pass = int(np.sum(google == True))
+        summary.append({"depth": depth, "pass": n_pass, "fail": len(google) - n_pass - n_error, "error": n_error})
+    return pd.DataFrame(summary)
+
+
+def main(args):
+    fnames = input_files(args.d)
+    if len(fnames) == 0:
+        raise ValueError("no csv files found for %s" % args.d)
+    suffixes = ["" if s == "none" else " " + s for s in args.suffixes]
+    memo = open_memo(args.memo)
+    start = time.time()
+    summary = rescore_files(fnames, memo, args.depth, suffixes, args.outdir)
+    memo.close()
+    print(summary.to_string(index=False))
+    print("re-scored %d files at %d depths in %.1f s" % (len(fnames), len(args.depth), time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', type=str, help="directory (or file, or quoted glob pattern) of pipeline output csvs to re-score", default="data/big_run")
+    parser.add_argument('--memo', type=str, help="memo file name (as for gpt_queries.py)", default="memo.p")
+    parser.add_argument('--depth', type=int, nargs="+", help="depth cutoff(s) for the Google search filter, applied to the exact depth (the pipeline's --depth checks whole pages of 10 results, so the two only agree on multiples of 10)", default=[10])
+    parser.add_argument('--suffixes', type=str, nargs="+", help="tokens to add to each term, in order, until the filter passes ('none' for the term itself)", default=[s.strip() or "none" for s in SUFFIXES])
+    parser.add_argument('--outdir', type=str, help="directory to write re-scored csvs to (with a depth_<cutoff> subdirectory per cutoff if there are several)", default="rescored")
+    args = parser.parse_args()
+
+    main(args)
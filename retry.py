@@ -0,0 +1,274 @@
+# retry policy for the completion and search API calls. failed calls are
+# classified as rate-limited, transient (worth retrying) or permanent (never
+# worth retrying, e.g. a bad API key or an exhausted daily quota), retried
+# with jittered exponential backoff that honours the Retry-After header, and
+# counted. a circuit breaker shared by all the workers using a policy pauses
+# them all when the upstream looks down (several failures in a row), then lets
+# a single call through to probe whether it is back. QuotaExhausted (raised
+# before a call is made) is passed straight through without being counted
+
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+import openai
+import requests
+from quota import QuotaExhausted
+
+
+RATE_LIMIT = "rate limit"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# reasons in Google API error bodies that mean the per-day quota is used up
+# (retrying won't help until it resets), and that mean requests are too fast
+GOOGLE_QUOTA_REASONS = ["dailyLimitExceeded", "quotaExceeded", "per day"]
+GOOGLE_RATE_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+
+# returns the HTTP status code, headers and body text of the response that
+# caused an exception (None for whatever isn't known)
+#
+# params:
+# e (Exception) - exception raised by an API call
+def error_response(e):
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code, e.response.headers, e.response.text
+    if isinstance(e, openai.error.OpenAIError):
+        return e.http_status, e.headers, e.http_body
+    return None, None, None
+
+
+# returns RATE_LIMIT, TRANSIENT or PERMANENT for an exception raised by an API
+# call. errors without an HTTP response (connection errors, timeouts, responses
+# that couldn't be parsed) are transient
+#
+# params:
+# e (Exception) - exception raised by an API call
+def classify(e):
+    status, headers, body = error_response(e)
+    body = body if isinstance(body, str) else ""
+    if isinstance(e, openai.error.RateLimitError):
+        # the API also answers 429 when the account is out of credit
+        if getattr(e, "code", None) == "insufficient_quota":
+            return PERMANENT
+        return RATE_LIMIT
+    if isinstance(e, (openai.error.AuthenticationError, openai.error.PermissionError, openai.error.InvalidRequestError)):
+        return PERMANENT
+    if status is None:
+        return TRANSIENT
+    if status in [403, 429] and any(reason in body for reason in GOOGLE_QUOTA_REASONS):
+        return PERMANENT
+    if status == 429 or (status == 403 and any(reason in body for reason in GOOGLE_RATE_REASONS)):
+        return RATE_LIMIT
+    if status in [408, 409] or status >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+
+# returns the number of seconds the Retry-After header of the response that
+# caused an exception asks to wait, or None if there isn't one
+#
+# params:
+# e (Exception) - exception raised by an API call
+def retry_after(e):
+    status, headers, body = error_response(e)
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# params:
+# max_attempts (int) - maximum number of calls for one request (the first call
+#                      plus retries) before giving up
+# base (float) - backoff before the first retry, in seconds. doubled for each
+#                further retry, and a random fraction of it is used (full
+#                jitter)
+# cap (float) - maximum backoff in seconds
+# breaker_threshold (int) - number of failures in a row (rate limited or
+#                           transient) that opens the circuit breaker
+# breaker_cooldown (float) - seconds the circuit breaker stays open before a
+#                            probe call is let through
+# clock (function) - monotonic clock to use (can be replaced for testing)
+# sleep (function) - function to block with (can be replaced for testing)
+# rng (random.Random) - random number generator for the jitter
+class RetryPolicy:
+    def __init__(self, max_attempts=8, base=1.0, cap=60.0, breaker_threshold=5, breaker_cooldown=30.0, clock=time.monotonic, sleep=time.sleep, rng=random):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.failures_in_a_row = 0
+        self.open_until = 0.0
+
+        # per-run counters
+        self.n_calls = 0
+        self.n_retries = 0
+        self.n_wasted = 0
+        self.n_given_up = 0
+        self.n_breaker_opens = 0
+        self.errors = Counter()
+        self.latencies = [] # seconds taken by each call
+
+    # seconds to back off before the next call
+    #
+    # params:
+    # attempt (int) - number of calls made so far for this request
+    # e (Exception) - exception raised by the last call
+    def backoff(self, attempt, e):
+        delay = self.rng.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+        wait = retry_after(e)
+        if wait is not None:
+            delay = max(delay, min(wait, self.cap))
+        return delay
+
+    # returns how many seconds a caller must wait for the circuit breaker
+    # before making a call (0 to go ahead). once the breaker's cooldown is
+    # over, the first caller goes ahead as a probe and the others are held
+    # back for another cooldown (or until the probe succeeds)
+    def admit(self):
+        with self.lock:
+            if self.failures_in_a_row < self.breaker_threshold:
+                return 0.0
+            now = self.clock()
+            if now < self.open_until:
+                return min(self.open_until - now, 1.0)
+            self.open_until = now + self.breaker_cooldown
+            return 0.0
+
+    # counts the time taken by one call
+    #
+    # params:
+    # started (float) - clock() reading from just before the call
+    def record_latency(self, started):
+        latency = self.clock() - started
+        with self.lock:
+            self.latencies.append(latency)
+
+    # returns the p-th percentile (nearest rank) of the call latencies in
+    # seconds, or None if no calls were made
+    #
+    # params:
+    # p (float) - percentile (e.g. 50 or 99)
+    def latency_percentile(self, p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return None
+        return latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)]
+
+    def record_success(self):
+        with self.lock:
+            self.n_calls += 1
+            self.failures_in_a_row = 0
+
+    # counts a failed call and returns its classification
+    #
+    # params:
+    # e (Exception) - exception raised by the call
+    def record_failure(self, e):
+        kind = classify(e)
+        with self.lock:
+            self.n_calls += 1
+            self.n_wasted += 1
+            self.errors[kind] += 1
+            if kind == PERMANENT:
+                return kind
+            self.failures_in_a_row += 1
+            if self.failures_in_a_row >= self.breaker_threshold:
+                if self.failures_in_a_row == self.breaker_threshold:
+                    self.n_breaker_opens += 1
+                self.open_until = self.clock() + self.breaker_cooldown
+        return kind
+
+    # decides what to do after a failed call: raises the exception if the
+    # request should be given up on, otherwise returns the seconds to back off
+    #
+    # params:
+    # attempt (int) - number of calls made so far for this request
+    # e (Exception) - exception raised by the last call
+    def after_failure(self, attempt, e):
+        kind = self.record_failure(e)
+        if kind == PERMANENT or attempt >= self.max_attempts:
+            with self.lock:
+                self.n_given_up += 1
+            raise e
+        with self.lock:
+            self.n_retries += 1
+        return self.backoff(attempt, e)
+
+    # calls fn(*args, **kwargs) until it returns, retrying failures according
+    # to the policy. raises the last exception if it gives up
+    #
+    # params:
+    # fn (function) - the API call
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            wait = self.admit()
+            while wait > 0:
+                self.sleep(wait)
+                wait = self.admit()
+            attempt += 1
+            started = self.clock()
+            try:
+                result = fn(*args, **kwargs)
+            except QuotaExhausted:
+                raise
+            except Exception as e:
+                self.record_latency(started)
+                self.sleep(self.after_failure(attempt, e))
+            else:
+                self.record_latency(started)
+                self.record_success()
+                return result
+
+    # async version of call, for a coroutine function fn
+    #
+    # params:
+    # fn (function) - coroutine function making the API call
+    async def call_async(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            wait = self.admit()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.admit()
+            attempt += 1
+            started = self.clock()
+            try:
+                result = await fn(*args, **kwargs)
+            except QuotaExhausted:
+                raise
+            except Exception as e:
+                self.record_latency(started)
+                await asyncio.sleep(self.after_failure(attempt, e))
+            else:
+                self.record_latency(started)
+                self.record_success()
+                return result
+
+    # one line summary of the counters
+    def summary(self):
+        latency = ""
+        if len(self.latencies) > 0:
+            latency = " (latency p50 %.3f s, p99 %.3f s)" % (self.latency_percentile(50), self.latency_percentile(99))
+        return "%d calls" % self.n_calls + latency + ", %d retries, %d wasted calls (%d rate limited, %d transient, %d permanent), %d given up, circuit breaker opened %d times" % (self.n_retries, self.n_wasted, self.errors[RATE_LIMIT], self.errors[TRANSIENT], self.errors[PERMANENT], self.n_given_up, self.n_breaker_opens)
@@ -0,0 +1,432 @@
+# columnar store of pipeline output csvs. `ingest` compacts a directory of
+# pipeline output csvs (a big run, a parameter sweep or manually labeled files)
+# into one Parquet dataset, partitioned by seed (and, for parameter sweeps, by
+# the run parameters in the file names), with typed columns: Google filter
+# results are booleans (null where the search errored), flags are booleans,
+# depths are integers and repetitive strings are dictionary-encoded. the
+# dataset directory also holds a manifest (_manifest.json) listing the source
+# files in their original order, with their sizes, mtimes, row counts and
+# columns.
+#
+# the analysis scripts read their input through read_runs / iter_runs (or
+# read_csv_typed for a single csv), which take either a directory of csvs or a
+# dataset, and return the same typed DataFrames for both, in one schema
+# whichever version of the pipeline wrote the files (see canonical). from a
+# dataset only the requested columns are read, and seed and file filters are
+# pushed down to the Parquet scan. map_runs applies a function to each file,
+# on a process pool for csvs, and scripts keep its results per file in a cache
+# (load_cache / save_cache) so that only new or changed files are read again.
+# pyarrow is only needed for datasets.
+#
+# e.g. python run_store.py ingest data/big_run data/big_run.parquet
+#      python largescale_plots.py -d data/big_run.parquet
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError: # only needed for datasets, csv directories are read without it
+    pa = None
+    ds = None
+
+
+MANIFEST = "_manifest.json"
+
+# bump when the layout of datasets changes, so that old ones are ingested again
+STORE_VERSION = 2
+
+# Google filter results: True / False, or "Error" (read in as null)
+RESULT_COLUMNS = ["Google", "GPT-3 term in Google", "GPT-3 term + pill in Google", "google filter", "name filter", "filter prediction"]
+
+# columns that are always True / False
+FLAG_COLUMNS = ["RedMed term inside GPT-3 term"]
+
+# small integer columns (nullable, they are missing from files of older runs).
+# Google depths are at most 100, the deepest the search API goes
+INT_COLUMNS = ["Google depth"]
+
+# columns with few distinct values. "False" in "Seed of GPT-3 term in RedMed"
+# (the term isn't in RedMed) is read in as null
+CATEGORICAL_COLUMNS = ["seed for prompt", "Seed of GPT-3 term in RedMed", "Google added token", "token added to Google", "manual label"]
+
+# run parameters encoded in the file names of parameter sweep outputs
+PARAM_COLUMNS = ["model", "temp", "freq", "pres", "prompts", "queries_per_prompt", "counter"]
+
+
+# returns the parameter settings of a sweep output file from its name, or None
+# if it isn't named like one
+#
+# params:
+# f (str) - file name, as written by the parameter sweep
+def params_from_fname(f):
+    try:
+        model, _, temp, _, freq, _, pres, _, prompts, _, _, _, queries_per_prompt, _, counter = f[:-4].split("_")
+        return {"model": model, "temp": float(temp) / 100, "freq": float(freq) / 100, "pres": float(pres) / 100,
+                "prompts": int(prompts), "queries_per_prompt": int(queries_per_prompt), "counter": counter == "True"}
+    except ValueError:
+        return None
+
+
+# converts the columns of a pipeline output csv, as read by pd.read_csv, to
+# their types (see the column lists above) and renames them to the current
+# schema (see canonical). returns the converted DataFrame
+#
+# params:
+# df (DataFrame) - pipeline output csv
+def typed(df):
+    df = df.copy()
+    for col in df.columns:
+        if col in RESULT_COLUMNS:
+            # columns without errors are read in as bools, others as strings
+            df[col] = df[col].map({True: True, False: False, "True": True, "False": False}).astype("boolean")
+        elif col in FLAG_COLUMNS:
+            # stored as strings by some writers, where "False" would be truthy.
+            # anything else is left null, which astype(bool) refuses
+            df[col] = df[col].map({True: True, False: False, "True": True, "False": False}).astype("boolean").astype(bool)
+        elif col in INT_COLUMNS:
+            df[col] = df[col].astype("Int8")
+        elif col in CATEGORICAL_COLUMNS:
+            values = df[col].astype(object)
+            if col == "Seed of GPT-3 term in RedMed":
+                values = values.where(values != "False")
+            df[col] = values.astype("category")
+    return canonical(df)
+
+
+# returns a typed pipeline output with the Google filter columns of the
+# current pipeline ("Google", "Google added token" and "Google depth"), from
+# whichever version of the pipeline wrote it:
+# - the first big runs recorded the filter result as "GPT-3 term in Google",
+#   with the suffix that validated the term in "token added to Google"
+# - the parameter sweep recorded the result of the term alone ("GPT-3 term in
+#   Google") and with " pill" added ("GPT-3 term + pill in Google"). the term
+#   passes if either is True, with " pill" added only if it took the suffix
+#   (these two columns are kept, they are what the sweep is analyzed by)
+# depths weren't recorded before the current pipeline, so they are null
+#
+# params:
+# df (DataFrame) - typed pipeline output (see typed)
+def canonical(df):
+    if "Google" in df.columns:
+        pass
+    elif "token added to Google" in df.columns:
+        df = df.rename(columns={"GPT-3 term in Google": "Google", "token added to Google": "Google added token"})
+    elif "GPT-3 term + pill in Google" in df.columns:
+        alone = df["GPT-3 term in Google"]
+        pill = ~alone & df["GPT-3 term + pill in Google"]
+        df["Google"] = alone | pill
+        df["Google added token"] = pd.Series(pd.NA, index=df.index, dtype=object).where(~pill.fillna(False), " pill").astype("category")
+    else:
+        return df
+    if not "Google depth" in df.columns:
+        df["Google depth"] = pd.Series(pd.NA, index=df.index, dtype="Int8")
+    return df
+
+
+# params:
+# path (str) - pipeline output csv
+def read_csv_typed(path):
+    return typed(pd.read_csv(path, index_col=0))
+
+
+# returns whether a path is a dataset written by ingest
+#
+# params:
+# path (str) - directory of csvs or dataset
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+# returns the source files of a directory of csvs or dataset, in order, as
+# dicts with the file name, size and mtime (as in the manifest, which also has
+# the row count and columns of each file)
+#
+# params:
+# path (str) - directory of csvs or dataset
+def source_files(path):
+    if is_dataset(path):
+        return load_manifest(path)["files"]
+    files = []
+    for f in os.listdir(path):
+        if f[-4:] == ".csv" and os.path.isfile(os.path.join(path, f)):
+            st = os.stat(os.path.join(path, f))
+            files.append({"file": f, "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+    return files
+
+
+# params:
+# path (str) - dataset
+def load_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest["version"] != STORE_VERSION:
+        raise ValueError("%s was written by another version of run_store.py, ingest it again" % path)
+    return manifest
+
+
+# returns the arrow type a column of a typed DataFrame is stored as
+#
+# params:
+# col (str) - column name
+# partition (bool) - whether the dataset is partitioned by the column
+def arrow_type(col, partition=False):
+    if col in RESULT_COLUMNS or col in FLAG_COLUMNS:
+        return pa.bool_()
+    if col in INT_COLUMNS:
+        return pa.int8()
+    if col == "row":
+        return pa.int64()
+    if col == "position":
+        return pa.int32()
+    if col in CATEGORICAL_COLUMNS:
+        return pa.string() if partition else pa.dictionary(pa.int32(), pa.string())
+    if col in ["temp", "freq", "pres"]:
+        return pa.float64()
+    if col in ["prompts", "queries_per_prompt"]:
+        return pa.int64()
+    if col == "counter":
+        return pa.bool_()
+    return pa.string()
+
+
+# returns the hive partitioning of a dataset (directories named col=value)
+#
+# params:
+# partition_columns (list) - columns the dataset is partitioned by
+def partitioning(partition_columns):
+    return ds.partitioning(pa.schema([(col, arrow_type(col, True)) for col in partition_columns]), flavor="hive")
+
+
+# compacts a directory of pipeline output csvs into a partitioned Parquet
+# dataset, replacing the dataset if it exists. returns the manifest
+#
+# params:
+# d (str) - directory of pipeline output csvs
+# out (str) - dataset directory to write
+def ingest(d, out):
+    if pa is None:
+        raise ImportError("ingesting csvs into a dataset needs pyarrow")
+    fnames = [f for f in os.listdir(d) if f[-4:] == ".csv" and os.path.isfile(os.path.join(d, f))]
+    params = [params_from_fname(f) for f in fnames]
+    is_sweep = len(fnames) > 0 and all(p is not None for p in params)
+
+    files = []
+    dfs = []
+    for f, p in zip(fnames, params):
+        path = os.path.join(d, f)
+        st = os.stat(path)
+        df = read_csv_typed(path)
+        files.append({"file": f, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "rows": len(df), "columns": df.columns.tolist()})
+        df = df.rename_axis("row").reset_index()
+        df.insert(0, "file", f)
+        df.insert(1, "position", range(len(df)))
+        if is_sweep:
+            for k, v in p.items():
+                df[k] = v
+        dfs.append(df)
+
+    columns = list(dict.fromkeys(col for df in dfs for col in df.columns))
+    partition_columns = ["seed for prompt"] + (PARAM_COLUMNS if is_sweep else [])
+    schema = pa.schema([(col, arrow_type(col, col in partition_columns)) for col in columns])
+    # categories differ between files, so concatenate them as plain values
+    df = pd.concat([df.astype({col: object for col in df.columns if col in CATEGORICAL_COLUMNS}) for df in dfs], ignore_index=True)
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    tmp = out.rstrip("/") + ".%d.tmp" % os.getpid()
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    ds.write_dataset(table, tmp, format="parquet", partitioning=partitioning(partition_columns), basename_template="part-{i}.parquet")
+    manifest = {"version": STORE_VERSION, "source": os.path.abspath(d), "partitioning": partition_columns, "columns": columns, "files": files}
+    with open(os.path.join(tmp, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.replace(tmp, out)
+    return manifest
+
+
+# reads rows of a dataset. returns a typed DataFrame indexed like the source
+# csvs, with a "file" column, in the order of the source files (and of the
+# rows in each file)
+#
+# params:
+# path (str) - dataset
+# columns (list) - columns to read (None for all)
+# seeds (list) - only read rows generated for these index terms (None for all)
+# files (list) - only read rows of these source files (None for all)
+def read_dataset(path, columns=None, seeds=None, files=None):
+    if pa is None:
+        raise ImportError("reading %s needs pyarrow" % path)
+    manifest = load_manifest(path)
+    dataset = ds.dataset(path, format="parquet", partitioning=partitioning(manifest["partitioning"]))
+
+    condition = None
+    for col, values in [("seed for prompt", seeds), ("file", files)]:
+        if values is not None:
+            c = ds.field(col).isin(list(values))
+            condition = c if condition is None else condition & c
+    if columns is not None:
+        columns = ["file", "position", "row"] + [col for col in columns if col in manifest["columns"] and not col in ["file", "position", "row"]]
+    table = dataset.to_table(columns=columns, filter=condition)
+    df = table.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+    for col in df.columns:
+        if col in FLAG_COLUMNS or col == "counter":
+            df[col] = df[col].astype(bool)
+        elif col in INT_COLUMNS:
+            df[col] = df[col].astype("Int8")
+        elif col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype("category")
+    order = {f["file"]: i for i, f in enumerate(manifest["files"])}
+    df["order"] = df["file"].map(order)
+    df = df.sort_values(["order", "position"]).drop(columns=["order", "position"])
+    return df.set_index("row").rename_axis(None)
+
+
+# reads the files of a directory of csvs or dataset into one typed DataFrame,
+# with a "file" column naming the source file of each row
+#
+# params:
+# path (str) - directory of csvs or dataset
+# columns (list) - columns to read (None for all)
+# seeds (list) - only read rows generated for these index terms (None for all)
+# files (list) - only read these source files (None for all)
+def read_runs(path, columns=None, seeds=None, files=None):
+    if is_dataset(path):
+        return read_dataset(path, columns, seeds, files)
+    dfs = [df.assign(file=f) for f, _, df in iter_runs(path, columns, seeds, files)]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=["file"])
+    return pd.concat(dfs)
+
+
+# yields (file name, columns of the file, typed DataFrame of its rows) for
+# each source file of a directory of csvs or dataset, in order (files without
+# rows included). a dataset is read in a single scan
+#
+# params:
+# path (str) - directory of csvs or dataset
+# columns (list) - columns to read (None for all)
+# seeds (list) - only read rows generated for these index terms (None for all)
+# files (list) - only read these source files (None for all)
+def iter_runs(path, columns=None, seeds=None, files=None):
+    sources = [s for s in source_files(path) if files is None or s["file"] in files]
+    if is_dataset(path):
+        df = read_dataset(path, columns, seeds, [s["file"] for s in sources])
+        groups = dict(list(df.groupby("file", sort=False)))
+        for s in sources:
+            cols = [col for col in s["columns"] if columns is None or col in columns]
+            rows = groups.get(s["file"], df.iloc[:0])
+            yield s["file"], s["columns"], rows[cols]
+        return
+    for s in sources:
+        df = read_csv_typed(os.path.join(path, s["file"]))
+        file_columns = df.columns.tolist()
+        if seeds is not None:
+            df = df.loc[df["seed for prompt"].isin(seeds)]
+        if columns is not None:
+            df = df[[col for col in df.columns if col in columns]]
+        yield s["file"], file_columns, df
+
+
+# reads one csv of a directory and applies fn to it (see map_runs). runs in
+# the worker processes
+#
+# params:
+# path (str) - directory of csvs
+# f (str) - file name
+# fn (function) - function to apply
+# columns (list) - columns to pass to fn (None for all)
+# seeds (list) - only pass rows generated for these index terms (None for all)
+def map_file(path, f, fn, columns=None, seeds=None):
+    for f, file_columns, df in iter_runs(path, columns, seeds, [f]):
+        return fn(f, file_columns, df)
+
+
+# applies fn(file name, columns of the file, typed DataFrame of its rows) to
+# some source files of a directory of csvs or dataset. yields (file name,
+# result) as the results come in: the csvs are read on a process pool (so fn
+# must be a top-level function), a dataset is read in a single scan
+#
+# params:
+# path (str) - directory of csvs or dataset
+# fn (function) - function to apply
+# files (list) - names of the source files to apply fn to
+# columns (list) - columns to pass to fn (None for all)
+# seeds (list) - only pass rows generated for these index terms (None for all)
+# workers (int) - number of worker processes
+def map_runs(path, fn, files, columns=None, seeds=None, workers=1):
+    if is_dataset(path) or workers <= 1 or len(files) <= 1:
+        for f, file_columns, df in iter_runs(path, columns, seeds, files):
+            yield f, fn(f, file_columns, df)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(map_file, path, f, fn, columns, seeds): f for f in files}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# returns the fingerprint of a source file (from source_files) that results
+# computed from it are cached with, along with anything else they depend on
+#
+# params:
+# source (dict) - source file
+# extra (tuple) - versions of everything else the results depend on
+def file_fingerprint(source, extra=()):
+    return (source["size"], source["mtime_ns"]) + tuple(extra)
+
+
+# loads a cache of per-file results: a dict mapping a key (of the file) to
+# the fingerprint of the file they were computed from and the results.
+# returns an empty cache if there is none (or it can't be read)
+#
+# params:
+# path (str) - cache file
+def load_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception: # missing, partially written or from an older version
+        return dict()
+
+
+# params:
+# cache (dict) - cache of per-file results (see load_cache)
+# path (str) - cache file
+def save_cache(cache, path):
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "wb") as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def main(args):
+    if args.command == "ingest":
+        start = time.time()
+        manifest = ingest(args.paths[0], args.paths[1])
+        n_rows = sum(f["rows"] for f in manifest["files"])
+        print("ingested %d files (%d rows) into %s in %.1f s, partitioned by %s" % (len(manifest["files"]), n_rows, args.paths[1], time.time() - start, ", ".join(manifest["partitioning"])))
+    elif args.command == "info":
+        manifest = load_manifest(args.paths[0])
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, _, fs in os.walk(args.paths[0]) for f in fs)
+        print("source: %s" % manifest["source"])
+        print("files: %d" % len(manifest["files"]))
+        print("rows: %d" % sum(f["rows"] for f in manifest["files"]))
+        print("partitioned by: %s" % ", ".join(manifest["partitioning"]))
+        print("bytes: %d" % size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=["ingest", "info"], help="ingest: compact a directory of pipeline output csvs into a dataset (run_store.py ingest DIR DATASET), info: describe a dataset")
+    parser.add_argument('paths', type=str, nargs="+", help="directory of csvs and dataset to write (ingest), or dataset (info)")
+    args = parser.parse_args()
+
+    main(args)
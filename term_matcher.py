@@ -0,0 +1,130 @@
+# compiled matcher for checking whether any of a set of (possibly multi-token)
+# terms occurs as a contiguous run of tokens in a response. terms and responses
+# use "_" to separate tokens, as in the rest of the pipeline. gives the same
+# answers as gpt_queries.redmed_term_in_response, but the terms are compiled
+# once into an Aho-Corasick automaton over tokens, so each check is linear in
+# the length of the response regardless of how many terms there are. terms can
+# be given labels (e.g. the seed each term belongs to) to find out which of
+# them occur in a single pass
+
+from functools import lru_cache
+
+
+class TermMatcher:
+    # params:
+    # terms (iterable) - terms to search for (could be a single term)
+    # labels (iterable) - label of each term (defaults to the term itself)
+    def __init__(self, terms, labels=None):
+        terms = list(terms)
+        if labels is None:
+            labels = terms
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [frozenset()] # labels of the terms that end at each state
+        for t, label in zip(terms, labels):
+            self._add(t.split("_"), label)
+        self._link()
+
+    # adds the token sequence of one term to the trie
+    #
+    # params:
+    # t_tokens (list) - tokens of the term
+    # label - label of the term
+    def _add(self, t_tokens, label):
+        state = 0
+        for tok in t_tokens:
+            nxt = self.goto[state].get(tok)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][tok] = nxt
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.out.append(frozenset())
+            state = nxt
+        self.out[state] = self.out[state] | {label}
+
+    # computes failure links breadth-first so that a mismatch falls back to the
+    # longest proper suffix of the current token run that is also a prefix of
+    # some term
+    def _link(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for tok, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and not tok in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(tok, 0)
+                self.out[nxt] = self.out[nxt] | self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    # checks to see if any of the compiled terms are present in the response
+    #
+    # params:
+    # r (str) - the response to check (e.g. a GPT-3 term or a search result title)
+    def matches(self, r):
+        return self.matches_tokens(r.lower().split("_"))
+
+    # like matches, for a response that is already lowercased and split into
+    # tokens
+    #
+    # params:
+    # r_tokens (sequence) - tokens of the response
+    def matches_tokens(self, r_tokens):
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for tok in r_tokens:
+            while state and not tok in goto[state]:
+                state = fail[state]
+            state = goto[state].get(tok, 0)
+            if out[state]:
+                return True
+        return False
+
+    # returns the set of labels of all the compiled terms present in a
+    # response that is already lowercased and split into tokens
+    #
+    # params:
+    # r_tokens (sequence) - tokens of the response
+    def labels_in_tokens(self, r_tokens):
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        found = set()
+        for tok in r_tokens:
+            while state and not tok in goto[state]:
+                state = fail[state]
+            state = goto[state].get(tok, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+    # batch version of matches
+    #
+    # params:
+    # responses (iterable) - responses to check
+    def matches_many(self, responses):
+        return [self.matches(r) for r in responses]
+
+    # checks to see if any of the compiled terms are present in any of the responses
+    #
+    # params:
+    # responses (iterable) - responses to check
+    def matches_any(self, responses):
+        for r in responses:
+            if self.matches(r):
+                return True
+        return False
+
+
+# returns the (cached) compiled matcher for checking search result titles and
+# snippets against several index terms at once, with each index term as its
+# own label
+#
+# params:
+# seeds (tuple) - index terms (sorted, so that the same set shares a matcher)
+@lru_cache(maxsize=4096)
+def seeds_matcher(seeds):
+    return TermMatcher(seeds)
@@ -0,0 +1,34 @@
+# the tests import the scripts from the repository root and run from there,
+# like the scripts themselves (they read the lexicon and data by relative
+# path). the fake servers don't check API keys, but the clients need one
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_servers
+
+
+@pytest.fixture(autouse=True)
+def in_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+
+
+# starts fake servers in the background (returning their URL) and stops them
+# after the test
+@pytest.fixture
+def serve():
+    started = []
+
+    def start(server):
+        started.append(server)
+        return fake_servers.start_in_background(server)
+
+    yield start
+    for server in started:
+        fake_servers.stop(server)
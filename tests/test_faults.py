@@ -0,0 +1,119 @@
+# runs the pipeline against fake servers that inject errors, go down or reject
+# the API key, and checks how completions that can't be parsed are handled
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+import pytest
+import completions
+import fake_servers
+import gpt_queries
+from memo_store import open_memo
+from output_writer import OutputWriter
+from rate_limit import CompletionLimiter
+from retry import RetryPolicy
+
+SEED = "alprazolam"
+
+
+# returns gpt_queries.py arguments for a --save run in tmp_path
+def pipeline_args(tmp_path, api_base, search_url, *extra):
+    seeds_fname = tmp_path / "seeds.txt"
+    seeds_fname.write_text(SEED)
+    return gpt_queries.get_parser().parse_args(["--seeds", str(seeds_fname), "--save", "--outdir", str(tmp_path), "--memo", str(tmp_path / "memo.p"),
+                                                "--quota_db", str(tmp_path / "quota.db"), "--daily_limit", "1000000000", "--prompt_seed", "0", "--depth", "3",
+                                                "--api_base", api_base, "--search_url", search_url, "--search_qps", "100", "--rpm", "6000"] + list(extra))
+
+
+# returns the (prompt index, query index) slots the run's checkpoint has done
+def done_slots(tmp_path, prompts, queries_per_prompt):
+    writer = OutputWriter(os.path.join(tmp_path, "%s.csv" % SEED), resume=True, prompt_seed=0)
+    return [(i, j) for i in range(prompts) for j in range(queries_per_prompt) if writer.is_done(SEED, i, j)]
+
+
+def test_flaky_servers(tmp_path, serve):
+    faults = dict(error_rate=0.1, throttle_rate=0.1, retry_after=0)
+    completion_server = fake_servers.make_completion_server(seed=1, **faults)
+    search_server = fake_servers.make_search_server(seed=2, **faults)
+    args = pipeline_args(tmp_path, serve(completion_server), serve(search_server), "--prompts", "4", "--queries_per_prompt", "2", "--concurrency", "4")
+    gpt_queries.main(args)
+    assert completion_server.n_faults > 0 and search_server.n_faults > 0
+    assert len(done_slots(tmp_path, 4, 2)) == 8
+
+
+def test_outage_skips_queries_until_resumed(tmp_path, serve):
+    completion_server = fake_servers.make_completion_server(seed=1)
+    completion_server.down = True
+    search_server = fake_servers.make_search_server(seed=2)
+    args = pipeline_args(tmp_path, serve(completion_server), serve(search_server), "--prompts", "2", "--max_attempts", "2")
+    completion_policy, _, _ = gpt_queries.main(args)
+    assert completion_policy.n_given_up == 2
+    assert done_slots(tmp_path, 2, 1) == []
+
+    completion_server.down = False
+    args.resume = True
+    gpt_queries.main(args)
+    assert done_slots(tmp_path, 2, 1) == [(0, 0), (1, 0)]
+
+
+def test_bad_key_stops_run_and_keeps_memo(tmp_path, serve):
+    completion_server = fake_servers.make_completion_server(seed=1)
+    search_server = fake_servers.make_search_server(seed=2)
+    args = pipeline_args(tmp_path, serve(completion_server), serve(search_server), "--prompts", "3")
+
+    # rejects the key once searching has started
+    def reject_key():
+        while search_server.n_requests == 0:
+            time.sleep(0.01)
+        completion_server.down_status = 401
+        completion_server.down = True
+    threading.Thread(target=reject_key, daemon=True).start()
+
+    with pytest.raises(openai.error.AuthenticationError):
+        gpt_queries.main(args)
+    memo = open_memo(str(tmp_path / "memo.p"))
+    assert len(memo.page_rows()) > 0
+
+
+# replaces the completion API with one that answers with the given texts in
+# turn, and returns the list of prompts it was called with
+def fake_create(monkeypatch, texts):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["prompt"])
+        return {"choices": [{"text": texts[min(len(calls), len(texts)) - 1], "index": 0}]}
+    monkeypatch.setattr(openai.Completion, "create", create)
+    monkeypatch.setattr(completions.time, "sleep", lambda seconds: None)
+    return calls
+
+
+def test_unparsable_completion_is_queried_again(monkeypatch):
+    calls = fake_create(monkeypatch, [" a\n\n2. b", " a\n2. b"])
+    policy = RetryPolicy()
+    assert completions.query("fake", "prompt", 0.5, 10, 0, 0, policy=policy) == ["a", "b"]
+    assert len(calls) == 2
+    assert policy.n_wasted == 0 and policy.failures_in_a_row == 0
+
+
+def test_unparsable_completion_is_queried_again_async(monkeypatch):
+    calls = fake_create(monkeypatch, [" a\n\n2. b", " a\n2. b"])
+    policy = RetryPolicy()
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return await completions.aquery("fake", "prompt", 0.5, 10, 0, 0, CompletionLimiter(6000, 1e9), executor, policy=policy)
+    assert asyncio.run(run()) == ["a", "b"]
+    assert len(calls) == 2
+    assert policy.n_wasted == 0 and policy.failures_in_a_row == 0
+
+
+def test_never_parsable_completion_is_skipped(monkeypatch):
+    calls = fake_create(monkeypatch, [" a\n\n2. b"])
+    policy = RetryPolicy(max_attempts=3)
+    assert completions.query("fake", "prompt", 0.5, 10, 0, 0, policy=policy) is None
+    assert len(calls) == 3
+    assert policy.n_breaker_opens == 0 and policy.n_given_up == 0
@@ -0,0 +1,82 @@
+# runs the Google search filter against the fake search server: results on
+# recorded pages, concurrent validation against sequential, the memo and the
+# QPS limit
+
+import time
+import pytest
+import fake_servers
+from google_search import SearchEngine, tokenize
+from memo_store import open_memo
+from retry import RetryPolicy
+
+TERMS = ["xanax", "xanax bars", "zannies", "blues", "footballs", "ladders", "bricks", "bars"]
+SEEDS = ["alprazolam", "fentanyl", "heroin"]
+
+
+# returns a recorded page of results with the given titles, in memo form
+def recorded_page(titles, total=None):
+    if total is None:
+        total = len(titles)
+    return (total, tuple((tokenize(title), None) for title in titles))
+
+
+# returns a search engine on a fresh memo in tmp_path, pointed at the server
+def engine(tmp_path, url, name="memo.p", **kwargs):
+    return SearchEngine(open_memo(str(tmp_path / name)), url=url, policy=RetryPolicy(base=0.01), **kwargs)
+
+
+def test_default_pace():
+    assert SearchEngine(None).limiter.rate == pytest.approx(1 / 1.5)
+
+
+def test_results_on_recorded_pages(tmp_path, serve):
+    recorded = open_memo(str(tmp_path / "recorded.p"))
+    recorded.put_page("foo", 1, recorded_page(["nothing", "more nothing", "still nothing", "buy alprazolam online"]))
+    recorded.put_page("bar", 1, recorded_page(["nothing at all"]))
+    recorded.put_page("bar pill", 1, recorded_page(["bar", "alprazolam 2mg bar"]))
+    server = fake_servers.make_search_server(memo=recorded)
+    search = engine(tmp_path, serve(server), qps=100)
+
+    assert search.validate("foo", "alprazolam") == (True, "", 4, 1)
+    # "bar" has a single result without the seed, so " pill" is tried next
+    assert search.validate("bar", "alprazolam") == (True, " pill", 2, 2)
+    assert server.n_replayed == 3
+    search.close()
+
+
+def test_concurrent_matches_sequential(tmp_path, serve):
+    server = fake_servers.make_search_server()
+    url = serve(server)
+    jobs = [(term, seed) for term in TERMS for seed in SEEDS]
+    sequential = engine(tmp_path, url, "sequential.p", qps=1000, workers=1, depth=20)
+    expected = sequential.validate_many(jobs)
+    n_sequential = server.n_requests
+
+    concurrent = engine(tmp_path, url, "concurrent.p", qps=1000, workers=8, depth=20)
+    assert concurrent.validate_many(jobs) == expected
+    assert concurrent.n_api_queries == n_sequential
+    # every page was requested once by each engine, however many seeds
+    # needed it
+    assert max(server.query_counts.values()) == 2
+
+    # a rerun finds every page in the memo
+    assert concurrent.validate_many(jobs) == [(google, google_add, depth, 0) for google, google_add, depth, n_googled in expected]
+    assert concurrent.n_api_queries == n_sequential
+    assert server.n_requests == 2 * n_sequential
+    sequential.close()
+    concurrent.close()
+
+
+def test_qps_limit(tmp_path, serve):
+    # the server answers 429 past 5 queries a second, the client sends 4
+    server = fake_servers.make_search_server(rate_limit=5)
+    search = engine(tmp_path, serve(server), qps=4, workers=8, depth=20)
+    start = time.monotonic()
+    search.validate_many([(term, "alprazolam") for term in TERMS])
+    elapsed = time.monotonic() - start
+    search.close()
+
+    assert server.n_faults == 0
+    assert search.n_api_queries == server.n_requests > 4
+    # a burst of 4, then one query every quarter second
+    assert elapsed >= (server.n_requests - 4) / 4 - 0.1
@@ -0,0 +1,106 @@
+# checks the shared search quota on a fake clock: the reserve kept for high
+# priority callers, and the reset at midnight Pacific time. the high and low
+# priority callers are separate QuotaManagers on the same database, like
+# separate processes
+
+import datetime
+import pytest
+from quota import QuotaExhausted, QuotaManager
+
+UTC = datetime.timezone.utc
+
+
+# a clock set to a UTC time, that only moves when told to
+class FakeClock:
+    def __init__(self, *utc):
+        self.now = datetime.datetime(*utc, tzinfo=UTC).timestamp()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    # 23:59 on 14 January in Los Angeles (PST, UTC-8)
+    return FakeClock(2026, 1, 15, 7, 59)
+
+
+# returns a high priority and a low priority caller sharing a quota of 10
+# queries a day, of which 3 are reserved for high priority
+def managers(tmp_path, clock, key="key"):
+    path = str(tmp_path / "quota.db")
+    return QuotaManager(path, limit=10, key=key, reserve=3, clock=clock), QuotaManager(path, limit=10, key=key, reserve=3, clock=clock)
+
+
+def test_reserve_keeps_low_priority_from_starving_high_priority(tmp_path, clock):
+    high, low = managers(tmp_path, clock)
+    for _ in range(7):
+        low.spend(1, priority=1)
+    assert low.remaining(priority=1) == 0
+    assert high.remaining(priority=0) == 3
+    with pytest.raises(QuotaExhausted):
+        low.spend(1, priority=1)
+    assert not low.try_spend(1, priority=1)
+
+    # the low priority caller's failed attempts didn't use anything up
+    assert high.used() == 7
+    for _ in range(3):
+        high.spend(1, priority=0)
+    with pytest.raises(QuotaExhausted):
+        high.spend(1, priority=0)
+    assert low.used() == 10
+
+
+def test_high_priority_spends_what_low_priority_left(tmp_path, clock):
+    high, low = managers(tmp_path, clock)
+    high.spend(5, priority=0)
+    # only 2 of the 5 left are outside the reserve
+    assert low.remaining(priority=1) == 2
+    assert not low.try_spend(3, priority=1)
+    assert low.try_spend(2, priority=1)
+    assert high.remaining(priority=0) == 3
+
+
+def test_quota_resets_at_pacific_midnight(tmp_path, clock):
+    high, low = managers(tmp_path, clock)
+    assert high.day() == "2026-01-14"
+    assert high.seconds_until_reset() == pytest.approx(60)
+    high.spend(10, priority=0)
+    with pytest.raises(QuotaExhausted):
+        low.spend(1, priority=1)
+
+    # 00:00:30 on 15 January in Los Angeles, 08:00:30 UTC
+    clock.now += 90
+    assert low.day() == "2026-01-15"
+    assert high.used() == 0 and low.used() == 0
+    low.spend(7, priority=1)
+    assert not low.try_spend(1, priority=1)
+    high.spend(3, priority=0)
+    assert high.used() == 10
+    assert high.seconds_until_reset() == pytest.approx(24 * 3600 - 30)
+
+
+def test_reset_follows_daylight_saving(tmp_path):
+    # 23:00 on 7 March in Los Angeles (PST). the next day is 23 hours long
+    clock = FakeClock(2026, 3, 8, 7, 0)
+    high, low = managers(tmp_path, clock)
+    assert high.seconds_until_reset() == pytest.approx(3600)
+    clock.now += 3600
+    assert high.day() == "2026-03-08"
+    assert high.seconds_until_reset() == pytest.approx(23 * 3600)
+
+
+def test_keys_have_separate_quotas(tmp_path, clock):
+    high, low = managers(tmp_path, clock)
+    other, _ = managers(tmp_path, clock, key="other key")
+    high.spend(10, priority=0)
+    assert other.remaining(priority=0) == 10
+
+
+def test_record_usage_at_least(tmp_path, clock):
+    high, low = managers(tmp_path, clock)
+    high.spend(4, priority=0)
+    low.record_usage_at_least(6)
+    assert high.used() == 6
+    low.record_usage_at_least(2)
+    assert high.used() == 6
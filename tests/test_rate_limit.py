@@ -0,0 +1,98 @@
+# checks the token buckets of the completion rate limiter on a fake clock, and
+# the concurrent completion path against the fake completion server
+
+import asyncio
+import time
+import openai
+import pytest
+import fake_servers
+from completions import run_queries
+from rate_limit import CompletionLimiter, TokenBucket, estimate_tokens
+from retry import RetryPolicy
+
+
+# a clock that only moves when told to
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst_then_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(2, capacity=3, clock=clock)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # the bucket goes into debt, so later callers wait longer
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    # refilled up to capacity only
+    clock.now = 10.0
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_token_bucket_refund():
+    clock = FakeClock()
+    bucket = TokenBucket(1, capacity=10, clock=clock)
+    assert bucket.reserve(10) == 0.0
+    assert bucket.reserve(5) == pytest.approx(5.0)
+    bucket.refund(5)
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    bucket.refund(100)
+    assert bucket.tokens == bucket.capacity
+
+
+def test_requests_per_minute():
+    clock = FakeClock()
+    limiter = CompletionLimiter(rpm=60, tpm=1e9, clock=clock)
+    assert [limiter.reserve(1) for _ in range(4)] == [0.0, pytest.approx(1.0), pytest.approx(2.0), pytest.approx(3.0)]
+    clock.now = 100.0
+    assert limiter.reserve(1) == 0.0
+
+
+def test_tokens_per_minute():
+    clock = FakeClock()
+    limiter = CompletionLimiter(rpm=1e9, tpm=600, clock=clock)
+    # 10 tokens a second, with a burst of 10
+    assert limiter.reserve(10) == 0.0
+    assert limiter.reserve(30) == pytest.approx(3.0)
+    # the request used fewer tokens than estimated
+    limiter.settle(30, 10)
+    assert limiter.reserve(10) == pytest.approx(2.0)
+
+
+def test_slowest_limit_wins():
+    clock = FakeClock()
+    limiter = CompletionLimiter(rpm=60, tpm=600, clock=clock)
+    limiter.reserve(10)
+    assert limiter.reserve(5) == pytest.approx(1.0)
+    assert limiter.reserve(50) == pytest.approx(5.5)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("a" * 40, 100) == 111
+
+
+def test_run_queries_against_fake_server(serve, monkeypatch):
+    # the server allows 2.5 requests a second (and answers 429 past it), the
+    # client sends at most 2 a second
+    server = fake_servers.make_completion_server(latency=0.05, rate_limit=2.5, terms={"seed %d" % k: ["term %d" % k] for k in range(4)})
+    monkeypatch.setattr(openai, "api_base", serve(server))
+    monkeypatch.setattr(openai, "api_key", "test")
+    prompts = ["ways to say seed %d:\n1." % k for k in range(4)]
+    limiter = CompletionLimiter(rpm=120, tpm=1e9)
+    policy = RetryPolicy()
+
+    start = time.monotonic()
+    responses = asyncio.run(run_queries(prompts, 2, "fake", 0.5, 10, 0, 0, limiter, 4, policy=policy))
+    elapsed = time.monotonic() - start
+
+    # in the order of the sequential loop: both queries of the first prompt,
+    # then both queries of the second, ...
+    assert responses == [["term_%d" % k] for k in range(4) for j in range(2)]
+    assert server.n_requests == 8
+    assert server.n_faults == 0 and policy.n_wasted == 0
+    # a burst of 2, then one request every half second
+    assert elapsed >= (8 - 2) / 2 - 0.1
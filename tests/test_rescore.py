@@ -0,0 +1,55 @@
+# re-scores hand-built memos: exact depth cutoffs, index terms found again in
+# pages a later search fetched, and coverage cut short by a result without a
+# title
+
+import pandas as pd
+import pytest
+import rescore
+from google_search import tokenize
+from memo_store import open_memo
+
+
+# returns a page of 10 results with the given titles at the given depths
+def page(start, hits, total=100):
+    return (total, tuple((tokenize(hits.get(start + k, "nothing here %d" % (start + k))), None) for k in range(10)))
+
+
+@pytest.fixture(params=["memo.p", "memo.db"])
+def memo(request, tmp_path):
+    memo = open_memo(str(tmp_path / request.param))
+    # searched to depth 10 for both seeds, then to depth 20 for alprazolam
+    # only, so heroin's -1 doesn't cover the second page
+    memo.put_page("foo", 1, page(1, {3: "alprazolam stuff"}))
+    memo.put_page("foo", 11, page(11, {15: "heroin stuff"}))
+    memo.put_results("foo", {"alprazolam": (True, 3), "heroin": (False, -1)})
+    # the 14th result has no title, so nothing past 13 can be decided
+    untitled = list(page(11, {12: "heroin"})[1])
+    untitled[3] = (None, None)
+    memo.put_page("bar", 1, page(1, {}))
+    memo.put_page("bar", 11, (100, tuple(untitled)))
+    memo.put_results("bar", {"heroin": (False, -1), "alprazolam": (False, -1)})
+    yield memo
+    memo.close()
+
+
+def test_load_results(memo):
+    results = rescore.load_results(memo)
+    assert results.loc[("foo", "heroin"), "depth"] == 15
+    assert results.loc[("bar", "heroin"), "depth"] == 12
+    assert results.loc[("bar", "alprazolam"), "depth"] == -1
+    assert results.loc[("foo", "heroin"), "coverage"] == 20
+    assert results.loc[("bar", "heroin"), "coverage"] == 13
+
+
+@pytest.mark.parametrize("depth, expected", [
+    (1, [False, False, False, False]),
+    (3, [True, False, False, False]),
+    (10, [True, False, False, False]),
+    (13, [True, False, True, False]),
+    (20, [True, True, True, "Error"]),
+])
+def test_exact_cutoffs(memo, depth, expected):
+    df = pd.DataFrame({"GPT-3 term": ["foo", "foo", "bar", "bar"], "seed for prompt": ["alprazolam", "heroin", "heroin", "alprazolam"]})
+    lookups = rescore.lookup(df["GPT-3 term"], df["seed for prompt"], rescore.load_results(memo), [""])
+    google, added, found_depth = rescore.rescore(lookups, [""], depth)
+    assert google.tolist() == expected
@@ -0,0 +1,38 @@
+# reads pipeline output csvs whose True / False columns were written as
+# strings, and checks they come back the same as the booleans of the csv
+# pandas writes
+
+import pandas as pd
+import pytest
+import run_store
+
+
+@pytest.fixture
+def run():
+    return pd.DataFrame({"GPT-3 term": ["xanax", "blues", "bars", "zannies"],
+                         "seed for prompt": ["alprazolam"] * 4,
+                         "Seed of GPT-3 term in RedMed": ["alprazolam", "False", "False", "alprazolam"],
+                         "RedMed term inside GPT-3 term": [True, False, False, True],
+                         "Google": [True, False, "Error", True],
+                         "Google added token": [None, None, None, " pill"],
+                         "Google depth": [1, -1, -1, 4]})
+
+
+def test_string_flags_round_trip(tmp_path, run):
+    path = str(tmp_path / "run.csv")
+    run.to_csv(path)
+    expected = run_store.read_csv_typed(path)
+    assert expected["RedMed term inside GPT-3 term"].tolist() == [True, False, False, True]
+
+    strings = run_store.typed(pd.read_csv(path, index_col=0, dtype=str))
+    assert strings["RedMed term inside GPT-3 term"].dtype == bool
+    assert strings["RedMed term inside GPT-3 term"].tolist() == [True, False, False, True]
+    assert strings["Google"].tolist() == [True, False, pd.NA, True]
+    pd.testing.assert_series_equal(strings["RedMed term inside GPT-3 term"], expected["RedMed term inside GPT-3 term"])
+
+
+def test_unknown_flag_is_an_error(run):
+    run["RedMed term inside GPT-3 term"] = ["True", "False", "maybe", "True"]
+    with pytest.raises(ValueError):
+        run_store.typed(run)
+
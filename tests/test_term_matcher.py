@@ -0,0 +1,68 @@
+# checks the compiled TermMatcher against the token scan it replaced
+# (gpt_queries.redmed_term_in_response) on every generated term of
+# data/big_run
+
+import glob
+import pandas as pd
+import pytest
+from gpt_queries import redmed_term_in_response
+from redmed_lexicon import load_lexicon
+from term_matcher import TermMatcher, seeds_matcher
+
+
+@pytest.fixture(scope="module")
+def big_run():
+    dfs = [pd.read_csv(fname, index_col=0) for fname in sorted(glob.glob("data/big_run/*.csv"))]
+    df = pd.concat(dfs, ignore_index=True)
+    df["GPT-3 term"] = df["GPT-3 term"].astype(str)
+    return df
+
+
+@pytest.fixture(scope="module")
+def lexicon():
+    return load_lexicon()
+
+
+def test_matches_candidates(big_run, lexicon):
+    n_multi = 0
+    for seed, group in big_run.groupby("seed for prompt"):
+        terms = lexicon.candidates[seed]
+        n_multi += sum("_" in t for t in terms)
+        matcher = TermMatcher(terms)
+        responses = group["GPT-3 term"].tolist()
+        expected = [redmed_term_in_response(r, terms) for r in responses]
+        assert [matcher.matches(r) for r in responses] == expected
+        assert matcher.matches_many(responses) == expected
+        assert matcher.matches_any(responses) == any(expected)
+        # the pipeline wrote the old scan's answers to the csvs
+        assert expected == group["RedMed term inside GPT-3 term"].astype(bool).tolist()
+    assert n_multi > 0
+    assert big_run["GPT-3 term"].str.contains("_").any()
+
+
+def test_matches_any_per_response(big_run, lexicon):
+    terms = lexicon.candidates["heroin"]
+    matcher = TermMatcher(terms)
+    for r in big_run["GPT-3 term"].head(2000):
+        assert matcher.matches_any([r]) == redmed_term_in_response(r, terms)
+
+
+# labels of the index terms and every multi-word term of the lexicon found in
+# each response, as with several seeds checked against a search result
+def test_labels_in_tokens(big_run, lexicon):
+    terms = sorted(set(big_run["seed for prompt"]) | {t for ts in lexicon.candidates.values() for t in ts if "_" in t})
+    responses = pd.Series(big_run["GPT-3 term"].unique())
+    lowered = responses.str.lower()
+
+    # the old scan, run per term on the responses that could contain it
+    expected = dict()
+    for t in terms:
+        for r in responses[lowered.str.contains(t.split("_")[0], regex=False)]:
+            if redmed_term_in_response(r, [t]):
+                expected.setdefault(r, set()).add(t)
+    assert any(len(labels) > 1 for labels in expected.values())
+    assert any("_" in t for labels in expected.values() for t in labels)
+
+    matcher = seeds_matcher(tuple(terms))
+    for r in responses:
+        assert matcher.labels_in_tokens(r.lower().split("_")) == expected.get(r, set())